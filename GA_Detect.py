@@ -1,19 +1,149 @@
 """A script to process OpenSky ADS-B data in an attempt to detect go-around events at an airport."""
-from traffic.core import Traffic
 from datetime import timedelta
-import multiprocessing as mp
-from OS_Airports import VABB
+import OS_Startup as OSS
+import OS_Download as OSD
+import OS_Manifest as OSM
+import OS_Registry as OSRG
+import OS_Parquet as OSPQ
+import OS_Results as OSRE
+import OS_Timing as OST
+import OS_Tune as OSTU
+import OS_Render as OSR
+import OS_Stream as OSST
+import OS_Batch as OSB
+import OS_Output as OSO
 import OS_Funcs as OSF
 import glob
+import time
 
 
-def main(start_n, fidder, do_write):
+def handle_results(b_res, writer, store, render):
+    """Pass the results of a batch of flights on to the output stages.
+
+    Arguments:
+    b_res -- the results, flight data, plots and stage timings from
+             OS_Batch.proc_batch()
+    writer -- the result_writer for the result records, or None
+    store -- the flight_store that the flight data is saved into
+    render -- the render_queue that draws the plots
+
+    Returns the number of aircraft processed, the number of go-arounds
+    seen and the writer sequence number of the records (0 if no writer).
+    """
+    recs, np_list, pl_list, timings = b_res
+    OST.merge(timings)
+    for odir, meta, pts in np_list:
+        store.add(odir, meta, pts)
+    for payload in pl_list:
+        render.put(payload)
+    seq = 0
+    if (writer is not None):
+        seq = writer.put(recs)
+
+    return len(recs), int(recs['ga'].sum()), seq
+
+
+def mark_done(man, marks, files, n_marked, store, final=False):
+    """Record written flights and completed input files in the manifest.
+
+    Only batches whose result records are on disk are recorded, and the
+    flight store is synced before the first of them.
+    Arguments:
+    man -- the manifest
+    marks -- a list of (result_writer or None, writer sequence number,
+             flight keys, number of complete input files) for each batch
+             not yet recorded. The recorded batches are removed from the
+             list.
+    files -- the list of input files being processed, or None if the
+             data is coming straight from the downloader
+    n_marked -- the number of input files already marked as complete
+    store -- the flight_store that the batches' flights were saved into
+    final -- (optional) True once every batch has been written
+
+    Returns the new number of input files marked as complete.
+    """
+    synced = False
+    while (len(marks) > 0):
+        writer, seq, keys, n_closed = marks[0]
+        n_written = 0
+        if (writer is not None):
+            n_written = writer.n_written
+        if (not final and seq > n_written):
+            break
+        if (not synced):
+            store.sync()
+            synced = True
+        marks.pop(0)
+        man.mark_flights(keys)
+        if (files is not None and n_closed > n_marked):
+            man.mark_files(files[n_marked:n_closed])
+            n_marked = n_closed
+    return n_marked
+
+
+def closed_files(s_counts, fl_first):
+    """Get the number of leading input files that have no flights waiting.
+
+    Arguments:
+    s_counts -- the counts from OS_Stream.stream_flights()
+    fl_first -- for each airport, the first input file of each flight
+                that has not yet been sent in a batch
+
+    Returns the number of leading input files that have no data left in
+    the stream buffers or in any airport's unsent flights.
+    """
+    n_closed = s_counts['closed']
+    for firsts in fl_first.values():
+        if (len(firsts) > 0):
+            n_closed = min(n_closed, min(firsts))
+    return n_closed
+
+
+def get_odirs(out_dir):
+    """Get the plot and data output directories under a top directory.
+
+    Returns a list of the directories for normal plots, go-around plots,
+    normal data and go-around data, in the order used by OS_Batch.
+    """
+    # odir_nm stores plots for normal landings
+    odir_pl_nm = out_dir + 'OUT_PLOT/NORM/'
+
+    # odir_ga stores plots for detected go-arounds
+    odir_pl_ga = out_dir + 'OUT_PLOT/PSGA/'
+
+    # odir_nm stores plots for normal landings
+    odir_da_nm = out_dir + 'OUT_DATA/NORM/'
+
+    # odir_ga stores plots for detected go-arounds
+    odir_da_ga = out_dir + 'OUT_DATA/PSGA/'
+
+    return [odir_pl_nm, odir_pl_ga, odir_da_nm, odir_da_ga]
+
+
+def send_batch(pool, fl_list, odirs, colormap, do_plot, airport):
+    """Start processing a batch of flights for one airport in the pool."""
+    return pool.apply_async(OSB.proc_batch,
+                            args=(fl_list,
+                                  None,
+                                  odirs,
+                                  colormap,
+                                  do_plot,
+                                  False,
+                                  True,
+                                  airport,))
+
+
+def main(start_n, fidder, do_write, hours=None, apt_names=None):
     """The main code for detecting go-arounds.
 
     Arguments:
     start_n -- The index of the first file to read
     fidder -- the id of an open file to write log information into
     do_write -- boolean flag specifying whether to output data to textfile
+    hours -- (optional) a list of hours to download from OpenSky and process
+             as they arrive, rather than reading files from indir
+    apt_names -- (optional) the ICAO codes of the airports to process, or
+                 None for every airport in OS_Airports
 
     """
     # Total number of aircraft seen
@@ -22,186 +152,282 @@ def main(start_n, fidder, do_write):
     # Of which go-arounds
     tot_n_ga = 0
 
-    top_dir = '/gf2/eodg/SRP002_PROUD_ADSBREP/GO_AROUNDS/VABB/'
+    # Each airport's flights are checked against its own runways. Data for
+    # several airports is read once, as a single region.
+    apts = OSRG.load_airports(apt_names)
+    if (len(apts) < 1):
+        print("No airports to process")
+        return
+    several = len(apts) > 1
+    region = '_'.join(apts.keys())
+
+    top_dir = '/gf2/eodg/SRP002_PROUD_ADSBREP/GO_AROUNDS/' + region + '/'
     # indir stores the opensky data
     indir = top_dir + 'INDATA/'
 
-    # odir_nm stores plots for normal landings
-    odir_pl_nm = top_dir + 'OUT_PLOT/NORM/'
+    # met_dir stores the METAR files, '<ICAO>_METAR' for each airport
+    # unless the airport definition gives its own
+    met_dir = '/home/proud/Desktop/GoAround_Paper/'
 
-    # odir_ga stores plots for detected go-arounds
-    odir_pl_ga = top_dir + 'OUT_PLOT/PSGA/'
+    # The outputs of each airport, in their own directory when there are
+    # several airports
+    odirs = {}
+    writers = {}
+    for icao in apts:
+        out_dir = top_dir
+        out_pre = ''
+        if (several):
+            out_dir = top_dir + icao + '/'
+            out_pre = icao + '_'
+        odirs[icao] = get_odirs(out_dir)
 
-    # odir_nm stores plots for normal landings
-    odir_da_nm = top_dir + 'OUT_DATA/NORM/'
+        # Output filenames for saving data about go-arounds
+        out_file_ga = out_pre + 'GA_MET_NEW.csv'
+        # Output filenames for saving data about non-go-arounds
+        out_file_noga = out_pre + 'GA_NOGA_NEW.csv'
 
-    # odir_ga stores plots for detected go-arounds
-    odir_da_ga = top_dir + 'OUT_DATA/PSGA/'
-
-    odirs = [odir_pl_nm, odir_pl_ga, odir_da_nm, odir_da_ga]
-
-    # Output filenames for saving data about go-arounds
-    out_file_ga = 'GA_MET_NEW.csv'
-    # Output filenames for saving data about non-go-arounds
-    out_file_noga = 'GA_NOGA_NEW.csv'
-
-    t_frmt = "%Y/%m/%d %H:%M:%S"
-
-    # File to save met info for g/a flights
-    if (do_write):
-        metfid = open(out_file_ga, 'w')
-        nogfid = open(out_file_noga, 'w')
-        metfid.write('ICAO24, Callsign, GA_Time, L_Time, Runway, Heading, Alt, Lat, \
-                      Lon, gapt, rocvar, hdgvar, latvar, lonvar, gspvar, \
-                      Temp, Dewp, Wind_Spd, Wind_Gust, Wind_Dir,Cld_Base,\
-                      CB, Vis, Pressure\n')
-        nogfid.write('ICAO24, Callsign, GA_Time, L_Time, Runway, gapt, rocvar, \
-                      hdgvar, latvar, lonvar, gspvar, \
-                      Temp, Dewp, Wind_Spd, Wind_Gust, Wind_Dir,Cld_Base,\
-                      CB, Vis, Pressure\n')
-    files = []
-    files = glob.glob(indir+'**.pkl')
-    files.sort()
-
-    fli_len = len(files)
+        # Result records are written by a background thread. Existing
+        # results are kept and added to.
+        writers[icao] = None
+        if (do_write):
+            writers[icao] = OSRE.result_writer(out_file_ga, out_file_noga,
+                                               fmt='csv')
+
+    # The manifest records completed work, so a rerun carries on from
+    # where the previous run stopped
+    man = OSM.manifest(top_dir + 'manifest.db')
+
+    # pqdir stores the opensky data converted to Parquet, see OS_Parquet
+    pqdir = top_dir + 'PQDATA/'
+
+    if (hours is None):
+        # Use the Parquet files if there are any, otherwise the pickles
+        files = OSPQ.list_files(pqdir, region)
+        if (len(files) < 1):
+            files = glob.glob(indir+'**.pkl')
+            files.sort()
+
+        # Skip the files that were completed by an earlier run. A few
+        # completed files are read again, so that flights already under
+        # way are recognised and skipped.
+        files, n_done = man.pending_files(files[start_n:])
+        print("Files to process:", len(files) - n_done)
+    else:
+        # Downloaded hours have no input files to record in the manifest,
+        # but completed flights are still skipped
+        files = None
+        n_done = 0
+        print("Hours to download:", len(hours))
 
     colormap = {'GND': 'black', 'CL': 'green', 'CR': 'blue',
                 'DE': 'orange', 'LVL': 'purple', 'NA': 'red'}
 
-    # Number of files to open in one go
-    n_files_proc = 55
-
-    pool_proc = 100
-
-    f_data = []
-    pool = mp.Pool(processes=pool_proc)
-
-    for main_count in range(start_n, fli_len, n_files_proc):
-        print("Processing batch starting with "
-              + str(main_count + 1).zfill(5) + " of "
-              + str(fli_len).zfill(5))
-        fidder.write("Processing batch starting with "
-                     + str(main_count + 1).zfill(5) + " of "
-                     + str(fli_len).zfill(5) + '\n')
-
-        p_list = []
-        # First we load several files at once
-        for j in range(0, n_files_proc):
-            if (main_count+j < fli_len):
-                p_list.append(pool.apply_async(OSF.get_flight,
-                                               args=(files[main_count+j],)))
-
-        for p in p_list:
-            t_res = p.get()
-            for fli in t_res:
-                f_data.append(fli)
-        if(len(f_data) < 1):
-            continue
-        traf_arr = Traffic.from_flights(f_data)
-        p_list = []
-        f_data = []
-        # Extend array end time if there's only one flight, else processing
-        # will fail as we check to ensure latest flight is > 5 mins from end
-        if (len(traf_arr) == 1):
-            end_time = traf_arr.end_time + timedelta(minutes=10)
-            print("Extending timespan due to single aircraft")
-        else:
-            end_time = traf_arr.end_time
-
-        # Now we process the results
-        for flight in traf_arr:
-            if (flight.stop + timedelta(minutes=5) < end_time):
-                p_list.append(pool.apply_async(OSF.proc_fl,
-                                               args=(flight,
-                                                     VABB.rwy_list,
-                                                     odirs,
-                                                     colormap,
-                                                     True,
-                                                     False,)))
-            else:
-                f_data.append(flight)
-
-        for p in p_list:
-            t_res = p.get()
-            if (t_res != -1):
-                tot_n_ac += 1
-                # If there's a go-around, this will be True
-                if (t_res[0]):
-                    if (do_write):
-                        metfid.write(t_res[1] + ',' + t_res[2] + ',')
-                        metfid.write(t_res[3].strftime(t_frmt) + ',')
-                        metfid.write(t_res[4].strftime(t_frmt) + ',')
-                        metfid.write(t_res[5] + ',')
-                        if (t_res[6] < 0):
-                            t_res[6] = 360 + t_res[6]
-                        metfid.write(str(t_res[6]) + ',')
-                        metfid.write(str(t_res[7]) + ',')
-                        metfid.write(str(t_res[8]) + ',')
-                        metfid.write(str(t_res[9]) + ',')
-                        metfid.write(str(t_res[10]) + ',')
-                        metfid.write(str(t_res[11]) + ',')
-                        metfid.write(str(t_res[12]) + ',')
-                        metfid.write(str(t_res[13]) + ',')
-                        metfid.write(str(t_res[14]) + ',')
-                        metfid.write(str(t_res[15]) + ',')
-                        metfid.write(str(t_res[16].temp) + ',')
-                        metfid.write(str(t_res[16].dewp) + ',')
-                        metfid.write(str(t_res[16].w_s) + ',')
-                        metfid.write(str(t_res[16].w_g) + ',')
-                        metfid.write(str(t_res[16].w_d) + ',')
-                        metfid.write(str(t_res[16].cld) + ',')
-                        if t_res[16].cb:
-                            metfid.write('1,')
-                        else:
-                            metfid.write('0,')
-                        metfid.write(str(t_res[16].vis) + ',')
-                        metfid.write(str(t_res[16].pres) + '\n')
-                    tot_n_ga += 1
-                # Otherwise, do the following (doesn't save g/a location etc).
-                else:
-                    if (do_write):
-                        nogfid.write(t_res[1] + ',' + t_res[2] + ',')
-                        nogfid.write(t_res[3].strftime(t_frmt) + ',')
-                        nogfid.write(t_res[4].strftime(t_frmt) + ',')
-                        nogfid.write(t_res[5] + ',')
-                        nogfid.write(str(t_res[10]) + ',')
-                        nogfid.write(str(t_res[11]) + ',')
-                        nogfid.write(str(t_res[12]) + ',')
-                        nogfid.write(str(t_res[13]) + ',')
-                        nogfid.write(str(t_res[14]) + ',')
-                        nogfid.write(str(t_res[15]) + ',')
-                        try:
-                            outstr = str(t_res[16].temp) + ','
-                            outstr = outstr + str(t_res[16].dewp) + ','
-                            outstr = outstr + str(t_res[16].w_s) + ','
-                            outstr = outstr + str(t_res[16].w_g) + ','
-                            outstr = outstr + str(t_res[16].w_d) + ','
-                            outstr = outstr + str(t_res[16].cld) + ','
-                            if t_res[16].cb:
-                                outstr = outstr + '1,'
-                            else:
-                                outstr = outstr + '0,'
-                            outstr = outstr + str(t_res[16].vis) + ','
-                            outstr = outstr + str(t_res[16].pres)
-                        except Exception as e:
-                            print("No METAR data for this flight")
-                            outstr = ''
-                        nogfid.write(outstr + '\n')
-
-        print("\t-\tHave processed " + str(tot_n_ac) +
-              " aircraft. Have seen " + str(tot_n_ga) + " go-arounds.")
-
-    if (do_write):
-        metfid.close()
-        nogfid.close()
-
-
-# Use this to start processing from a given file number.
-# Can be helpful if processing fails at some point.
+    # Number of workers in the pool, None for twice the number of CPUs.
+    # Not all of them are used at once, the number given work is tuned
+    # during the run from the measured throughput (see OS_Tune.py).
+    pool_proc = None
+
+    # Memory (bytes) that the batches being processed may use, None for
+    # half of the physical memory. The number of flights in each batch is
+    # chosen to fit.
+    mem_budget = None
+
+    # Which flights to plot: 'all', 'ga' (go-arounds only) or 'none'
+    plot_mode = 'all'
+
+    # Plot output DPI, use a lower value for quick previews
+    plot_dpi = 300
+
+    # Smoothing for the plotted lines: 'spline' (slowest), 'savgol' or
+    # 'window'
+    plot_smooth = 'savgol'
+
+    # Number of processes used to draw plots
+    render_proc = 16
+
+    # Number of simultaneous downloads, and whether to save the raw data
+    # into indir, when downloading
+    dl_proc = 6
+    dl_save = True
+
+    # Whether to time each processing stage, and where to write the
+    # summary. It is rewritten every time_every seconds and at the end.
+    time_stages = True
+    time_file = top_dir + 'timing.json'
+    time_every = 600
+
+    # Build the shared tables once here, before starting the workers
+    OSS.report_import_times(fidder=fidder)
+    OST.enable(time_stages)
+    apt_data = {}
+    for icao, apt in apts.items():
+        met_file = OSRG.get_metar_file(apt, met_dir)
+        OSF.get_metar_store(met_file)
+        for rwy in apt.rwy_list:
+            rwy.precompute_envelopes()
+        apt_data[icao] = (met_file, apt.rwy_list)
+    tuner = OSTU.batch_tuner(max_proc=pool_proc, mem_budget=mem_budget,
+                             fidder=fidder)
+    met_file, rwy_list = apt_data[next(iter(apts))]
+    pool = OSS.make_pool(tuner.max_proc, met_file, rwy_list,
+                         timing=time_stages, airports=apt_data)
+    t_written = time.perf_counter()
+
+    # Flights are read in time order and passed on once complete, those
+    # that never come near a runway approach are dropped here
+    apt_index = OSRG.airport_index(apts)
+    s_counts = {}
+    dler = None
+    if (hours is None):
+        stream = OSST.stream_flights(files, pool=pool, fidder=fidder,
+                                     corr=apt_index, counts=s_counts,
+                                     n_ahead=tuner.files_ahead(files),
+                                     n_done=n_done)
+    else:
+        # Each hour is passed to detection as soon as it is downloaded
+        source = OSD.opensky_source(OSRG.get_region_bounds(apts))
+        dler = OSD.downloader(source, region, indir, n_proc=dl_proc)
+        stream = OSST.stream_flights(hours, fidder=fidder, corr=apt_index,
+                                     counts=s_counts,
+                                     loader=dler.flights(hours,
+                                                         save=dl_save))
+
+    # Flight data is saved by this process into one file per day
+    store = OSO.flight_store()
+
+    # Plots are drawn by a separate pool
+    render = OSR.render_queue(render_proc, colormap,
+                              mode=plot_mode, odpi=plot_dpi,
+                              smooth=plot_smooth, timing=time_stages)
+
+    # Flights are batched separately for each airport whose corridors
+    # they enter. Each entry of p_list holds a running batch, its airport,
+    # the manifest keys of its flights, the number of input files complete
+    # once it is written and the estimated memory of the batch. A file is
+    # only complete once no airport has unsent flights with data in it.
+    fl_lists = {icao: [] for icao in apts}
+    fl_keys = {icao: [] for icao in apts}
+    fl_first = {icao: [] for icao in apts}
+    p_list = []
+    marks = []
+    n_marked = n_done
+    n_skip = 0
+    for flight in stream:
+        for icao in apt_index.match(flight):
+            fkey = OSM.flight_key(flight, icao if several else None)
+            if (man.flight_done(fkey)):
+                n_skip += 1
+                continue
+            fl_lists[icao].append(flight)
+            fl_keys[icao].append(fkey)
+            fl_first[icao].append(s_counts['first'])
+            if (tuner.add(flight, icao)):
+                fl_first[icao] = []
+                p_list.append((send_batch(pool, fl_lists[icao], odirs[icao],
+                                          colormap, plot_mode != 'none',
+                                          icao),
+                               icao, fl_keys[icao],
+                               closed_files(s_counts, fl_first),
+                               tuner.sent(icao)))
+                fl_lists[icao] = []
+                fl_keys[icao] = []
+        # Collect finished batches, and wait if the active workers have
+        # enough to do or the memory budget is used up
+        while (len(p_list) > 0 and
+               (p_list[0][0].ready() or tuner.full(len(p_list)))):
+            p, icao, keys, n_closed, n_bytes = p_list.pop(0)
+            n_ac, n_ga, seq = handle_results(p.get(), writers[icao], store,
+                                             render)
+            tuner.done(n_bytes, len(keys))
+            marks.append((writers[icao], seq, keys, n_closed))
+            tot_n_ac += n_ac
+            tot_n_ga += n_ga
+            if (n_ac > 0):
+                print("\t-\tHave processed " + str(tot_n_ac) +
+                      " aircraft. Have seen " + str(tot_n_ga) +
+                      " go-arounds.")
+        n_marked = mark_done(man, marks, files, n_marked, store)
+        if (time_stages and time.perf_counter() > t_written + time_every):
+            OST.write_summary(time_file)
+            t_written = time.perf_counter()
+
+    for icao in apts:
+        if (len(fl_lists[icao]) > 0):
+            fl_first[icao] = []
+            p_list.append((send_batch(pool, fl_lists[icao], odirs[icao],
+                                      colormap, plot_mode != 'none', icao),
+                           icao, fl_keys[icao],
+                           closed_files(s_counts, fl_first),
+                           tuner.sent(icao)))
+    for p, icao, keys, n_closed, n_bytes in p_list:
+        n_ac, n_ga, seq = handle_results(p.get(), writers[icao], store,
+                                         render)
+        tuner.done(n_bytes, len(keys))
+        marks.append((writers[icao], seq, keys, n_closed))
+        tot_n_ac += n_ac
+        tot_n_ga += n_ga
+    marks.append((None, 0, [], s_counts['closed']))
+
+    # Wait for the writers to finish before recording the last batches
+    for writer in writers.values():
+        if (writer is not None):
+            writer.close()
+    store.close()
+    mark_done(man, marks, files, n_marked, store, final=True)
+
+    tuner.log("Finished with")
+    n_skip = n_skip + s_counts['skipped']
+    if (n_skip > 0):
+        print("Skipped " + str(n_skip) + " flights processed by an "
+              "earlier run")
+    print("\t-\tHave processed " + str(tot_n_ac) +
+          " aircraft. Have seen " + str(tot_n_ga) + " go-arounds.")
+    outstr = ("Rejected " + str(s_counts['rejected']) + " of "
+              + str(s_counts['rejected'] + s_counts['emitted'])
+              + " flights outside the approach corridors")
+    print(outstr)
+    fidder.write(outstr + '\n')
+
+    if (dler is not None):
+        print("Downloads:", dler.counts)
+        dler.close()
+    pool.close()
+    pool.join()
+    render.close()
+    man.close()
+
+    if (time_stages):
+        OST.write_summary(time_file)
+        print("Stage timings written to", time_file)
+
+
+# Use this to start processing from a given file number. Completed files
+# are skipped automatically using the manifest, so this is rarely needed.
 init_num = 0
 
-fid = open('/home/proud/Desktop/log.log', 'w')
+# The airports to process, from OS_Airports. With several airports the
+# data for the whole region is read once, and each flight is checked
+# against the runways of every airport whose approaches it enters. Set
+# to None to process every airport in OS_Airports.
+apt_names = ['VABB']
+
+# Set dl_start and dl_end to download and process a time range directly,
+# rather than reading previously downloaded files
+dl_start = None
+dl_end = None
+
+# The guard is needed as workers started by the forkserver import this file
+if __name__ == '__main__':
+    fid = open('/home/proud/Desktop/log.log', 'w')
+
+    dl_hours = None
+    if (dl_start is not None):
+        dl_hours = []
+        cur_dt = dl_start
+        while (cur_dt < dl_end):
+            dl_hours.append(cur_dt)
+            cur_dt = cur_dt + timedelta(hours=1)
 
-main(init_num, fid, False)
+    main(init_num, fid, False, dl_hours, apt_names)
 
-fid.close()
+    fid.close()
@@ -1,3 +1,57 @@
+import numpy as np
+import hashlib
+import json
+import os
+
+
+# The distances (km to the runway threshold) on which the approach envelope
+# curves are evaluated, this matches the x-axis of OS_Output.do_plots_dist
+env_grid = np.arange(-10., 0.1 + 0.01, 0.01)
+
+# The polynomial sets for each envelope: lower, middle and upper curves
+env_names = {'lon': ['lons1', 'lonm', 'lonp1'],
+             'lat': ['lats1', 'latm', 'latp1'],
+             'hdg': ['hdgs1', 'hdgm', 'hdgp1'],
+             'gal': ['gals1', 'galm', 'galp1'],
+             'alt': ['alts1', 'altm', 'altp1'],
+             'roc': ['rocs1', 'rocm', 'rocp1']}
+
+# The envelopes in the order of the runway table's envelope axis
+env_order = list(env_names.keys())
+
+# The longest runway name allowed
+max_name_len = 8
+
+# A compiled runway table has one row per runway. 'coeffs' holds the
+# polynomials of each envelope (lower, middle, upper) and 'curves' the
+# same evaluated on env_grid. Missing envelopes are NaN.
+rwy_dtype = np.dtype([('name', 'U' + str(max_name_len)),
+                      ('mainhdg', np.float64),
+                      ('heading', np.float64, (4,)),
+                      ('rwy', np.float64, (2,)),
+                      ('rwy2', np.float64, (2,)),
+                      ('gate', np.float64, (2,)),
+                      ('coeffs', np.float64, (len(env_order), 3, 7)),
+                      ('curves', np.float64,
+                       (len(env_order), 3, len(env_grid)))])
+
+# Increase this when rwy_dtype or the compilation changes, so that cached
+# tables are rebuilt
+table_version = '1'
+
+
+def eval_poly(dists, multis):
+    ''' Evaluate a 6th order polynomial using Horner's method.
+    Dists: The x values, as a float or numpy array
+    Multis: The coefficients, highest power first: [f0, f1, ... f6]
+            Only the first seven values are used.
+    '''
+    yvals = np.zeros(np.shape(dists)) + multis[0]
+    for mult in multis[1:7]:
+        yvals = yvals * dists + mult
+    return yvals
+
+
 class rwy_data:
     ''' Defines a new runway for an airport. Takes the form:
     Name: Name of the runway, i.e: '01L'
@@ -13,6 +67,7 @@ class rwy_data:
     Then follows a series of numbers to define lines of best fit for approaches
     to a given runway. Each of these are a list containing 6 values for a
     polynomial fit: y = f0 * x^6 + f1 * x^5 ... f6
+    The fits are evaluated on env_grid and cached, see get_envelope().
     '''
     def __init__(self, name, mainhdg, heading, rwy, rwy2, gate,
                  lons1, lonm, lonp1,
@@ -46,4 +101,281 @@ class rwy_data:
         self.rocs1 = rocs1
         self.rocm = rocm
         self.rocp1 = rocp1
+        self.envelopes = {}
+
+    def get_envelope(self, env):
+        ''' Return the lower, middle and upper curves of an approach envelope
+        evaluated on env_grid, as three numpy arrays. Env is one of the
+        keys of env_names, i.e: 'alt'. The curves are computed on first use
+        and then cached.
+        '''
+        if (env not in self.envelopes):
+            self.envelopes[env] = [eval_poly(env_grid, getattr(self, name))
+                                   for name in env_names[env]]
+        return self.envelopes[env]
+
+    def envelope_at(self, env, dists):
+        ''' Return the lower, middle and upper curves of an approach envelope
+        at some distances (km), interpolated from the cached curves. Points
+        outside env_grid take the value at the nearest end of the grid.
+        '''
+        return [np.interp(dists, env_grid, curve)
+                for curve in self.get_envelope(env)]
+
+    def precompute_envelopes(self):
+        ''' Compute and cache every approach envelope. '''
+        for env in env_names:
+            self.get_envelope(env)
+
+    @classmethod
+    def from_table(cls, table, idx):
+        ''' Create a runway from row idx of a compiled runway table. The
+        positions, heading ranges and envelope curves are views into the
+        table, so nothing is evaluated again.
+        '''
+        rwy = cls.__new__(cls)
+        rwy.name = str(table['name'][idx])
+        rwy.mainhdg = float(table['mainhdg'][idx])
+        rwy.heading = table['heading'][idx]
+        rwy.rwy = table['rwy'][idx]
+        rwy.rwy2 = table['rwy2'][idx]
+        rwy.gate = table['gate'][idx]
+        rwy.envelopes = {}
+        for e_num, env in enumerate(env_order):
+            for c_num, name in enumerate(env_names[env]):
+                setattr(rwy, name, table['coeffs'][idx, e_num, c_num])
+            rwy.envelopes[env] = list(table['curves'][idx, e_num])
+        return rwy
+
+
+class runway_list(list):
+    ''' A list of runways that also holds their compiled runway table, so
+    runway matching can use the table's arrays directly. Row i of the
+    table is runway i of the list.
+    '''
+    def __init__(self, rwys, table):
+        super().__init__(rwys)
+        self.table = table
+
+
+class airport_data:
+    ''' An airport loaded from a declarative definition, see load_airport().
+    Airport_name, icao_name, iata_name: The airport's names
+    Metar_file: The airport's METAR file, or None if not given
+    Table: The compiled runway table
+    Rwy_list: A runway_list of the runways, in the order of the table
+    '''
+    def __init__(self, cfg, table):
+        self.airport_name = cfg['airport_name']
+        self.icao_name = cfg['icao_name']
+        self.iata_name = cfg.get('iata_name', '')
+        self.metar_file = cfg.get('metar_file', None)
+        self.table = table
+        self.rwy_list = runway_list([rwy_data.from_table(table, i)
+                                     for i in range(0, len(table))], table)
+
+
+def check_vals(vals, shape, what):
+    ''' Check that a config value is an array of finite numbers of a given
+    shape, and return it as a float array. Raises ValueError if not.
+    '''
+    try:
+        arr = np.asarray(vals, dtype=np.float64)
+    except (TypeError, ValueError):
+        raise ValueError(what + ' must be numbers')
+    if (arr.shape != shape):
+        raise ValueError(what + ' must have shape ' + str(shape) +
+                         ', not ' + str(arr.shape))
+    if (not np.all(np.isfinite(arr))):
+        raise ValueError(what + ' must be finite')
+    return arr
 
+
+def check_point(vals, what):
+    ''' Check that a config value is a [lat, lon] position. '''
+    arr = check_vals(vals, (2,), what)
+    if (abs(arr[0]) > 90 or abs(arr[1]) > 180):
+        raise ValueError(what + ' is not a valid [lat, lon]: ' + str(vals))
+    return arr
+
+
+def validate_config(cfg):
+    ''' Check an airport definition, raising ValueError if it is invalid.
+    The definition is a dict with 'airport_name', 'icao_name', a list of
+    'runways' and optionally 'iata_name' and 'metar_file'. Each runway has
+    'name', 'heading', 'rwy', 'rwy2' and 'gate', as for rwy_data, and
+    optionally 'mainhdg' and the envelopes: 'lon', 'lat', 'hdg', 'gal',
+    'alt' and 'roc', each a list of the lower, middle and upper curves'
+    seven polynomial coefficients.
+    '''
+    if (not isinstance(cfg, dict)):
+        raise ValueError('The definition must be an object')
+    apt_keys = ['airport_name', 'icao_name', 'iata_name', 'metar_file',
+                'runways']
+    for key in cfg:
+        if (key not in apt_keys):
+            raise ValueError('Unknown airport setting: ' + str(key))
+    for key in ['airport_name', 'icao_name']:
+        if (not isinstance(cfg.get(key), str) or len(cfg[key]) < 1):
+            raise ValueError(key + ' must be a non-empty string')
+    rwys = cfg.get('runways')
+    if (not isinstance(rwys, list) or len(rwys) < 1):
+        raise ValueError('runways must be a non-empty list')
+
+    rwy_keys = ['name', 'mainhdg', 'heading', 'rwy', 'rwy2', 'gate']
+    names = []
+    for rwy in rwys:
+        if (not isinstance(rwy, dict)):
+            raise ValueError('Each runway must be an object')
+        name = rwy.get('name')
+        if (not isinstance(name, str) or len(name) < 1 or
+                len(name) > max_name_len):
+            raise ValueError('Runway names must be strings of 1 to ' +
+                             str(max_name_len) + ' characters: ' + str(name))
+        if (name in names):
+            raise ValueError('Runway ' + name + ' is defined twice')
+        names.append(name)
+        for key in rwy:
+            if (key not in rwy_keys and key not in env_names):
+                raise ValueError('Runway ' + name + ': unknown setting '
+                                 + str(key))
+        for key in ['heading', 'rwy', 'rwy2', 'gate']:
+            if (key not in rwy):
+                raise ValueError('Runway ' + name + ': ' + key +
+                                 ' is missing')
+        hdg = check_vals(rwy['heading'], (4,), 'Runway ' + name + ' heading')
+        if (hdg[0] > hdg[1] or hdg[2] > hdg[3]):
+            raise ValueError('Runway ' + name + ': heading must be two '
+                             '[min, max] ranges')
+        for key in ['rwy', 'rwy2', 'gate']:
+            check_point(rwy[key], 'Runway ' + name + ' ' + key)
+        if ('mainhdg' in rwy):
+            check_vals(rwy['mainhdg'], (), 'Runway ' + name + ' mainhdg')
+        for env in env_order:
+            if (env in rwy):
+                check_vals(rwy[env], (3, 7), 'Runway ' + name + ' ' + env)
+
+
+def compile_table(cfg):
+    ''' Compile the runways of a validated airport definition into a
+    runway table (of rwy_dtype). If mainhdg is not given it is the bearing
+    from the runway threshold to the far threshold.
+    '''
+    rwys = cfg['runways']
+    table = np.zeros(len(rwys), dtype=rwy_dtype)
+    for i, rwy in enumerate(rwys):
+        table['name'][i] = rwy['name']
+        table['heading'][i] = rwy['heading']
+        table['rwy'][i] = rwy['rwy']
+        table['rwy2'][i] = rwy['rwy2']
+        table['gate'][i] = rwy['gate']
+        if ('mainhdg' in rwy):
+            table['mainhdg'][i] = rwy['mainhdg']
+        else:
+            d_lat = rwy['rwy2'][0] - rwy['rwy'][0]
+            d_lon = ((rwy['rwy2'][1] - rwy['rwy'][1]) *
+                     np.cos(np.radians(rwy['rwy'][0])))
+            table['mainhdg'][i] = np.degrees(np.arctan2(d_lon, d_lat))
+        for e_num, env in enumerate(env_order):
+            table['coeffs'][i, e_num] = rwy.get(env, np.nan)
+
+    # Evaluate every envelope at once, in the same order as eval_poly()
+    coeffs = table['coeffs']
+    curves = np.zeros(np.shape(table['curves'])) + coeffs[..., 0:1]
+    for k in range(1, 7):
+        curves = curves * env_grid + coeffs[..., k:k+1]
+    table['curves'] = curves
+    return table
+
+
+def table_of(rwy_list):
+    ''' Return the runway table of a list of runways. A runway_list
+    already holds one, otherwise it is compiled from the runways. This is
+    slow, so convert plain lists once with as_runway_list().
+    '''
+    table = getattr(rwy_list, 'table', None)
+    if (table is not None):
+        return table
+    cfg = {'runways': []}
+    for rwy in rwy_list:
+        ent = {'name': rwy.name, 'mainhdg': rwy.mainhdg,
+               'heading': rwy.heading, 'rwy': rwy.rwy, 'rwy2': rwy.rwy2,
+               'gate': rwy.gate}
+        for env in env_order:
+            ent[env] = [getattr(rwy, name)[0:7] for name in env_names[env]]
+        cfg['runways'].append(ent)
+    return compile_table(cfg)
+
+
+def as_runway_list(rwy_list):
+    ''' Return a list of runways as a runway_list, compiling its table
+    if it doesn't already have one. None is returned unchanged.
+    '''
+    if (rwy_list is None or hasattr(rwy_list, 'table')):
+        return rwy_list
+    return runway_list(rwy_list, table_of(rwy_list))
+
+
+def load_table(inf, cfg, cache_dir=None):
+    ''' Return the compiled runway table of an airport definition file.
+    The table is cached in cache_dir (by default the filename with
+    '.cache' appended) and memory-mapped on later calls. It is compiled
+    again if the file's contents or table_version change.
+    Inf: The definition file
+    Cfg: Its contents, already validated
+    '''
+    if (cache_dir is None):
+        cache_dir = inf + '.cache'
+    sha = hashlib.sha1()
+    with open(inf, 'rb') as fid:
+        sha.update(fid.read())
+    key = table_version + ':' + sha.hexdigest()
+    keyf = os.path.join(cache_dir, 'key.txt')
+    tabf = os.path.join(cache_dir, 'table.npy')
+    try:
+        with open(keyf, 'r') as fid:
+            if (fid.read().strip() == key):
+                return np.load(tabf, mmap_mode='r')
+    except (OSError, ValueError, EOFError):
+        pass
+
+    table = compile_table(cfg)
+    # The key is written last, so a partial cache is never used
+    try:
+        if (not os.path.exists(cache_dir)):
+            os.makedirs(cache_dir, exist_ok=True)
+        if (os.path.exists(keyf)):
+            os.remove(keyf)
+        tmpf = tabf + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpf, 'wb') as fid:
+            np.save(fid, table)
+        os.replace(tmpf, tabf)
+        tmpf = keyf + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpf, 'w') as fid:
+            fid.write(key + '\n')
+        os.replace(tmpf, keyf)
+    except OSError as e:
+        print("WARNING: Unable to write runway cache:", cache_dir, e)
+    return table
+
+
+def config_path(icao):
+    ''' Return the path of the definition file for an airport in this
+    directory, such as 'VABB.json'.
+    '''
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        icao + '.json')
+
+
+def load_airport(inf, cache_dir=None):
+    ''' Load, validate and compile an airport definition file (JSON).
+    Raises ValueError, naming the file, if the definition is invalid.
+    Returns an airport_data.
+    '''
+    try:
+        with open(inf, 'r') as fid:
+            cfg = json.load(fid)
+        validate_config(cfg)
+    except ValueError as e:
+        raise ValueError(inf + ': ' + str(e))
+    return airport_data(cfg, load_table(inf, cfg, cache_dir))
@@ -0,0 +1,298 @@
+"""Columnar 'flight batch' versions of the go-around detection steps.
+
+Rather than running each step once per flight, the flights in a batch are
+concatenated into single numpy arrays with an offset array marking where
+each flight begins. Takeoff rejection, state-change detection, runway
+matching and the go-around test are then done as array passes over the
+whole batch, which removes most of the per-flight overhead.
+"""
+from datetime import timedelta
+import OS_Airports.RWY as RWY
+import OS_Results as OSRE
+import OS_Timing as OST
+import OS_Consts as CNS
+import OS_Phase as OSPH
+import OS_Funcs as OSF
+import pandas as pd
+import numpy as np
+
+
+# The per-point arrays that are concatenated into a batch
+batch_cols = ['time', 'lats', 'lons', 'alts', 'spds',
+              'gals', 'hdgs', 'rocs', 'ongd']
+
+
+def make_batch(fds):
+    """Concatenate a list of flight dicts into one columnar batch.
+
+    Input:
+        -   A list of dicts of flight data, such as that returned by
+            preproc_data(). Each must contain at least one datapoint.
+    Returns:
+        A dict containing:
+        -   One concatenated array for each of batch_cols
+        -   offs: An int array of length n_flights + 1, flight i occupies
+            positions offs[i] to offs[i+1] in the arrays
+        -   seg: An int array giving the flight number of each datapoint
+        -   fds: The input list. The array entries of each flight dict are
+            replaced by views into the batch arrays.
+    """
+    bd = {}
+    lens = np.array([len(fd['time']) for fd in fds], dtype=np.int64)
+    offs = np.zeros(len(fds) + 1, dtype=np.int64)
+    offs[1:] = np.cumsum(lens)
+    for col in batch_cols:
+        if (len(fds) > 0):
+            bd[col] = np.concatenate([fd[col] for fd in fds])
+        else:
+            bd[col] = np.zeros(0)
+    bd['offs'] = offs
+    bd['seg'] = np.repeat(np.arange(len(fds)), lens)
+    bd['fds'] = fds
+
+    for i, fd in enumerate(fds):
+        for col in batch_cols:
+            fd[col] = bd[col][offs[i]:offs[i+1]]
+
+    return bd
+
+
+def select_batch(bd, keep):
+    """Select some of the flights of a batch, without rebuilding it.
+
+    The batch arrays are cut down with one boolean mask over the points,
+    and the flight dicts are left as they are, still holding views into
+    the original batch.
+    Inputs:
+        -   bd: A batch dict, such as that returned by make_batch(). Its
+            'labl' array is also selected, if it has one.
+        -   keep: A sorted int array of the flights to keep
+    Returns:
+        -   A batch dict of the kept flights, as for make_batch()
+    """
+    lens = np.diff(bd['offs'])
+    fl_mask = np.zeros(len(lens), dtype=np.bool_)
+    fl_mask[keep] = True
+    mask = fl_mask[bd['seg']]
+    new = {}
+    for col in batch_cols + ['labl']:
+        if (col in bd):
+            new[col] = bd[col][mask]
+    lens = lens[keep]
+    new['offs'] = np.zeros(len(keep) + 1, dtype=np.int64)
+    new['offs'][1:] = np.cumsum(lens)
+    new['seg'] = np.repeat(np.arange(len(keep)), lens)
+    new['fds'] = [bd['fds'][i] for i in keep]
+
+    return new
+
+
+def batch_takeoff(bd):
+    """Check which flights in a batch are taking off, as check_takeoff().
+
+    Input:
+        -   A batch dict, such as that returned by make_batch()
+    Returns:
+        -   A bool array, True for flights that are takeoffs
+    """
+    offs = bd['offs']
+    lens = np.diff(offs)
+    n_pts = len(bd['time'])
+    takeoff = lens < 10
+    if (n_pts < 1):
+        return takeoff
+
+    # The first five points of each flight
+    idx = offs[:-1, None] + np.arange(0, 5)[None, :]
+    idx = np.minimum(idx, n_pts - 1)
+    alt_sub = bd['gals'][idx]
+    alt_sub2 = bd['alts'][idx]
+    roc_sub = bd['rocs'][idx]
+    ongd_sub = bd['ongd'][idx].astype(bool)
+
+    takeoff = takeoff | (np.all(ongd_sub, axis=1) &
+                         np.any(alt_sub2 < 3000, axis=1))
+    takeoff = takeoff | np.all(alt_sub < CNS.takeoff_thresh_alt, axis=1)
+    with np.errstate(invalid='ignore'):
+        early = np.nanmean(alt_sub2[:, 0:2], axis=1)
+        late = np.nanmean(alt_sub2[:, 2:5], axis=1)
+        takeoff = takeoff | ((np.nanmean(alt_sub, axis=1) < 3000) &
+                             (early < late))
+    takeoff = takeoff | np.any(roc_sub > 1500, axis=1)
+
+    return takeoff
+
+
+def batch_check_ga(bd, labels, verbose):
+    """Check for go-arounds in every flight of a batch, as check_ga().
+
+    Inputs:
+        -   A batch dict, such as that returned by make_batch()
+        -   The concatenated flight phase labels
+        -   A boolean for verbose mode. If True, a g/a warning is printed
+    Returns:
+        -   A bool array, True for flights where a go-around is likely
+        -   An int array giving the position within each flight of the
+            last go-around, or -1
+        -   A list giving an int array of the positions within each flight
+            of every go-around
+    """
+    offs = bd['offs']
+    n_fl = len(offs) - 1
+    bpt = np.full(n_fl, -1, dtype=np.int64)
+
+    gapts = OSF.find_gas(bd['time'], bd['alts'], bd['rocs'], labels, offs)
+    seg = bd['seg'][gapts]
+    ga_flag = np.bincount(seg, minlength=n_fl) > 0
+    # The positions are in order, so the last one written for each
+    # flight is its last go-around
+    bpt[seg] = gapts - offs[seg]
+    fl_gapts = np.split(gapts - offs[seg], np.searchsorted(seg,
+                                                           np.arange(1, n_fl)))
+
+    if verbose:
+        for pt, fl in zip(gapts, seg):
+            fd = bd['fds'][fl]
+            l_pt = pt - offs[fl]
+            ga_time = fd['strt'] + timedelta(seconds=int(fd['time'][l_pt]))
+            print("\t-\tG/A warning:",
+                  fd['call'],
+                  fd['ic24'],
+                  ga_time.strftime("%Y-%m-%d %H:%M"))
+
+    return ga_flag, bpt, fl_gapts
+
+
+def proc_batch(flights, check_rwys, odirs, colormap, do_save, verbose,
+               return_data=False, airport=None):
+    """Filter, assign phases and determine go-around status for many flights.
+
+    This gives the same results as calling proc_fl() for each flight, but
+    runs the detection steps over the whole batch at once.
+    Inputs:
+        -   A list of 'traffic' flight objects
+        -   The remaining arguments are as for proc_fl()
+        -   (optional) If True, the flight data and plots are returned
+            rather than saved, so that one process can write the data to
+            a flight_store and plots can be drawn by a render_queue
+        -   (optional) The ICAO code of the airport, when several are
+            processed at once. Its runways and METARs, as given to
+            OS_Funcs.init_worker(), are used in place of check_rwys.
+    Returns:
+        -   A structured array (of OS_Results.res_dtype) with a result
+            record for each flight that was not skipped
+        -   If return_data is True, also a list of packed flight data as
+            (directory, meta, points), a list of plot payloads and the
+            stage timings of this worker (see OS_Timing.take())
+    """
+    np_out = None
+    plot_out = None
+    if (return_data):
+        np_out = []
+        plot_out = []
+    met_file = None
+    if (airport is not None):
+        met_file, check_rwys = OSF.shared_airports[airport]
+    if (check_rwys is None):
+        check_rwys = OSF.shared_rwys
+    check_rwys = RWY.as_runway_list(check_rwys)
+    results = [-1] * len(flights)
+    OST.count('flights', len(flights))
+
+    # Preprocessing is still done per flight
+    fds = []
+    fl_ids = []
+    for i, flight in enumerate(flights):
+        with OST.stage('prep'):
+            fd = OSF.prep_fl(flight, verbose)
+        if (fd is None):
+            continue
+        fds.append(fd)
+        fl_ids.append(i)
+    if (len(fds) < 1):
+        return batch_return(results, np_out, plot_out)
+
+    # We don't care about take-offs, so find and exclude. The batch is
+    # built once here, and later steps only select from it.
+    with OST.stage('takeoff'):
+        bd = make_batch(fds)
+        keep = np.flatnonzero(~batch_takeoff(bd))
+    OST.count('takeoffs', len(fds) - len(keep))
+    fl_ids = [fl_ids[i] for i in keep]
+    if (len(keep) < 1):
+        return batch_return(results, np_out, plot_out)
+    bd = select_batch(bd, keep)
+
+    # Use Junzi's labelling method to get flight phases for the whole
+    # batch, and exclude flights that can't be labelled or never change
+    # state
+    with OST.stage('labels'):
+        bd['labl'], bad = OSPH.fuzzy_labels(bd['time'], bd['alts'],
+                                            bd['spds'], bd['rocs'],
+                                            bd['offs'], ongd=bd['ongd'])
+        _, n_cng = OSF.label_changes(bd['labl'], bd['offs'])
+    keep = np.flatnonzero((n_cng > 0) & ~bad)
+    for i in np.flatnonzero(bad):
+        print("\t-\tUnable to label flight:", bd['fds'][i]['call'])
+    if verbose:
+        for i in np.flatnonzero((n_cng == 0) & ~bad):
+            print("\t-\tNo state change:", bd['fds'][i]['call'])
+    fl_ids = [fl_ids[i] for i in keep]
+    if (len(keep) < 1):
+        return batch_return(results, np_out, plot_out)
+    bd = select_batch(bd, keep)
+    fds = bd['fds']
+    for i, fd in enumerate(fds):
+        fd['labl'] = bd['labl'][bd['offs'][i]:bd['offs'][i+1]]
+
+    # Estimate which runway each flight is landing on, and at what
+    # point in the data arrays it does so. The runway is found using
+    # points interpolated to one second near each runway gate.
+    with OST.stage('runway'):
+        bd2 = make_batch([OSF.interp_near(fd, check_rwys) for fd in fds])
+        rwys, _ = OSF.estimate_rwy_batch(bd2, check_rwys, verbose)
+        _, possers = OSF.estimate_rwy_batch(bd, check_rwys, verbose)
+        for i, fd in enumerate(fds):
+            fd['min_alt_pt'] = OSF.set_rdis(fd, rwys[i], verbose)
+
+    # Find the METAR for each flight in one lookup, and correct the
+    # barometric altitudes
+    with OST.stage('metar'):
+        l_times = [pd.Timestamp(fd['strt'] + (fd['dura'] / 2), tz='UTC')
+                   for fd in fds]
+        bmets, tdiffs = OSF.get_metar_store(met_file).find_closest_batch(
+            l_times, max_diff=3600)
+        for i, fd in enumerate(fds):
+            OSF.correct_alts(fd, bmets[i], tdiffs[i], l_times[i])
+
+    # The altitudes have been corrected, so update them in the batch and
+    # do the actual go-around check
+    with OST.stage('check_ga'):
+        bd['alts'] = np.concatenate([fd['alts'] for fd in fds])
+        ga_flags, gapts, fl_gapts = batch_check_ga(bd, bd['labl'], True)
+
+    for i, fd in enumerate(fds):
+        if (ga_flags[i]):
+            gapt = int(gapts[i])
+        else:
+            gapt = None
+        results[fl_ids[i]] = OSF.finish_fl(fd, rwys[i], int(possers[i]),
+                                           fd['min_alt_pt'],
+                                           bool(ga_flags[i]), gapt,
+                                           bmets[i], l_times[i],
+                                           odirs, colormap,
+                                           do_save, verbose,
+                                           np_out=np_out,
+                                           plot_out=plot_out,
+                                           gapts=fl_gapts[i])
+
+    return batch_return(results, np_out, plot_out)
+
+
+def batch_return(results, np_out, plot_out):
+    """Return the results of proc_batch(), with the flight data if kept."""
+    results = OSRE.to_array([res for res in results
+                             if not isinstance(res, int)])
+    if (np_out is None):
+        return results
+    return results, np_out, plot_out, OST.take()
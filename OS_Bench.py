@@ -0,0 +1,473 @@
+"""Synthetic ADS-B data and a per-stage benchmark of go-around detection.
+
+Flights are generated for the runways of an airport definition in
+OS_Airports, using a seeded random generator so the same settings always
+give the same data. Five kinds of flight are made, identified by the
+first three letters of the callsign:
+    APP - a normal approach and landing
+    GAR - an approach that goes around
+    DEP - a takeoff
+    OVF - an overflight, above the approach altitudes
+    VEH - a ground vehicle
+The flights are written as one pickle per hour, with the same names and
+layout as those from OpenSky_Get_Data, and then each stage of detection
+is timed separately.
+
+Usage:
+    python OS_Bench.py [--airport VABB] [--sizes 1000 10000 100000]
+"""
+from datetime import datetime, timedelta
+import OS_Registry as OSRG
+import OS_Download as OSD
+import OS_Output as OSO
+import OS_Funcs as OSF
+import numpy as np
+import argparse
+import tempfile
+import time
+import os
+
+
+# The kinds of flight, and the fraction of each that is generated
+fl_kinds = {'APP': 0.5, 'GAR': 0.05, 'DEP': 0.25, 'OVF': 0.1, 'VEH': 0.1}
+
+# The stages that are timed, in order
+bench_stages = ['get_flight', 'preproc_data', 'do_labels', 'estimate_rwy',
+                'check_ga', 'plotting', 'to_numpy']
+
+# km per degree of latitude
+km_deg = 111.2
+
+# Knots to km/s and ft/min to ft/s
+kt_kms = 1.852 / 3600.
+fpm_fps = 1. / 60.
+
+
+def rwy_axes(rwy):
+    """Get the threshold and approach direction of a runway.
+
+    Input:
+        -   rwy: A runway, defined in OS_Airports
+    Returns:
+        -   The threshold, as [lat, lon]
+        -   The unit vector (north, east) in km pointing out from the
+            threshold along the approach, towards the gate
+        -   The length (km) of the runway
+    """
+    thr = np.array(rwy.rwy, dtype=np.float64)
+    cos_lat = np.cos(np.radians(thr[0]))
+    u_vec = np.array([(rwy.gate[0] - thr[0]) * km_deg,
+                      (rwy.gate[1] - thr[1]) * km_deg * cos_lat])
+    u_vec = u_vec / np.sqrt(np.sum(u_vec * u_vec))
+    end = np.array([(rwy.rwy2[0] - thr[0]) * km_deg,
+                    (rwy.rwy2[1] - thr[1]) * km_deg * cos_lat])
+    return thr, u_vec, np.sqrt(np.sum(end * end))
+
+
+def to_latlon(thr, pos):
+    """Convert (north, east) offsets in km from a threshold to lat / lon."""
+    cos_lat = np.cos(np.radians(thr[0]))
+    return (thr[0] + pos[:, 0] / km_deg,
+            thr[1] + pos[:, 1] / (km_deg * cos_lat))
+
+
+def sample_times(rng, dura):
+    """Get irregular report times, a few seconds apart, over a duration."""
+    steps = rng.integers(1, 9, size=int(dura) + 1)
+    times = np.cumsum(steps) - steps[0]
+    return times[times <= dura].astype(np.float64)
+
+
+def track_of(u_vec):
+    """Get the track angle (deg) of a (north, east) direction."""
+    return np.degrees(np.arctan2(u_vec[1], u_vec[0])) % 360.
+
+
+def make_approach(rng, rwy, go_around=False):
+    """Create a straight-in approach to a runway.
+
+    A normal approach lands and rolls out along the runway, a go-around
+    starts to climb again between 200 and 600 ft above the runway.
+    Returns:
+        -   A dict of the per-point values, as for make_flight()
+    """
+    thr, u_vec, rwy_len = rwy_axes(rwy)
+    d0 = rng.uniform(20., 30.)
+    spd = rng.uniform(135., 165.)
+    # Three degree glide path, crossing the threshold at 50 ft
+    slope = np.tan(np.radians(3.)) * 3280.84
+    t_land = d0 / (spd * kt_kms)
+
+    if (go_around):
+        ga_alt = rng.uniform(200., 600.)
+        t_ga = (d0 - (ga_alt - 50.) / slope) / (spd * kt_kms)
+        dura = t_ga + rng.uniform(240., 360.)
+    else:
+        t_ga = np.inf
+        dura = t_land + 60.
+    times = sample_times(rng, dura)
+
+    dist = d0 - spd * kt_kms * times
+    alts = np.maximum(dist * slope + 50., 0.)
+    rocs = np.full(len(times), -spd * 101.27 * np.tan(np.radians(3.)))
+    spds = np.full(len(times), spd)
+    ongd = np.zeros(len(times), dtype=bool)
+
+    if (go_around):
+        climb = times > t_ga
+        t_c = times[climb] - t_ga
+        rocs[climb] = np.minimum(500. + t_c * 100., 2000.)
+        alts[climb] = ga_alt + np.cumsum(rocs[climb] *
+                                         np.diff(np.append(t_ga, times[climb]))
+                                         * fpm_fps)
+        spds[climb] = np.minimum(spd + t_c * 0.5, 220.)
+        dist[climb] = (d0 - spd * kt_kms * t_ga -
+                       np.cumsum(spds[climb] * kt_kms *
+                                 np.diff(np.append(t_ga, times[climb]))))
+    else:
+        roll = times > t_land
+        t_r = times[roll] - t_land
+        spds[roll] = np.maximum(spd - t_r * 2.5, 20.)
+        dist[roll] = -np.minimum(np.cumsum(spds[roll] * kt_kms *
+                                           np.diff(np.append(t_land,
+                                                             times[roll]))),
+                                 rwy_len * 0.9)
+        alts[roll] = 0.
+        rocs[roll] = 0.
+        ongd[roll] = True
+
+    pos = dist[:, None] * u_vec[None, :]
+    lats, lons = to_latlon(thr, pos)
+    return {'time': times, 'lats': lats, 'lons': lons, 'alts': alts,
+            'spds': spds, 'rocs': rocs, 'ongd': ongd,
+            'hdgs': np.full(len(times), track_of(-u_vec))}
+
+
+def make_departure(rng, rwy):
+    """Create a takeoff roll and climb out from a runway threshold."""
+    thr, u_vec, rwy_len = rwy_axes(rwy)
+    t_roll = rng.uniform(30., 45.)
+    v_rot = rng.uniform(140., 160.)
+    times = sample_times(rng, t_roll + rng.uniform(300., 420.))
+    air = times > t_roll
+
+    spds = np.where(air, np.minimum(v_rot + (times - t_roll) * 0.5, 250.),
+                    v_rot * times / t_roll)
+    rocs = np.where(air, rng.uniform(1500., 2500.), 0.)
+    d_t = np.diff(np.append(0., times))
+    dist = np.cumsum(spds * kt_kms * d_t)
+    alts = np.cumsum(rocs * fpm_fps * d_t)
+    pos = dist[:, None] * -u_vec[None, :]
+    lats, lons = to_latlon(thr, pos)
+    return {'time': times, 'lats': lats, 'lons': lons, 'alts': alts,
+            'spds': spds, 'rocs': rocs, 'ongd': ~air,
+            'hdgs': np.full(len(times), track_of(-u_vec))}
+
+
+def make_overflight(rng, centre):
+    """Create a level flight across the airport, above the approaches."""
+    ang = rng.uniform(0., 2. * np.pi)
+    u_vec = np.array([np.cos(ang), np.sin(ang)])
+    spd = rng.uniform(220., 280.)
+    times = sample_times(rng, rng.uniform(400., 600.))
+    dist = spd * kt_kms * times - 30.
+    offset = rng.uniform(-5., 5.) * np.array([-u_vec[1], u_vec[0]])
+    pos = dist[:, None] * u_vec[None, :] + offset[None, :]
+    lats, lons = to_latlon(centre, pos)
+    n_pts = len(times)
+    return {'time': times, 'lats': lats, 'lons': lons,
+            'alts': np.full(n_pts, rng.uniform(7000., 9500.)),
+            'spds': np.full(n_pts, spd), 'rocs': np.zeros(n_pts),
+            'ongd': np.zeros(n_pts, dtype=bool),
+            'hdgs': np.full(n_pts, track_of(u_vec))}
+
+
+def make_vehicle(rng, rwy):
+    """Create a ground vehicle moving slowly around a runway threshold."""
+    thr, u_vec, rwy_len = rwy_axes(rwy)
+    times = sample_times(rng, rng.uniform(300., 600.))
+    d_t = np.diff(np.append(0., times))
+    ang = np.cumsum(rng.normal(0., 0.1, len(times)))
+    spds = rng.uniform(5., 25.) + rng.normal(0., 1., len(times))
+    step = (spds * kt_kms * d_t)[:, None]
+    pos = np.cumsum(step * np.vstack([np.cos(ang), np.sin(ang)]).T, axis=0)
+    lats, lons = to_latlon(thr, pos)
+    n_pts = len(times)
+    return {'time': times, 'lats': lats, 'lons': lons,
+            'alts': np.zeros(n_pts), 'spds': spds, 'rocs': np.zeros(n_pts),
+            'ongd': np.ones(n_pts, dtype=bool),
+            'hdgs': np.degrees(ang) % 360.}
+
+
+def make_flight(rng, kind, rwy_list, centre):
+    """Create the per-point values for one synthetic flight.
+
+    Inputs:
+        -   rng: A numpy random Generator
+        -   kind: The kind of flight, one of fl_kinds
+        -   rwy_list: The airport's runways
+        -   centre: The airport centre, as [lat, lon]
+    Returns:
+        -   A dict of arrays: time (s from the first point), lats, lons,
+            alts (ft), spds (kts), rocs (fpm), ongd and hdgs (deg)
+    """
+    rwy = rwy_list[rng.integers(len(rwy_list))]
+    if (kind == 'APP'):
+        pts = make_approach(rng, rwy)
+    elif (kind == 'GAR'):
+        pts = make_approach(rng, rwy, go_around=True)
+    elif (kind == 'DEP'):
+        pts = make_departure(rng, rwy)
+    elif (kind == 'OVF'):
+        pts = make_overflight(rng, centre)
+    else:
+        pts = make_vehicle(rng, rwy)
+
+    # Add some noise, altitudes are reported in 25 ft steps
+    n_pts = len(pts['time'])
+    pts['lats'] = pts['lats'] + rng.normal(0., 2e-5, n_pts)
+    pts['lons'] = pts['lons'] + rng.normal(0., 2e-5, n_pts)
+    pts['gals'] = pts['alts'] + rng.normal(0., 30., n_pts)
+    pts['alts'] = np.round((pts['alts'] + rng.normal(0., 15., n_pts))
+                           / 25.) * 25.
+    pts['spds'] = np.maximum(pts['spds'] + rng.normal(0., 2., n_pts), 0.)
+    pts['rocs'] = np.round((pts['rocs'] + rng.normal(0., 60., n_pts))
+                           / 64.) * 64.
+    pts['hdgs'] = (pts['hdgs'] + rng.normal(0., 1., n_pts)) % 360.
+    return pts
+
+
+def make_hour(rng, hour, n_flights, rwy_list, fl_num=0):
+    """Create an hour of synthetic data as an OpenSky-style DataFrame.
+
+    Inputs:
+        -   rng: A numpy random Generator
+        -   hour: The start of the hour, as a datetime
+        -   n_flights: The number of flights
+        -   rwy_list: The airport's runways
+        -   fl_num: (optional) The number of the first flight, used to
+            make unique icao24 codes and callsigns
+    Returns:
+        -   A DataFrame with the columns of opensky.history()
+    """
+    import pandas as pd
+
+    centre = np.mean([rwy.rwy for rwy in rwy_list], axis=0)
+    kinds = list(fl_kinds.keys())
+    probs = np.array(list(fl_kinds.values()))
+    probs = probs / np.sum(probs)
+    t_hour = pd.Timestamp(hour, tz='UTC')
+
+    frames = []
+    for i in range(0, n_flights):
+        kind = kinds[rng.choice(len(kinds), p=probs)]
+        pts = make_flight(rng, kind, rwy_list, centre)
+        start = rng.uniform(0., max(3600. - pts['time'][-1] - 1., 0.))
+        stamps = t_hour + pd.to_timedelta(start + pts['time'], unit='s')
+        ic24 = '%06x' % (0x900000 + fl_num + i)
+        call = kind + str(fl_num + i).zfill(5)
+        frames.append(pd.DataFrame({'timestamp': stamps,
+                                    'icao24': ic24,
+                                    'callsign': call,
+                                    'latitude': pts['lats'],
+                                    'longitude': pts['lons'],
+                                    'altitude': pts['alts'],
+                                    'geoaltitude': pts['gals'],
+                                    'groundspeed': pts['spds'],
+                                    'track': pts['hdgs'],
+                                    'vertical_rate': pts['rocs'],
+                                    'onground': pts['ongd'],
+                                    'last_position': stamps}))
+    df = pd.concat(frames, ignore_index=True)
+    return df.sort_values(by=['timestamp'], kind='stable')
+
+
+def make_files(outdir, airport, n_flights, n_per_file=50, seed=0,
+               start=datetime(2019, 8, 10)):
+    """Write synthetic data as hourly pickles, as OpenSky_Get_Data does.
+
+    Existing files are reused, so a larger run can share the data of a
+    smaller one.
+    Inputs:
+        -   outdir: The output directory
+        -   airport: The airport module, from OS_Airports
+        -   n_flights: The total number of flights
+        -   n_per_file: (optional) The number of flights in each hour
+        -   seed: (optional) The random seed
+        -   start: (optional) The first hour
+    Returns:
+        -   The list of files, in time order
+    """
+    files = []
+    for f_num in range(0, int(np.ceil(n_flights / n_per_file))):
+        hour = start + timedelta(hours=f_num)
+        outf = os.path.join(outdir, 'OS_' + hour.strftime("%Y%m%d%H%M")
+                            + '_' + airport.icao_name + '.pkl')
+        files.append(outf)
+        if (os.path.exists(outf)):
+            continue
+        # Seed each hour separately, so each file is the same whatever
+        # the total size
+        rng = np.random.default_rng([seed, f_num])
+        n_fl = min(n_per_file, n_flights - f_num * n_per_file)
+        df = make_hour(rng, hour, n_fl, airport.rwy_list,
+                       fl_num=f_num * n_per_file)
+        OSD.write_data(df, outf)
+    return files
+
+
+def run_bench(files, rwy_list, outdir, n_out=100, smooth='spline'):
+    """Time each stage of go-around detection over a set of files.
+
+    Plotting and to_numpy() are only timed for the first n_out flights,
+    as they write a file per flight.
+    Inputs:
+        -   files: The input files
+        -   rwy_list: The airport's runways
+        -   outdir: A directory for the plots and numpy files
+        -   n_out: (optional) The number of flights to plot and save
+        -   smooth: (optional) The plot smoothing method
+    Returns:
+        -   A dict of the total time (s) spent in each of bench_stages
+        -   A dict of the number of calls of each stage
+        -   A dict of the number of flights of each kind, and the number
+            of those flagged as go-arounds
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+
+    cmap = {'GND': 'black', 'CL': 'green', 'CR': 'blue',
+            'DE': 'orange', 'LVL': 'purple', 'NA': 'red'}
+    pl_dir = os.path.join(outdir, 'PLOT') + '/'
+    np_dir = os.path.join(outdir, 'DATA') + '/'
+    for odir in [pl_dir, np_dir]:
+        if (not os.path.exists(odir)):
+            os.makedirs(odir)
+
+    tot = {stage: 0. for stage in bench_stages}
+    n_calls = {stage: 0 for stage in bench_stages}
+    kinds = {}
+    n_done = 0
+
+    def add(stage, t_start):
+        tot[stage] += time.perf_counter() - t_start
+        n_calls[stage] += 1
+
+    for inf in files:
+        t_start = time.perf_counter()
+        flist = OSF.get_flight(inf)
+        add('get_flight', t_start)
+
+        for flight in flist:
+            kind = str(flight.callsign)[0:3]
+            kinds.setdefault(kind, [0, 0])
+            kinds[kind][0] += 1
+
+            t_start = time.perf_counter()
+            fd = OSF.preproc_data(flight, False)
+            add('preproc_data', t_start)
+            if (fd is None):
+                continue
+
+            t_start = time.perf_counter()
+            try:
+                fd['labl'] = OSF.do_labels(fd)
+            except ValueError:
+                continue
+            add('do_labels', t_start)
+
+            t_start = time.perf_counter()
+            rwy, _ = OSF.estimate_rwy(OSF.interp_near(fd, rwy_list),
+                                      rwy_list, False)
+            OSF.estimate_rwy(fd, rwy_list, False)
+            add('estimate_rwy', t_start)
+
+            t_start = time.perf_counter()
+            ga_flag, _, _ = OSF.check_ga(fd, False)
+            add('check_ga', t_start)
+            if (ga_flag):
+                kinds[kind][1] += 1
+
+            if (n_done >= n_out):
+                continue
+            n_done += 1
+            t_start = time.perf_counter()
+            spldict = OSF.create_spline(fd, method=smooth)
+            OSO.do_plots(fd, spldict, cmap, pl_dir, rwy=rwy)
+            add('plotting', t_start)
+
+            t_start = time.perf_counter()
+            OSO.to_numpy(fd, np_dir)
+            add('to_numpy', t_start)
+
+    return tot, n_calls, kinds
+
+
+def print_results(n_flights, tot, n_calls, kinds):
+    """Print the timings from run_bench()."""
+    print("\nFlights:", n_flights)
+    print("%-14s %10s %10s %12s %12s" % ('Stage', 'Calls', 'Total (s)',
+                                         'Per call (ms)', 'Calls / s'))
+    for stage in bench_stages:
+        if (n_calls[stage] < 1):
+            continue
+        print("%-14s %10d %10.3f %12.3f %12.1f" %
+              (stage, n_calls[stage], tot[stage],
+               1000. * tot[stage] / n_calls[stage],
+               n_calls[stage] / max(tot[stage], 1e-9)))
+    for kind in sorted(kinds):
+        print("%s: %d flights, %d flagged as go-arounds" %
+              (kind, kinds[kind][0], kinds[kind][1]))
+
+
+def main():
+    """Generate the synthetic data and run the benchmark at each size."""
+    parser = argparse.ArgumentParser(description='Benchmark go-around '
+                                     'detection on synthetic data.')
+    parser.add_argument('--airport', nargs='+', default=['VABB', 'KIAD'],
+                        help='the airports to use, from OS_Airports')
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[1000, 10000, 100000],
+                        help='the numbers of flights to time')
+    parser.add_argument('--per-file', type=int, default=50,
+                        help='the number of flights in each hourly file')
+    parser.add_argument('--n-out', type=int, default=100,
+                        help='the number of flights to plot and save')
+    parser.add_argument('--smooth', default='spline',
+                        help='the plot smoothing method')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='the random seed')
+    parser.add_argument('--dir', default=None,
+                        help='the directory for the data, by default a '
+                        'temporary directory')
+    args = parser.parse_args()
+
+    top_dir = args.dir
+    if (top_dir is None):
+        top_dir = tempfile.mkdtemp(prefix='ga_bench_')
+    print("Using directory:", top_dir)
+
+    # Airports that can't be loaded are reported and skipped
+    airports = OSRG.load_airports(args.airport)
+    for name, airport in airports.items():
+        indir = os.path.join(top_dir, name, 'INDATA')
+        if (not os.path.exists(indir)):
+            os.makedirs(indir)
+        print("\nAirport:", name)
+        t_start = time.perf_counter()
+        files = make_files(indir, airport, max(args.sizes),
+                           n_per_file=args.per_file, seed=args.seed)
+        print("Generated data in %.1f s" % (time.perf_counter() - t_start))
+
+        for size in sorted(args.sizes):
+            n_files = int(np.ceil(size / args.per_file))
+            outdir = os.path.join(top_dir, name, 'OUT_' + str(size))
+            tot, n_calls, kinds = run_bench(files[0:n_files],
+                                            airport.rwy_list, outdir,
+                                            n_out=args.n_out,
+                                            smooth=args.smooth)
+            print_results(size, tot, n_calls, kinds)
+
+
+if __name__ == '__main__':
+    main()
@@ -50,3 +50,19 @@ exclude_list = ['800b7b', '800b7c', '800b7d', '800d5f', '800b87', ]
 # This variable allows you to select a single callsign to process
 # To keep all aircraft use '', otherwise enter your own, i.e: 'IGO366'
 search_call = ''
+
+
+# The time (in seconds) without new data after which a flight is treated
+# as complete and passed on for processing
+stream_gap = 300.
+
+
+# The approach corridors used to discard flights early (see OS_Corridor).
+# How far the corridor extends beyond the gate, in degrees
+corr_ext = 0.1
+
+# The corridor half-width, in degrees. Never less than gate_dist.
+corr_width = 0.02
+
+# The grid cell size used to index the corridors, in degrees
+corr_cell = 0.005
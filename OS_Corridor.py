@@ -0,0 +1,238 @@
+"""A grid index of the approach corridors around an airport's runways.
+
+Each corridor runs from the runway threshold out through the gate and
+beyond, with a set half-width. Flights that never enter any corridor
+below the gate altitude cannot be matched to a runway, so they can be
+dropped before any per-flight processing is done.
+
+Runway matching works on the track interpolated to one second, so a
+sparsely reported approach can have no reported point in a corridor
+even though the track between two reports passes through it. The
+flight tests therefore use the whole segment between each pair of
+consecutive reports that has at least one end below the gate altitude.
+"""
+import OS_Airports.RWY as RWY
+import OS_Consts as CNS
+import numpy as np
+import pandas as pd
+
+
+def seg_dist(lats, lons, p0, p1):
+    """Compute the distance (deg) from some points to a line segment.
+
+    Inputs:
+        -   lats, lons: Arrays of point coordinates
+        -   p0, p1: The segment end points, as [lat, lon]
+    Returns:
+        -   An array of distances
+    """
+    d_lat = p1[0] - p0[0]
+    d_lon = p1[1] - p0[1]
+    seg_len2 = d_lat * d_lat + d_lon * d_lon
+    if (seg_len2 <= 0):
+        frac = np.zeros(np.shape(lats))
+    else:
+        frac = ((lats - p0[0]) * d_lat + (lons - p0[1]) * d_lon) / seg_len2
+        frac = np.clip(frac, 0., 1.)
+    c_lat = lats - (p0[0] + frac * d_lat)
+    c_lon = lons - (p0[1] + frac * d_lon)
+    return np.sqrt(c_lat * c_lat + c_lon * c_lon)
+
+
+def track_points(lats, lons, alts, step):
+    """Sample the low parts of a track, as used by the flight tests.
+
+    Every segment between consecutive points with at least one end at or
+    below the gate altitude is split so that neighbouring samples are no
+    more than 'step' apart in latitude and in longitude. Any point on
+    such a segment is then within one grid cell of a sample in each
+    direction, if 'step' is no larger than the cell size. Points with no
+    position are skipped and their neighbours joined, and points with no
+    altitude count as low.
+    Inputs:
+        -   lats, lons: Arrays of point coordinates, in time order
+        -   alts: An array of geometric altitudes (ft)
+        -   step: The largest spacing of the samples (deg)
+    Returns:
+        -   The latitudes and longitudes of the samples
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    alts = np.asarray(alts, dtype=np.float64)
+    good = np.isfinite(lats) & np.isfinite(lons)
+    lats = lats[good]
+    lons = lons[good]
+    with np.errstate(invalid='ignore'):
+        low = ~(alts[good] > CNS.gate_alt)
+    if (len(lats) < 2):
+        return lats[low], lons[low]
+
+    # The low points, and the start of each segment with a low end
+    use = np.flatnonzero(low[:-1] | low[1:])
+    d_lat = lats[use + 1] - lats[use]
+    d_lon = lons[use + 1] - lons[use]
+    n_sub = np.maximum(np.ceil(np.maximum(np.abs(d_lat), np.abs(d_lon))
+                               / step), 1).astype(np.int64)
+    seg = np.repeat(np.arange(len(use)), n_sub)
+    first = np.cumsum(n_sub) - n_sub
+    frac = (np.arange(len(seg)) - first[seg]) / n_sub[seg]
+    s_lats = np.concatenate([lats[low], lats[use][seg] + frac * d_lat[seg]])
+    s_lons = np.concatenate([lons[low], lons[use][seg] + frac * d_lon[seg]])
+    return s_lats, s_lons
+
+
+class corridor_index:
+    """A grid of cells marking the approach corridors of a set of runways.
+
+    lat0, lon0 = the south-west corner of the grid
+    cell = the cell size in degrees
+    mask = a 2d bool array, True for cells inside a corridor
+    near = mask grown by one cell in every direction, for track samples
+    """
+
+    def __init__(self, rwy_list, ext=None, width=None, cell=None):
+        """Build the index.
+
+        Inputs:
+            -   rwy_list: A list of runways, defined in OS_Airports
+            -   ext: (optional) How far (deg) the corridor extends beyond
+                the gate, defaults to CNS.corr_ext
+            -   width: (optional) The corridor half-width (deg), defaults
+                to CNS.corr_width. It is never less than CNS.gate_dist so
+                every point that estimate_rwy() could accept is covered.
+            -   cell: (optional) The grid cell size (deg), defaults to
+                CNS.corr_cell
+        """
+        if (ext is None):
+            ext = CNS.corr_ext
+        if (width is None):
+            width = CNS.corr_width
+        if (cell is None):
+            cell = CNS.corr_cell
+        width = max(width, CNS.gate_dist)
+
+        # The corridor segments, threshold -> gate -> extended point
+        segs = []
+        table = RWY.table_of(rwy_list)
+        for thr, gate in zip(table['rwy'], table['gate']):
+            u_vec = gate - thr
+            u_len = np.sqrt(np.sum(u_vec * u_vec))
+            if (u_len > 0):
+                far = gate + u_vec / u_len * ext
+            else:
+                far = gate
+            segs.append((thr, far))
+
+        # The grid has two spare cells on each side, so that 'near' is
+        # never cut off at the edge
+        pts = np.array([p for seg in segs for p in seg]).reshape(-1, 2)
+        self.cell = cell
+        self.lat0 = np.min(pts[:, 0]) - width - 2 * cell
+        self.lon0 = np.min(pts[:, 1]) - width - 2 * cell
+        n_lat = int(np.ceil((np.max(pts[:, 0]) + width + 2 * cell
+                             - self.lat0) / cell)) + 1
+        n_lon = int(np.ceil((np.max(pts[:, 1]) + width + 2 * cell
+                             - self.lon0) / cell)) + 1
+
+        # Mark every cell that could contain a point inside a corridor
+        c_lat = self.lat0 + (np.arange(n_lat) + 0.5) * cell
+        c_lon = self.lon0 + (np.arange(n_lon) + 0.5) * cell
+        g_lat, g_lon = np.meshgrid(c_lat, c_lon, indexing='ij')
+        reach = width + cell * np.sqrt(2.) / 2.
+        self.mask = np.zeros((n_lat, n_lon), dtype=bool)
+        for p0, p1 in segs:
+            self.mask |= seg_dist(g_lat, g_lon, p0, p1) <= reach
+        pad = np.pad(self.mask, 1)
+        self.near = np.zeros_like(self.mask)
+        for i_lat in range(3):
+            for i_lon in range(3):
+                self.near |= pad[i_lat:i_lat + n_lat, i_lon:i_lon + n_lon]
+
+    def cells_of(self, lats, lons):
+        """Get the grid cells of some points.
+
+        Returns:
+            -   The cell rows and columns, and a bool array that is True
+                for points inside the grid
+        """
+        with np.errstate(invalid='ignore'):
+            i_lat = np.floor((lats - self.lat0) / self.cell)
+            i_lon = np.floor((lons - self.lon0) / self.cell)
+            good = ((i_lat >= 0) & (i_lat < self.mask.shape[0]) &
+                    (i_lon >= 0) & (i_lon < self.mask.shape[1]))
+        i_lat = np.where(good, i_lat, 0).astype(np.int64)
+        i_lon = np.where(good, i_lon, 0).astype(np.int64)
+        return i_lat, i_lon, good
+
+    def hits(self, lats, lons, alts):
+        """Check which points are inside a corridor, below the gate altitude.
+
+        Inputs:
+            -   lats, lons: Arrays of point coordinates
+            -   alts: An array of geometric altitudes (ft)
+        Returns:
+            -   A bool array, True for points inside a corridor
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        alts = np.asarray(alts, dtype=np.float64)
+        i_lat, i_lon, good = self.cells_of(lats, lons)
+        with np.errstate(invalid='ignore'):
+            good = good & ~(alts > CNS.gate_alt)
+        return good & self.mask[i_lat, i_lon]
+
+    def sample_hits(self, s_lats, s_lons):
+        """Check whether any track sample is within a cell of a corridor.
+
+        Inputs:
+            -   s_lats, s_lons: The samples, as from track_points() with a
+                step no larger than the cell size
+        Returns:
+            -   True if the track between the samples could enter a
+                corridor below the gate altitude
+        """
+        i_lat, i_lon, good = self.cells_of(s_lats, s_lons)
+        return bool(np.any(good & self.near[i_lat, i_lon]))
+
+    def track_hits(self, lats, lons, alts):
+        """Check whether a track could enter a corridor between its points.
+
+        Unlike hits(), this never misses a track whose one second
+        interpolation enters a corridor below the gate altitude, but may
+        keep some tracks that pass just outside one.
+        Inputs:
+            -   lats, lons: Arrays of point coordinates, in time order
+            -   alts: An array of geometric altitudes (ft)
+        Returns:
+            -   True if the track could enter a corridor
+        """
+        return self.sample_hits(*track_points(lats, lons, alts, self.cell))
+
+    def flight_hits(self, flight, prev=None):
+        """Check whether a 'traffic' flight enters any corridor.
+
+        Input:
+            -   A flight produced by the 'traffic' library
+            -   prev: (optional) The previous piece of the same flight,
+                whose last point is joined to the first of this one
+        Returns:
+            -   True if the track could enter a corridor, see track_hits()
+        """
+        return self.track_hits(*track_arrays(flight, prev))
+
+
+def track_arrays(flight, prev=None):
+    """Get the positions and geometric altitudes of a 'traffic' flight.
+
+    Inputs:
+        -   A flight produced by the 'traffic' library
+        -   prev: (optional) The previous piece of the same flight, whose
+            last point is put before those of this one
+    Returns:
+        -   Arrays of the latitudes, longitudes and altitudes
+    """
+    f_data = flight.data
+    if (prev is not None):
+        f_data = pd.concat([prev.data.iloc[-1:], f_data], ignore_index=True)
+    return (f_data['latitude'].values, f_data['longitude'].values,
+            f_data['geoaltitude'].values)
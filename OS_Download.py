@@ -0,0 +1,318 @@
+"""A work-queue downloader for hourly OpenSky data.
+
+Each hour to retrieve is a separate task. The tasks are shared out over a
+persistent pool of workers, so 'n_proc' requests are always in progress
+and a slow hour only holds up its own worker. Failed requests are retried
+with an exponential backoff, and files are written to a temporary name
+and then moved into place so a partial file is never left behind.
+
+The data comes from a 'source', any picklable object with a method
+fetch(start, stop) that returns a DataFrame of OpenSky data (or None).
+opensky_source() uses the 'traffic' library, replay_source() reads files
+that have already been downloaded and can be used to test and time the
+downloader without using the OpenSky database.
+
+downloader.flights() is used by GA_Detect to process data as it arrives.
+Each worker splits its hour into flights and passes them straight back,
+so detection can start after the first hour rather than after the whole
+download. Saving the raw data is optional and runs alongside the split.
+"""
+from datetime import timedelta
+import multiprocessing as mp
+import OS_Airports.RWY as RWY
+import OS_Parquet as OSPQ
+import numpy as np
+import threading
+import random
+import time
+import os
+
+
+def get_bounds(rwys, margin=0.45):
+    """
+    This function computes the boundaries of the retrieval
+    'box' based upon the runways selected for processing.
+    The box is 'margin' degrees in each direction around
+    the airport midpoint.
+    """
+    table = RWY.table_of(rwys)
+    ends = np.concatenate([table['rwy'], table['rwy2']])
+
+    lat_ave = np.nanmean(ends[:, 0])
+    lon_ave = np.nanmean(ends[:, 1])
+    bounds = [lon_ave - margin, lat_ave - margin,
+              lon_ave + margin, lat_ave + margin]
+
+    return bounds
+
+
+class opensky_source:
+    """Data from the OpenSky historical database, via 'traffic'."""
+
+    def __init__(self, bounds, other_params=" and time-lastcontact<=15 "):
+        """Setup the class.
+
+        Inputs:
+            -   bounds: The retrieval box, as [lon0, lat0, lon1, lat1]
+            -   other_params: (optional) Extra terms for the query
+        """
+        self.bounds = bounds
+        self.other_params = other_params
+
+    def fetch(self, start, stop):
+        """Retrieve the data between two times, or None if there is none."""
+        from traffic.data import opensky
+
+        flights = opensky.history(start=start,
+                                  stop=stop,
+                                  bounds=self.bounds,
+                                  other_params=self.other_params)
+        if (flights is None):
+            return None
+        return flights.data
+
+
+class replay_source:
+    """Data read back from files written by an earlier download.
+
+    Both the pickles in a single directory and the Parquet layout of
+    OS_Parquet are supported. 'delay' adds a fixed wait to each request
+    to stand in for the time taken by the database.
+    """
+
+    def __init__(self, indir, icao, delay=0.):
+        """Setup the class.
+
+        Inputs:
+            -   indir: The directory holding the pickles, or the top
+                directory of the Parquet layout
+            -   icao: The ICAO code of the airport
+            -   delay: (optional) The time (s) each request takes
+        """
+        self.indir = indir
+        self.icao = icao
+        self.delay = delay
+
+    def fetch(self, start, stop):
+        """Read the hour starting at 'start', or None if there is no file."""
+        import pandas as pd
+
+        if (self.delay > 0):
+            time.sleep(self.delay)
+        inf = OSPQ.get_outname(self.indir, self.icao, start)
+        if (os.path.exists(inf)):
+            return OSPQ.read_frame(inf)
+        inf = os.path.join(self.indir, 'OS_' + start.strftime("%Y%m%d%H%M")
+                           + '_' + self.icao + '.pkl')
+        if (os.path.exists(inf)):
+            data = pd.read_pickle(inf)
+            return getattr(data, 'data', data)
+        return None
+
+
+def write_data(df, outf):
+    """Write a DataFrame of OpenSky data to a pickle or Parquet file.
+
+    The format is chosen by the file extension, and in both cases the
+    file is written to a temporary name first.
+    """
+    if (outf.endswith('.parquet')):
+        OSPQ.write_frame(df, outf)
+        return
+    odir = os.path.dirname(outf)
+    if (len(odir) > 0 and not os.path.exists(odir)):
+        os.makedirs(odir, exist_ok=True)
+    tmpf = outf + '.' + str(os.getpid()) + '.tmp'
+    df.to_pickle(tmpf)
+    os.replace(tmpf, outf)
+
+
+def fetch_retry(source, hour, n_retry, backoff):
+    """Retrieve an hour of data from a source, retrying on failure.
+
+    Inputs:
+        -   source: The data source
+        -   hour: The start time
+        -   n_retry: The number of retries after a failure
+        -   backoff: The wait (s) before the first retry
+    Returns:
+        -   The DataFrame (None if it failed), the number of attempts
+            and the last error message
+    """
+    err = ''
+    for n_try in range(1, n_retry + 2):
+        try:
+            return source.fetch(hour, hour + timedelta(hours=1)), n_try, ''
+        except Exception as e:
+            err = str(e) or type(e).__name__
+        if (n_try <= n_retry):
+            # Wait longer after each failure, with some jitter so the
+            # workers don't all retry at once
+            time.sleep(backoff * (2 ** (n_try - 1)) * random.uniform(0.5, 1.5))
+    return None, n_retry + 1, err
+
+
+def fetch_hour(task):
+    """Retrieve and save a single hour of data, retrying on failure.
+
+    Input:
+        -   task: A tuple of (source, start time, output filename,
+            number of retries, initial backoff in seconds)
+    Returns:
+        -   A tuple of (start time, output filename, status, number of
+            attempts, error message). The status is one of 'done',
+            'exists', 'empty' or 'failed'.
+    """
+    source, hour, outf, n_retry, backoff = task
+    if (os.path.exists(outf)):
+        return hour, outf, 'exists', 0, ''
+    df, n_try, err = fetch_retry(source, hour, n_retry, backoff)
+    if (len(err) > 0):
+        return hour, outf, 'failed', n_try, err
+    if (df is None or len(df) < 1):
+        return hour, outf, 'empty', n_try, ''
+    try:
+        write_data(df, outf)
+    except Exception as e:
+        return hour, outf, 'failed', n_try, str(e)
+    return hour, outf, 'done', n_try, ''
+
+
+def fetch_flights(task):
+    """Retrieve a single hour of data and split it into flights.
+
+    If an output filename is given the raw data is also saved, in a
+    thread that runs while the flights are split. An hour that has
+    already been saved is read from its file.
+    Input:
+        -   task: A tuple of (source, start time, output filename or None,
+            number of retries, initial backoff in seconds)
+    Returns:
+        -   A tuple of (start time, output filename, status, number of
+            attempts, error message, list of flights). The status is as
+            for fetch_hour().
+    """
+    import OS_Funcs as OSF
+
+    source, hour, outf, n_retry, backoff = task
+    if (outf is not None and os.path.exists(outf)):
+        return hour, outf, 'exists', 0, '', OSF.get_flight(outf)
+    df, n_try, err = fetch_retry(source, hour, n_retry, backoff)
+    if (len(err) > 0):
+        return hour, outf, 'failed', n_try, err, []
+    if (df is None or len(df) < 1):
+        return hour, outf, 'empty', n_try, '', []
+
+    saver = None
+    if (outf is not None):
+        saver = threading.Thread(target=write_data, args=(df, outf))
+        saver.start()
+    try:
+        flist = OSF.get_flight_frame(df)
+    finally:
+        if (saver is not None):
+            saver.join()
+    return hour, outf, 'done', n_try, '', flist
+
+
+class downloader:
+    """Retrieves hours of data using a persistent pool of workers.
+
+    fmt = 'pkl' for one pickle per hour in outdir, or 'parquet' for the
+          partitioned layout of OS_Parquet under outdir
+    counts = the number of hours with each status, see fetch_hour()
+    """
+
+    def __init__(self, source, icao, outdir, fmt='pkl', n_proc=6,
+                 n_retry=5, backoff=10., method='forkserver'):
+        """Setup the class and start the worker pool.
+
+        Inputs:
+            -   source: The data source, see above
+            -   icao: The ICAO code of the airport
+            -   outdir: The output directory
+            -   fmt: (optional) The output format, see above
+            -   n_proc: (optional) The number of simultaneous requests
+            -   n_retry: (optional) The number of retries after a failure
+            -   backoff: (optional) The wait (s) before the first retry,
+                this doubles after each further failure
+            -   method: (optional) The multiprocessing start method
+        """
+        self.source = source
+        self.n_proc = n_proc
+        self.icao = icao
+        self.outdir = outdir
+        self.fmt = fmt
+        self.n_retry = n_retry
+        self.backoff = backoff
+        self.counts = {'done': 0, 'exists': 0, 'empty': 0, 'failed': 0}
+        if (method not in mp.get_all_start_methods()):
+            method = None
+        self.pool = mp.get_context(method).Pool(processes=n_proc)
+
+    def get_outname(self, hour):
+        """Get the output filename for an hour of data."""
+        if (self.fmt == 'parquet'):
+            return OSPQ.get_outname(self.outdir, self.icao, hour)
+        return os.path.join(self.outdir, 'OS_' + hour.strftime("%Y%m%d%H%M")
+                            + '_' + self.icao + '.pkl')
+
+    def run(self, hours):
+        """Retrieve a list of hours.
+
+        The hours are queued in order and each worker takes the next one
+        as soon as it is free, so results can arrive out of order.
+        Input:
+            -   hours: A list of datetimes, the start of each hour
+        Yields:
+            -   The result of fetch_hour() for each hour, as it completes
+        """
+        tasks = [(self.source, hour, self.get_outname(hour),
+                  self.n_retry, self.backoff) for hour in hours]
+        for res in self.pool.imap_unordered(fetch_hour, tasks, chunksize=1):
+            self.counts[res[2]] += 1
+            yield res
+
+    def flights(self, hours, save=False, n_ahead=None):
+        """Retrieve a list of hours and return the flights in each.
+
+        The hours are returned in order. At most n_ahead hours are being
+        retrieved or waiting to be used at any time, so a slow consumer
+        holds back the download rather than using up memory.
+        Inputs:
+            -   hours: A list of datetimes, the start of each hour
+            -   save: (optional) True to also save the raw data
+            -   n_ahead: (optional) The number of hours to retrieve ahead,
+                defaults to twice the number of workers
+        Yields:
+            -   The list of flights for each hour, as from get_flight()
+        """
+        if (n_ahead is None):
+            n_ahead = 2 * self.n_proc
+        p_list = []
+        for hour in hours:
+            outf = None
+            if (save):
+                outf = self.get_outname(hour)
+            p_list.append(self.pool.apply_async(fetch_flights,
+                                                args=((self.source, hour,
+                                                       outf, self.n_retry,
+                                                       self.backoff),)))
+            if (len(p_list) >= n_ahead):
+                yield self.collect(p_list.pop(0))
+        for p in p_list:
+            yield self.collect(p)
+
+    def collect(self, p):
+        """Wait for one hour from flights() and return its flights."""
+        hour, outf, status, n_try, err, flist = p.get()
+        self.counts[status] += 1
+        if (status == 'failed'):
+            print("There is a problem with this date/time combination:",
+                  err, hour)
+        return flist
+
+    def close(self):
+        """Stop the worker pool."""
+        self.pool.close()
+        self.pool.join()
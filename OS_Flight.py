@@ -0,0 +1,97 @@
+"""A compact container for the data of a single flight.
+
+flight_data holds each per-point value as a contiguous numpy array with a
+fixed dtype, plus the per-flight values, in __slots__ rather than a dict.
+It can be indexed like the dicts used throughout, so fd['lats'] and
+fd['lats'] = ... work as before.
+"""
+import numpy as np
+
+
+# The per-point arrays and their dtypes
+pt_types = {'time': np.int64,
+            'lats': np.float64,
+            'lons': np.float64,
+            'alts': np.float64,
+            'spds': np.float64,
+            'gals': np.float64,
+            'hdgs': np.float64,
+            'rocs': np.float64,
+            'ongd': np.bool_}
+
+# The values added during processing, and the per-flight values
+fl_cols = ['labl', 'rdis', 'call', 'ic24', 'strt', 'stop', 'dura',
+           'min_alt_pt', 'rwy', 'posser', 'gapt', 'gapts', 'ga_times',
+           'offset', 'length']
+
+
+class flight_data:
+    """The data for one flight.
+
+    time = the time since first contact (s) of each point
+    lats, lons = the position of each point
+    alts, gals = the barometric and geometric altitude of each point
+    spds, hdgs, rocs = the ground speed, track and vertical rate
+    ongd = True for points where the aircraft is on the ground
+    call, ic24 = the callsign and icao24 code
+    strt, stop, dura = the first and last times and the duration
+    The other values are added while a flight is processed.
+    """
+
+    __slots__ = list(pt_types.keys()) + fl_cols
+
+    def __init__(self, **kwargs):
+        """Setup the class, with any values given as keywords."""
+        for key, val in kwargs.items():
+            setattr(self, key, val)
+
+    def __getitem__(self, key):
+        """Get a value by name, as for a dict."""
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, val):
+        """Set a value by name, as for a dict."""
+        try:
+            setattr(self, key, val)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        """Check whether a value has been set."""
+        return key in self.__slots__ and hasattr(self, key)
+
+    def get(self, key, default=None):
+        """Get a value by name, or a default if it has not been set."""
+        return getattr(self, key, default)
+
+    def keys(self):
+        """Return the names of the values that have been set."""
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def to_dict(self):
+        """Return the values as a dict."""
+        return {key: getattr(self, key) for key in self.keys()}
+
+
+def from_columns(cols, order=None, **kwargs):
+    """Create a flight_data from a set of per-point arrays.
+
+    Every array is converted to its fixed dtype and put in order in a
+    single indexing pass.
+    Inputs:
+        -   cols: A dict of the per-point arrays, keyed as pt_types
+        -   order: (optional) An index array giving the point order
+        -   Any per-flight values, as keywords
+    Returns:
+        -   A flight_data
+    """
+    fd = flight_data(**kwargs)
+    for col, ctype in pt_types.items():
+        vals = np.asarray(cols[col], dtype=ctype)
+        if (order is not None):
+            vals = vals[order]
+        fd[col] = vals
+    return fd
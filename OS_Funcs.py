@@ -1,18 +1,206 @@
-"""Core methods for processing ADS-B data and detecting go-arounds."""
-from scipy.interpolate import UnivariateSpline as UniSpl
-from traffic.core import Traffic
+"""Core methods for processing ADS-B data and detecting go-arounds.
+
+The heavier libraries (traffic and scipy) are only imported
+by the functions that need them, so that importing this module is cheap.
+"""
 from datetime import timedelta
 import metar_parse as MEP
 import pandas as pd
 
-import flightphase as flph
+import OS_Results as OSRE
+import OS_Airports.RWY as RWY
+import OS_Timing as OST
+import OS_Flight as OSFL
+import OS_Phase as OSPH
+import OS_Render as OSR
 import OS_Output as OSO
 import OS_Consts as CNS
 import numpy as np
 
 
-# Read METARs from disk
-metars = MEP.get_metars('/home/proud/Desktop/GoAround_Paper/VABB_METAR')
+# The METAR file for the airport being processed. It is only read when
+# first needed, see get_metar_store().
+metar_file = '/home/proud/Desktop/GoAround_Paper/VABB_METAR'
+metars = None
+
+# The METARs of other airports, keyed by filename, when several airports
+# are processed at once
+met_stores = {}
+
+# The runway list shared with pool workers by init_worker()
+shared_rwys = None
+
+# The METAR file and runway list of each airport, keyed by ICAO code,
+# shared with pool workers by init_worker()
+shared_airports = {}
+
+
+def get_metar_store(met_file=None):
+    """Return the METARs for metar_file, reading them on first use.
+
+    Input:
+        -   met_file: (optional) Another METAR file, such as that of one of
+            several airports. Each file is only read once.
+    Returns:
+        -   A metar_store, such as that returned by metar_parse.get_metars()
+    """
+    global metars
+    if (met_file is not None and met_file != metar_file):
+        if (met_file not in met_stores):
+            met_stores[met_file] = MEP.get_metars(met_file)
+        return met_stores[met_file]
+    if (metars is None):
+        metars = MEP.get_metars(metar_file)
+    return metars
+
+
+def init_worker(met_file, rwy_list, timing=False, airports=None):
+    """Initialise a pool worker with state built by the parent process.
+
+    The parent should call get_metar_store() before starting the pool, so
+    the METAR cache already exists and each worker only memory-maps it.
+    Inputs:
+        -   met_file: The METAR file to use, or None to keep metar_file
+        -   rwy_list: A list of runways to check, defined in OS_Airports
+        -   timing: (optional) True to time each stage, see OS_Timing
+        -   airports: (optional) A dict of ICAO code -> (METAR file,
+            runway list), for processing several airports
+    """
+    global metar_file, metars, shared_rwys, shared_airports
+    OST.enable(timing)
+    if (met_file is not None and met_file != metar_file):
+        metar_file = met_file
+        metars = None
+    if (metar_file is not None):
+        get_metar_store()
+    # Plain runway lists are compiled into runway tables once, here
+    shared_rwys = RWY.as_runway_list(rwy_list)
+    if (airports is None):
+        airports = {}
+    shared_airports = {icao: (a_met, RWY.as_runway_list(a_rwys))
+                       for icao, (a_met, a_rwys) in airports.items()}
+    for a_met, a_rwys in airports.values():
+        if (a_met is not None):
+            get_metar_store(a_met)
+
+
+def seg_argmin(vals, offs):
+    """Find the first position of the minimum value in each segment.
+
+    NaNs are ignored, as in np.nanargmin.
+    Inputs:
+        -   vals: A 2d array (n_points, n_cols) of values
+        -   offs: The segment offsets, segment i is vals[offs[i]:offs[i+1]].
+            Every segment must be non-empty.
+    Returns:
+        -   An int array (n_segments, n_cols) of positions in vals
+        -   A float array (n_segments, n_cols) of the minimum values, this
+            is inf if a segment contains only NaNs
+    """
+    tmp = np.where(vals == vals, vals, np.inf)
+    mins = np.minimum.reduceat(tmp, offs[:-1], axis=0)
+    seg = np.repeat(np.arange(len(offs) - 1), np.diff(offs))
+    npts = len(tmp)
+    cand = np.where(tmp == mins[seg], np.arange(npts)[:, None], npts)
+    pos = np.minimum.reduceat(cand, offs[:-1], axis=0)
+    pos = np.minimum(pos, offs[1:, None] - 1)
+
+    return pos, mins
+
+
+def report_gates(calls, df, pos, fails, rwy):
+    """Print why some flights failed the gates of a runway.
+
+    Inputs:
+        -   calls, the callsign of each flight
+        -   df, a dict of flight data arrays, as for match_rwys()
+        -   pos, the position tested for each flight
+        -   fails, a bool array of the flights to report
+        -   rwy, the runway
+    """
+    for i in np.flatnonzero(fails):
+        pt = pos[i]
+        if (df['gals'][pt] > CNS.gate_alt):
+            print("Bad geo alt", calls[i], df['gals'][pt], CNS.gate_alt)
+        elif (df['rocs'][pt] > CNS.gate_roc):
+            print("Bad rate of climb", calls[i], df['rocs'][pt],
+                  CNS.gate_roc)
+        else:
+            print("Bad heading", calls[i], df['hdgs'][pt], rwy.heading)
+
+
+def match_rwys(df, offs, rwy_list, calls=None):
+    """Match one or more flights to the runways they are landing on.
+
+    The distance from every point to every runway gate is computed as a
+    single (points x runways) array. For each flight and runway the closest
+    and second closest points are then tested against the altitude, rate
+    of climb and heading gates, with all flights tested together.
+    Inputs:
+        -   df, a dict of flight data arrays, which may hold several
+            flights one after another
+        -   offs, the flight offsets, flight i is at offs[i]:offs[i+1]
+        -   rwy_list, a list of runways to check, defined in OS_Airports
+        -   calls, (optional) the callsign of each flight. If given, the
+            reason is printed whenever a point that would be the best
+            match so far fails a gate.
+    Returns:
+        -   An int array giving the index in rwy_list for each flight, or
+            -1 if no runway is found
+        -   An int array giving the position within each flight at which
+            it is closest to the runway gate, or -1
+        -   A float array giving the distance to the gate at that position
+    """
+    offs = np.asarray(offs)
+    n_fl = len(offs) - 1
+    b_dist = np.full(n_fl, 999.)
+    b_rwy = np.full(n_fl, -1, dtype=np.int64)
+    b_pos = np.full(n_fl, -1, dtype=np.int64)
+    if (n_fl < 1 or len(rwy_list) < 1):
+        return b_rwy, b_pos, b_dist
+
+    table = RWY.table_of(rwy_list)
+    gates = table['gate']
+    hdgr = table['heading']
+    dlat = df['lats'][:, None] - gates[None, :, 0]
+    dlon = df['lons'][:, None] - gates[None, :, 1]
+    dists = np.sqrt(dlat * dlat + dlon * dlon)
+
+    # Closest and second closest point to each gate
+    pos1, min1 = seg_argmin(dists, offs)
+    cols = np.arange(len(rwy_list))
+    dists[pos1, cols[None, :]] = 999.
+    pos2, min2 = seg_argmin(dists, offs)
+
+    # The gates for every candidate point, as (flights x runways) masks
+    gd1 = (~(df['gals'][pos1] > CNS.gate_alt) &
+           ~(df['rocs'][pos1] > CNS.gate_roc))
+    gd2 = (~(df['gals'][pos2] > CNS.gate_alt) &
+           ~(df['rocs'][pos2] > CNS.gate_roc))
+    hdg1 = df['hdgs'][pos1]
+    hdg2 = df['hdgs'][pos2]
+    gd1 = gd1 & (((hdg1 >= hdgr[:, 0]) & (hdg1 <= hdgr[:, 1])) |
+                 ((hdg1 >= hdgr[:, 2]) & (hdg1 <= hdgr[:, 3])))
+    gd2 = gd2 & (((hdg2 >= hdgr[:, 0]) & (hdg2 <= hdgr[:, 1])) |
+                 ((hdg2 >= hdgr[:, 2]) & (hdg2 <= hdgr[:, 3])))
+
+    # Pick the best candidate, first using the closest point to each
+    # runway and then the second closest. A runway is only considered if
+    # its closest point beats the best distance found so far.
+    for dist, pos, good in [(min1, pos1, gd1), (min2, pos2, gd2)]:
+        for r in range(0, len(rwy_list)):
+            if (calls is not None):
+                report_gates(calls, df, pos[:, r],
+                             (min1[:, r] < b_dist) & ~good[:, r],
+                             rwy_list[r])
+            acc = (min1[:, r] < b_dist) & good[:, r]
+            b_dist = np.where(acc, dist[:, r], b_dist)
+            b_rwy = np.where(acc, r, b_rwy)
+            b_pos = np.where(acc, pos[:, r] - offs[:-1], b_pos)
+
+    b_rwy[b_dist > CNS.gate_dist] = -1
+
+    return b_rwy, b_pos, b_dist
 
 
 def estimate_rwy(df, rwy_list, verbose):
@@ -25,77 +213,104 @@ def estimate_rwy(df, rwy_list, verbose):
     Returns:
         -   A runway class from the list.
     """
-    b_dist = 999.
-    b_rwy = None
-    b_pos = -1.
-
-    for run in range(0, 2):
-        for rwy in rwy_list:
-            dists2 = np.sqrt((df['lats'] - rwy.gate[0]) *
-                             (df['lats'] - rwy.gate[0]) +
-                             (df['lons'] - rwy.gate[1]) *
-                             (df['lons'] - rwy.gate[1]))
-            min_d = np.nanmin(dists2)
-            if (min_d < b_dist):
-                pt2 = (min_d == dists2).nonzero()
-                if (len(pt2[0]) > 0):
-                    pt2 = pt2[0]
-                pt2 = pt2[0]
-
-                if (run == 1):
-                    dists2[pt2] = 999.
-                    min_d = np.nanmin(dists2)
-                    pt2 = (min_d == dists2).nonzero()
-                    if (len(pt2[0]) > 0):
-                        pt2 = pt2[0]
-                    pt2 = pt2[0]
-                if (df['gals'][pt2] > CNS.gate_alt):
-                    if (verbose):
-                        print("Bad geo alt", df['call'],
-                              df['gals'][pt2], CNS.gate_alt)
-                    continue
-                if (df['rocs'][pt2] > CNS.gate_roc):
-                    if (verbose):
-                        print("Bad rate of climb", df['call'],
-                              df['rocs'][pt2], CNS.gate_roc)
-                    continue
-                if (df['hdgs'][pt2] >= rwy.heading[0] and
-                        df['hdgs'][pt2] <= rwy.heading[1]):
-                    b_dist = min_d
-                    b_rwy = rwy
-                    b_pos = pt2
-                elif (df['hdgs'][pt2] >= rwy.heading[2] and
-                      df['hdgs'][pt2] <= rwy.heading[3]):
-                    b_dist = min_d
-                    b_rwy = rwy
-                    b_pos = pt2
-                else:
-                    if (verbose):
-                        print("Bad heading", df['call'],
-                              df['hdgs'][pt2], rwy.heading)
-                    continue
-    if (b_dist > CNS.gate_dist):
+    offs = np.array([0, len(df['lats'])])
+    calls = None
+    if (verbose):
+        calls = [df['call']]
+    b_rwy, b_pos, b_dist = match_rwys(df, offs, rwy_list, calls)
+    if (b_rwy[0] < 0):
         if (verbose):
-            print("too far", df['call'], b_dist, CNS.gate_dist)
-        return None, b_pos
+            print("too far", df['call'], b_dist[0], CNS.gate_dist)
+        return None, b_pos[0]
+
+    return rwy_list[b_rwy[0]], b_pos[0]
 
-    return b_rwy, b_pos
+
+def estimate_rwy_batch(bd, rwy_list, verbose):
+    """Guess which runway each of a batch of flights is landing on.
+
+    Inputs:
+        -   bd, a batch dict, such as that returned by OS_Batch.make_batch()
+        -   rwy_list, a list of runways to check, defined in OS_Airports
+        -   verbose, a bool specifying whether to verbosely print updates
+    Returns:
+        -   A list containing a runway class from the list, or None, for
+            each flight
+        -   An int array of the position within each flight at which it
+            is closest to the runway gate, or -1
+    """
+    calls = None
+    if (verbose):
+        calls = [fd['call'] for fd in bd['fds']]
+    b_rwy, b_pos, b_dist = match_rwys(bd, bd['offs'], rwy_list, calls)
+    rwys = []
+    for i in range(0, len(b_rwy)):
+        if (b_rwy[i] < 0):
+            if (verbose):
+                print("too far", bd['fds'][i]['call'], b_dist[i],
+                      CNS.gate_dist)
+            rwys.append(None)
+        else:
+            rwys.append(rwy_list[b_rwy[i]])
+
+    return rwys, b_pos
 
 
 def get_flight(inf):
     """Load a series of flights from a file using Xavier's 'traffic' library.
 
+    Parquet files (see OS_Parquet) only have the needed columns read from
+    disk. Every point is read, as cleaning and filtering use the points
+    either side of those that are kept, so a Parquet file and the pickle it
+    was converted from give the same flights.
     Input:
         -   inf, the input filename
     Returns:
         -   a list of flights
     """
-    flist = []
+    from traffic.core import Traffic
+
 #    try:
-    fdata = Traffic.from_file(inf).query("latitude == latitude")
-    fdata = fdata.clean_invalid().filter().eval()
+    with OST.stage('read'):
+        if (inf.endswith('.parquet')):
+            import OS_Parquet as OSPQ
+            fdata = Traffic(OSPQ.read_frame(inf))
+        else:
+            fdata = Traffic.from_file(inf)
 #    except:
-#        return flist
+#        return []
+    OST.count('files')
+    with OST.stage('split'):
+        return split_flights(fdata)
+
+
+def get_flight_frame(df):
+    """Load a series of flights from a DataFrame of OpenSky data.
+
+    This is used for data passed straight from the downloader.
+    Input:
+        -   df, a DataFrame as returned by opensky.history()
+    Returns:
+        -   a list of flights
+    """
+    from traffic.core import Traffic
+
+    return split_flights(Traffic(df))
+
+
+def split_flights(fdata):
+    """Clean a 'traffic' Traffic object and split it into flights.
+
+    Input:
+        -   fdata, the Traffic object
+    Returns:
+        -   a list of flights
+    """
+    flist = []
+    fdata = fdata.query("latitude == latitude")
+    if (fdata is None):
+        return flist
+    fdata = fdata.clean_invalid().filter().eval()
     for flight in fdata:
         pos = flight.callsign.find(CNS.search_call)
         if (pos < 0):
@@ -165,6 +380,126 @@ def get_future_time(times, c_pos, n_sec):
     return idx
 
 
+def future_pos(times, offs, pts, n_sec, max_diff=20):
+    """Find, for many points at once, the position closest to n_sec later.
+
+    This gives the same positions as get_future_time(), using one
+    searchsorted over all the flights rather than a search per point.
+    Inputs:
+        -   times, the times of one or more flights, one after another.
+            The times within each flight must be in order.
+        -   offs, the flight offsets, flight i is at offs[i]:offs[i+1]
+        -   pts, an int array of positions in times
+        -   n_sec, the desired time delta (>= 0)
+        -   max_diff, (optional) the largest allowed time difference
+    Returns:
+        -   An int array of positions in times, or -1 if no time is found
+    """
+    offs = np.asarray(offs)
+    pts = np.asarray(pts, dtype=np.int64)
+    if (len(pts) < 1):
+        return np.full(0, -1, dtype=np.int64)
+    times = np.asarray(times, dtype=np.float64)
+    lens = np.diff(offs)
+    fseg = np.repeat(np.arange(len(lens)), lens)
+    seg = fseg[pts]
+    starts = offs[:-1][seg]
+    ends = offs[1:][seg]
+
+    # Place the flights one after another on a single increasing axis
+    span = np.ptp(times) + n_sec + max_diff + 1.
+    key = times - times[offs[:-1][fseg]] + fseg * span
+
+    f_key = key[pts] + n_sec
+    right = np.searchsorted(key, f_key, side='left')
+    left = right - 1
+    d_l = np.where(left >= starts,
+                   np.abs(key[np.clip(left, 0, None)] - f_key), np.inf)
+    d_r = np.where(right < ends,
+                   np.abs(key[np.clip(right, None, len(key) - 1)] - f_key),
+                   np.inf)
+    # As argmin, take the earlier point on a tie and the first of any
+    # repeated times
+    best = np.where(d_l <= d_r, left, right)
+    best = np.searchsorted(key, key[np.clip(best, 0, len(key) - 1)],
+                           side='left')
+    return np.where(np.minimum(d_l, d_r) <= max_diff, best, -1)
+
+
+def label_changes(labels, offs):
+    """Find the label state changes within one or more flights.
+
+    Inputs:
+        -   labels: The flight phase labels, flights one after another
+        -   offs: The flight offsets
+    Returns:
+        -   An int array of positions where the label differs from
+            that of the previous point in the same flight
+        -   An int array giving the number of changes in each flight
+    """
+    offs = np.asarray(offs)
+    cng = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+    # A change across a flight boundary is not a state change
+    starts = np.zeros(len(labels), dtype=bool)
+    starts[offs[:-1][offs[:-1] < len(labels)]] = True
+    cng = cng[~starts[cng]]
+    seg = np.searchsorted(offs, cng, side='right') - 1
+    n_cng = np.bincount(seg, minlength=len(offs) - 1)
+
+    return cng, n_cng
+
+
+def find_gas(times, alts, rocs, labels, offs):
+    """Find every go-around in one or more flights.
+
+    A go-around is a change from descent to level or climb at low
+    altitude, after which most points up to ga_tcheck seconds later are
+    above alt_thresh and enough are climbing faster than vrt_thresh.
+    Every candidate is tested at once, with the point counts taken from
+    cumulative sums.
+    Inputs:
+        -   times, alts, rocs, labels: The flight arrays, with the flights
+            one after another
+        -   offs: The flight offsets
+    Returns:
+        -   An int array of the positions of every go-around, in order
+    """
+    offs = np.asarray(offs)
+    cng, _ = label_changes(labels, offs)
+    # Only descent -> level / climb changes at low altitude can be g/a
+    good = ~(alts[cng] > CNS.ga_st_alt_t)
+    good = good & (labels[cng - 1] == "DE")
+    good = good & ((labels[cng] == "LVL") | (labels[cng] == "CL"))
+    cng = cng[good]
+    if (len(cng) < 1):
+        return cng
+
+    # The end of the test window for each candidate. If there's no point
+    # ga_tcheck seconds later then use the rest of the flight, unless
+    # most of it is too far in the future.
+    ends = offs[1:][np.searchsorted(offs, cng, side='right') - 1]
+    t_pos = future_pos(times, offs, cng, CNS.ga_tcheck)
+    no_fut = t_pos < 0
+    stop = np.where(no_fut, ends, t_pos)
+    c_time = np.concatenate(([0.], np.cumsum(times, dtype=np.float64)))
+    r_time = (c_time[ends] - c_time[cng]) / (ends - cng)
+    skip = no_fut & (r_time > times[cng] + (CNS.ga_tcheck * 2.))
+
+    # Remove dodgy datapoints, sometimes on landing an aircraft
+    # will report its position as very high (30+kft)
+    alt_ok = np.where(alts > 20000, -10000, alts) > CNS.alt_thresh
+    c_alt = np.concatenate(([0], np.cumsum(alt_ok)))
+    c_vrt = np.concatenate(([0], np.cumsum(rocs > CNS.vrt_thresh)))
+
+    n_pos = stop - cng
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alts_p = ((c_alt[stop] - c_alt[cng]) / n_pos) * 100.
+        vrts_p = ((c_vrt[stop] - c_vrt[cng]) / n_pos) * 100.
+    is_ga = ~skip & (n_pos > 10) & (alts_p > 50) & (vrts_p > 20)
+
+    return cng[is_ga]
+
+
 def check_ga(fd, verbose, first_pos=-1):
     """Check if a go-around occurred based on some simple tests.
 
@@ -175,137 +510,181 @@ def check_ga(fd, verbose, first_pos=-1):
             This is useful for situations with multiple g/a's in one track
     Returns:
         -   True if a go-around is likely to have occurred, false otherwise
-        -   An int specifying the array location where g/a occurred, or None
+        -   An int specifying the array location of the last g/a, or None
+        -   An int array of the locations of every g/a
     """
-    ga_flag = False
-    bpt = None
-
-    labels = fd['labl']
-
-    lblen = len(labels)
-    cng = np.zeros(lblen, dtype=bool)
-    for i in range(1, lblen):
-        if (labels[i] != labels[i-1]):
-            cng[i] = True
-    main_pts = (cng).nonzero()
-    if np.all(cng is False):
-        return ga_flag
-    if (len(main_pts[0]) > 0):
-        main_pts = main_pts[0]
-    for pt in main_pts:
-        #   Check data is in desired range
-        if (pt < first_pos):
-            continue
-        # First check altitude of state change. G/A will be low alt
-        if (fd['alts'][pt] > CNS.ga_st_alt_t):
-            continue
-        # We only want points where initial state is Descent
-        if (labels[pt-1] != "DE"):
-            continue
-        # And the next state should be level or climbing
-        if (labels[pt] != "LVL" and labels[pt] != "CL"):
-            continue
-        # Now we check future altitudes, some must be > threshold
-        # to be defined as a go-around, otherwise it could be
-        # bad data on landing
-        t_pos = get_future_time(fd['time'], pt, CNS.ga_tcheck)
-        if (t_pos < 0):
-            lenner = len(fd['alts'])
-            r_time = np.nanmean(fd['time'][pt:lenner])
-            if (r_time > fd['time'][pt] + (CNS.ga_tcheck * 2.)):
-                continue
-            alt_sub = fd['alts'][pt:lenner]
-            vrt_sub = fd['rocs'][pt:lenner]
-            n_pos = len(fd['alts']) - pt
-        else:
-            alt_sub = fd['alts'][pt:t_pos]
-            vrt_sub = fd['rocs'][pt:t_pos]
-            n_pos = t_pos - pt
-
-        # Remove dodgy datapoints, sometimes on landing an aircraft
-        # will report its position as very high (30+kft)
-        pts = (alt_sub > 20000).nonzero()
-        alt_sub[pts] = -10000
-
-        alt_test = (alt_sub > CNS.alt_thresh)
-        pts_alt = (alt_test).nonzero()
-        if (len(pts_alt[0]) > 0):
-            pts_alt = pts_alt[0]
-
-        vrt_test = (vrt_sub > CNS.vrt_thresh)
-        pts_vrt = (vrt_test).nonzero()
-        if (len(pts_vrt[0]) > 0):
-            pts_vrt = pts_vrt[0]
-
-        n_pts_alt = len(pts_alt)
-        n_pts_vrt = len(pts_vrt)
-        alts_p = (n_pts_alt/n_pos)*100.
-        vrts_p = (n_pts_vrt/n_pos)*100.
-
-        if (n_pos > 10 and alts_p > 50 and vrts_p > 20):
-            if verbose:
-                ga_time = fd['strt'] + timedelta(seconds=int(fd['time'][pt]))
-                print("\t-\tG/A warning:",
-                      fd['call'],
-                      fd['ic24'],
-                      ga_time.strftime("%Y-%m-%d %H:%M"))
-            ga_flag = True
-            bpt = pt
-
-    return ga_flag, bpt
+    offs = np.array([0, len(fd['time'])])
+    gapts = find_gas(fd['time'], fd['alts'], fd['rocs'],
+                     np.asarray(fd['labl']), offs)
+    gapts = gapts[gapts >= first_pos]
+    if (len(gapts) < 1):
+        return False, None, gapts
 
+    if verbose:
+        for pt in gapts:
+            ga_time = fd['strt'] + timedelta(seconds=int(fd['time'][pt]))
+            print("\t-\tG/A warning:",
+                  fd['call'],
+                  fd['ic24'],
+                  ga_time.strftime("%Y-%m-%d %H:%M"))
 
-def proc_fl(flight, check_rwys, odirs, colormap, do_save, verbose):
-    """Filter, assign phases and determine go-around status for a given flight.
+    return True, int(gapts[-1]), gapts
+
+
+def prep_fl(flight, verbose):
+    """Check and preprocess a flight ready for go-around detection.
 
     Inputs:
         -   A 'traffic' flight object
-        -   A list storing potential landing runways to check
-        -   A 4-element list specifying various output directories:
-            -   normal plot output
-            -   go-around plot output
-            -   normal numpy data output
-            -   go-around numpy data output
-        -   A dict of colours used for flightpath labelling
-        -   A boolean specifying whether to save data or not
         -   A boolean specifying whether to use verbose mode
     Returns:
-        -   Nothing
+        -   A dict of flight data, such as that returned by preproc_data(),
+            or None if the flight is not suitable for processing.
     """
     # First, check if a flight is not on exclusion list
     gd_fl = check_good_flight(flight)
     if (not gd_fl):
         if (verbose):
             print("\t-\tBad flight call:", flight.callsign)
-        return -1
+        return None
 
     # Print some details if verbose
     if (verbose):
         print("\t-\tProcessing:", flight.callsign)
 
-    # Resample trajectory to one second, this is used for runway estimation
-    flight2 = flight.resample("1s")
-
     # Preprocess the data, sorting by time and putting into UNIX format
     fd = preproc_data(flight, verbose)
-    fd2 = preproc_data(flight2, verbose)
 
     # If we don't have good data here, skip
     if (fd is None):
         if (verbose):
             print("\t-\tBad flight data:", flight.callsign, fd)
-        return -1
-    if (fd2 is None):
-        if verbose:
-            print("\t-\tBad flight data:", flight.callsign, fd2)
+        return None
+
+    return fd
+
+
+def interp_near(fd, rwy_list, n_pts=2):
+    """Interpolate a flight to one second, but only near the runway gates.
+
+    Runway estimation works best on a track with one point per second,
+    and uses the closest and second closest of these points to each gate.
+    Rather than resampling the whole flight, only the track segments that
+    could hold the n_pts closest one second points to each gate are
+    interpolated. A segment's distance from a gate is never more than that
+    of its one second points, so segments are added, closest first, until
+    none is left that is closer than the n_pts'th closest point found so
+    far. These points are then the same as with a full resample, even when
+    the track passes a gate more than once.
+    Inputs:
+        -   fd, a dict of flight data, such as that returned by
+            preproc_data()
+        -   rwy_list, a list of runways, defined in OS_Airports
+        -   n_pts, (optional) the number of closest points to each gate
+            that must match a full resample
+    Returns:
+        -   A dict of the interpolated points, with the same arrays as fd
+    """
+    times = fd['time']
+    npts = len(times)
+    if (npts < 2 or len(rwy_list) < 1):
+        return fd
+
+    # Distance from each gate to each segment between consecutive points
+    gates = RWY.table_of(rwy_list)['gate']
+    lat0 = fd['lats'][:-1, None]
+    lon0 = fd['lons'][:-1, None]
+    d_lat = np.diff(fd['lats'])[:, None]
+    d_lon = np.diff(fd['lons'])[:, None]
+    seg_len2 = d_lat * d_lat + d_lon * d_lon
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = (((gates[None, :, 0] - lat0) * d_lat +
+                 (gates[None, :, 1] - lon0) * d_lon) / seg_len2)
+    frac = np.clip(np.where(seg_len2 > 0, frac, 0.), 0., 1.)
+    c_lat = gates[None, :, 0] - (lat0 + frac * d_lat)
+    c_lon = gates[None, :, 1] - (lon0 + frac * d_lon)
+    segd = c_lat * c_lat + c_lon * c_lon
+    segd = np.where(segd == segd, segd, np.inf)
+
+    # Start from the closest segment to each gate, then add every segment
+    # that could hold a point closer than the n_pts'th closest so far
+    use = np.zeros(segd.shape, dtype=np.bool_)
+    use[np.argmin(segd, axis=0), np.arange(len(gates))] = True
+    while True:
+        best = np.flatnonzero(np.any(use, axis=1))
+        t_new = np.unique(np.concatenate([np.arange(times[i],
+                                                    times[i + 1] + 1)
+                                          for i in best]))
+        p_lat = np.interp(t_new, times, fd['lats'])[:, None] - gates[:, 0]
+        p_lon = np.interp(t_new, times, fd['lons'])[:, None] - gates[:, 1]
+        ptd = p_lat * p_lat + p_lon * p_lon
+        ptd = np.where(ptd == ptd, ptd, np.inf)
+        if (len(t_new) > n_pts):
+            lim = np.partition(ptd, n_pts - 1, axis=0)[n_pts - 1]
+        else:
+            lim = np.full(len(gates), np.inf)
+        # Allow for rounding in the segment distances
+        add = (segd <= lim * (1 + 1e-9) + 1e-18) & ~use
+        if (not np.any(add)):
+            break
+        use = use | add
+
+    fd2 = {}
+    for col in ['lats', 'lons', 'alts', 'spds', 'gals', 'rocs']:
+        fd2[col] = np.interp(t_new, times, fd[col])
+    # Headings are interpolated in the 0 -> 360 range, as 'traffic' does
+    hdgs = np.interp(t_new, times, np.mod(fd['hdgs'], 360.))
+    fd2['hdgs'] = np.where(hdgs > 180., hdgs - 360., hdgs)
+    pos = np.clip(np.searchsorted(times, t_new, side='right') - 1, 0, npts - 1)
+    fd2['ongd'] = fd['ongd'][pos]
+    fd2['time'] = t_new
+    fd2['call'] = fd['call']
+    fd2['ic24'] = fd['ic24']
+
+    return fd2
+
+
+def proc_fl(flight, check_rwys, odirs, colormap, do_save, verbose):
+    """Filter, assign phases and determine go-around status for a given flight.
+
+    Inputs:
+        -   A 'traffic' flight object
+        -   A list storing potential landing runways to check, or None to
+            use the list given to init_worker()
+        -   A 4-element list specifying various output directories:
+            -   normal plot output
+            -   go-around plot output
+            -   normal numpy data output
+            -   go-around numpy data output
+        -   A dict of colours used for flightpath labelling
+        -   A boolean specifying whether to save data or not
+        -   A boolean specifying whether to use verbose mode
+    Returns:
+        -   A result record (see finish_fl), or -1 if the flight is skipped
+    """
+    if (check_rwys is None):
+        check_rwys = shared_rwys
+    check_rwys = RWY.as_runway_list(check_rwys)
+
+    OST.count('flights')
+    with OST.stage('prep'):
+        fd = prep_fl(flight, verbose)
+    if (fd is None):
         return -1
 
     # We don't care about take-offs, so find and exclude
-    takeoff = check_takeoff(fd)
+    with OST.stage('takeoff'):
+        takeoff = check_takeoff(fd)
     if takeoff:
+        OST.count('takeoffs')
         return -1
     # Use Junzi's labelling method to get flight phases
-    labels = do_labels(fd)
+    try:
+        with OST.stage('labels'):
+            labels = do_labels(fd)
+    except ValueError as e:
+        print("\t-\tUnable to label flight:", flight.callsign, e)
+        return -1
     if (np.all(labels == labels[0])):
         if verbose:
             print("\t-\tNo state change:", flight.callsign)
@@ -314,11 +693,41 @@ def proc_fl(flight, check_rwys, odirs, colormap, do_save, verbose):
 
     # Estimate which runway the flight is landing on (rwy), and at what
     # point in the data arrays it does so (posser).
-    rwy, posser = estimate_rwy(fd2, check_rwys, verbose)
-    rwy2, posser2 = estimate_rwy(fd, check_rwys, verbose)
+    with OST.stage('runway'):
+        rwy, posser = estimate_rwy(interp_near(fd, check_rwys),
+                                   check_rwys, verbose)
+        rwy2, posser2 = estimate_rwy(fd, check_rwys, verbose)
+
+        min_alt_pt = set_rdis(fd, rwy, verbose)
 
-    # If we can't estimate a runway, try using minimum altitude
-    # Either way, compute relative distances to the runway / minimum point
+    # Correct barometric altitudes
+    with OST.stage('metar'):
+        l_time = fd['strt'] + (fd['dura'] / 2)
+        l_time = pd.Timestamp(l_time, tz='UTC')
+        bmet, tdiff = find_closest_metar(l_time, get_metar_store())
+        correct_alts(fd, bmet, tdiff, l_time)
+
+    # Now the actual go-around check
+    with OST.stage('check_ga'):
+        ga_flag, gapt, gapts = check_ga(fd, True)
+
+    return finish_fl(fd, rwy, posser2, min_alt_pt, ga_flag, gapt,
+                     bmet, l_time, odirs, colormap, do_save, verbose,
+                     gapts=gapts)
+
+
+def set_rdis(fd, rwy, verbose):
+    """Compute the signed distance of each point to the landing runway.
+
+    If we can't estimate a runway the point of minimum altitude is used
+    instead. The result is stored in fd['rdis'], in km.
+    Inputs:
+        -   A dict of flight data, such as that returned by preproc_data()
+        -   The landing runway class, or None
+        -   A boolean specifying whether to use verbose mode
+    Returns:
+        -   The array position of the minimum altitude
+    """
     min_alt_pt = (np.nanmin(fd['alts']) == fd['alts']).nonzero()
     if (len(min_alt_pt[0]) > 0):
         min_alt_pt = min_alt_pt[0]
@@ -348,11 +757,21 @@ def proc_fl(flight, check_rwys, odirs, colormap, do_save, verbose):
     r_dis[0:pt] = r_dis[0:pt] * -1
     fd['rdis'] = r_dis
 
-    # Correct barometric altitudes
+    return min_alt_pt
+
+
+def correct_alts(fd, bmet, tdiff, l_time):
+    """Correct the barometric altitudes of a flight using a METAR.
+
+    Inputs:
+        -   A dict of flight data, such as that returned by preproc_data()
+        -   The closest METAR (as metobs), or None
+        -   The time difference to that METAR, in seconds
+        -   The time used to find the METAR
+    Returns:
+        -   Nothing, fd['alts'] is replaced with the corrected altitudes
+    """
     t_alt = fd['alts']
-    l_time = fd['strt'] + (fd['dura'] / 2)
-    l_time = pd.Timestamp(l_time, tz='UTC')
-    bmet, tdiff = find_closest_metar(l_time, metars)
     if (bmet is not None):
         t_alt = correct_baro(t_alt, bmet.temp, bmet.pres)
     else:
@@ -360,25 +779,56 @@ def proc_fl(flight, check_rwys, odirs, colormap, do_save, verbose):
               bmet, tdiff, l_time)
     fd['alts'] = t_alt
 
-    # Now the actual go-around check
-    ga_flag, gapt = check_ga(fd, True)
+
+def finish_fl(fd, rwy, posser2, min_alt_pt, ga_flag, gapt,
+              bmet, l_time, odirs, colormap, do_save, verbose,
+              np_out=None, plot_out=None, gapts=None):
+    """Save outputs and assemble the results for a processed flight.
+
+    Inputs:
+        -   A dict of flight data, with labels and runway distances added
+        -   The landing runway class, or None
+        -   The runway gate array position, as returned by estimate_rwy()
+        -   The array position of the minimum altitude
+        -   A boolean go-around flag and its array position, from check_ga()
+        -   The closest METAR (as metobs), or None
+        -   The time used to find the METAR
+        -   A 4-element list of output directories, see proc_fl()
+        -   A dict of colours used for flightpath labelling
+        -   A boolean specifying whether to save data or not
+        -   A boolean specifying whether to use verbose mode
+        -   (optional) A list to append the packed flight data to, as
+            (directory, meta, points), for writing to a flight_store. If
+            None the data is saved straight away with to_numpy().
+        -   (optional) A list to append plot payloads to, for drawing by
+            an OS_Render.render_queue. If None, plots are drawn here.
+        -   (optional) An int array of the positions of every go-around.
+            These and their times are saved with the flight data as
+            'gapts' and 'ga_times'.
+    Returns:
+        -   A result record (of OS_Results.res_dtype)
+    """
+    # Choose output directory based upon go-around flag
+    if (ga_flag):
+        odir_pl = odirs[1]
+        odir_np = odirs[3]
+    else:
+        odir_pl = odirs[0]
+        odir_np = odirs[2]
 
     # Make some plots if required, this needs a spline to smooth output
-    if do_save:
-        spldict = create_spline(fd, bpos=None)
-        # Choose output directory based upon go-around flag
-        if (ga_flag):
-            odir_pl = odirs[1]
-            odir_np = odirs[3]
-        else:
-            odir_pl = odirs[0]
-            odir_np = odirs[2]
-        OSO.do_plots(fd,
-                     spldict,
-                     colormap,
-                     odir_pl,
-                     rwy=rwy,
-                     bpos=None)
+    if (do_save and plot_out is not None):
+        plot_out.append(OSR.make_payload(fd, odir_pl, ga_flag))
+    elif do_save:
+        with OST.stage('spline'):
+            spldict = create_spline(fd, bpos=None)
+        with OST.stage('plot'):
+            OSO.do_plots(fd,
+                         spldict,
+                         colormap,
+                         odir_pl,
+                         rwy=rwy,
+                         bpos=None)
     if (ga_flag):
         ga_time = pd.Timestamp(fd['strt'] +
                                pd.Timedelta(seconds=fd['time'][gapt]),
@@ -420,23 +870,40 @@ def proc_fl(flight, check_rwys, odirs, colormap, do_save, verbose):
         lonvar = 0
         gspvar = 0
 
+    if (gapts is None):
+        gapts = np.array([gapt] if ga_flag else [], dtype=np.int64)
+    n_ga = len(gapts)
+    ga_times = [pd.Timestamp(fd['strt'] + pd.Timedelta(seconds=fd['time'][pt]),
+                             tz='UTC') for pt in gapts]
+
     # Return data to the calling function
     if rwy is not None:
-        garr = [ga_flag, fd['ic24'], fd['call'], l_time,
-                ga_time, rwy.name, fd['hdgs'][gapt],
-                fd['alts'][gapt], fd['lats'][gapt], fd['lons'][gapt],
-                gapt, rocvar, hdgvar, latvar, lonvar, gspvar,
-                bmet]
+        rwy_name = rwy.name
     else:
-        garr = [ga_flag, fd['ic24'], fd['call'], l_time,
-                ga_time, 'None', fd['hdgs'][gapt],
-                fd['alts'][gapt], fd['lats'][gapt], fd['lons'][gapt],
-                gapt, rocvar, hdgvar, latvar, lonvar, gspvar,
-                bmet]
+        rwy_name = 'None'
+    hdg = fd['hdgs'][gapt]
+    if (hdg < 0):
+        hdg = 360 + hdg
+    garr = OSRE.make_record(ga_flag, fd['ic24'], fd['call'], l_time,
+                            ga_time, rwy_name, hdg,
+                            fd['alts'][gapt], fd['lats'][gapt],
+                            fd['lons'][gapt], gapt,
+                            [rocvar, hdgvar, latvar, lonvar, gspvar],
+                            bmet, n_ga=n_ga)
     fd['posser'] = posser2
     fd['gapt'] = gapt
+    fd['gapts'] = gapts
+    fd['ga_times'] = ga_times
     fd['min_alt_pt'] = min_alt_pt
-    OSO.to_numpy(fd, odir_np)
+    with OST.stage('save'):
+        if (np_out is None):
+            OSO.to_numpy(fd, odir_np)
+        else:
+            meta, pts = OSO.pack_flight(fd)
+            np_out.append((odir_np, meta, pts))
+    OST.count('processed')
+    if (ga_flag):
+        OST.count('go_arounds', n_ga)
     if (verbose):
         print("\t-\tDONE")
     return garr
@@ -503,7 +970,7 @@ def preproc_data(flight, verbose):
         -   A flight produced by the 'traffic' library.
         -   A bool specifying verbose mode
     Returns:
-        A dict containing:
+        A flight_data (see OS_Flight), or None, containing:
         -   time: The time-since-first-contact for each datapoint
         -   lats: Reported latitude of each datapoint
         -   lons: Reported longitude
@@ -535,71 +1002,51 @@ def preproc_data(flight, verbose):
 
     if(len(f_data) < 5):
         return None
-    fdata = {}
 
     tmp = f_data['timestamp'].values
     ts = (tmp - np.datetime64('1970-01-01T00:00:00')) / np.timedelta64(1, 's')
-    times = ts.astype(np.int)
+    times = ts.astype(np.int64)
 
     # Correct headings into -180 -> 180 range
     hdgs = f_data['track'].values
-    pts = (hdgs > 180.).nonzero()
-    hdgs[pts] = hdgs[pts] - 360.
-
-    fdata['time'] = times - times[0]
-    fdata['lats'] = f_data['latitude'].values
-    fdata['lons'] = f_data['longitude'].values
-    fdata['alts'] = f_data['altitude'].values
-    fdata['spds'] = f_data['groundspeed'].values
-    fdata['gals'] = f_data['geoaltitude'].values
-    fdata['hdgs'] = hdgs
-    fdata['rocs'] = f_data['vertical_rate'].values
-    fdata['ongd'] = f_data['onground'].values
-
-    # The next bit is needed in case a flight crosses two pkl files, which are
-    # usually one hour long. So a flight going from 00:59 -> 01:00 is in two
-    # files, and due to multiprocessing the two segments may be reversed.
-    df_tmp = pd.DataFrame(fdata)
-    df_new = df_tmp.sort_values(by=['time'])
-
-    fdata['time'] = df_new['time'].values
-    fdata['lats'] = df_new['lats'].values
-    fdata['lons'] = df_new['lons'].values
-    fdata['alts'] = df_new['alts'].values
-    fdata['spds'] = df_new['spds'].values
-    fdata['gals'] = df_new['gals'].values
-    fdata['hdgs'] = df_new['hdgs'].values
-    fdata['rocs'] = df_new['rocs'].values
-    fdata['ongd'] = df_new['ongd'].values
-    fdata['call'] = flight.callsign
-    fdata['ic24'] = flight.icao24
-    fdata['strt'] = flight.start
-    fdata['stop'] = flight.stop
-    fdata['dura'] = flight.duration
+    hdgs = np.where(hdgs > 180., hdgs - 360., hdgs)
+
+    cols = {'time': times - times[0],
+            'lats': f_data['latitude'].values,
+            'lons': f_data['longitude'].values,
+            'alts': f_data['altitude'].values,
+            'spds': f_data['groundspeed'].values,
+            'gals': f_data['geoaltitude'].values,
+            'hdgs': hdgs,
+            'rocs': f_data['vertical_rate'].values,
+            'ongd': f_data['onground'].values}
+
+    # The data is sorted by time in case a flight crosses two pkl files,
+    # which are usually one hour long. So a flight going from 00:59 -> 01:00
+    # is in two files, and due to multiprocessing the two segments may be
+    # reversed.
+    order = np.argsort(cols['time'], kind='stable')
+    fdata = OSFL.from_columns(cols, order,
+                              call=flight.callsign,
+                              ic24=flight.icao24,
+                              strt=flight.start,
+                              stop=flight.stop,
+                              dura=flight.duration)
 
     return fdata
 
 
 def find_closest_metar(l_time, metars):
-    """Find the best-fitting metar from a dict that matches a specified time value.
+    """Find the best-fitting METAR in a store for a specified time value.
 
     Inputs:
         -   The time to match (datetime)
-        -   A dict of METARS, each as a metobs class
+        -   A metar_store, such as that returned by metar_parse.get_metars()
     Returns:
         The best metar (as metobs) and the time difference in seconds
 
     """
-    tdiff = 1e8
-    bmet = None
-
-    timelist = list(metars.keys())
-    in_time = l_time.to_pydatetime()
-    btim = min(timelist, key=lambda date: abs(in_time-date))
-    tdiff = abs((btim - in_time).total_seconds())
-    if (tdiff < 3600):
-        bmet = metars[btim]
-    return bmet, tdiff
+    return metars.find_closest(l_time, max_diff=3600)
 
 
 def correct_baro(balt, t0, p0):
@@ -629,12 +1076,88 @@ def correct_baro(balt, t0, p0):
     return alt
 
 
-def create_spline(fd, bpos=None):
+# The smoothed channels that create_spline() provides, and their data
+spline_cols = {'altspl': 'alts', 'spdspl': 'spds', 'rocspl': 'rocs',
+               'galspl': 'gals', 'hdgspl': 'hdgs', 'latspl': 'lats',
+               'lonspl': 'lons'}
+
+
+def smooth_channel(times, vals, method='spline', window=31, order=2):
+    """Smooth one channel of flight data.
+
+    Inputs:
+        -   times: The point times (s), in order
+        -   vals: The values to smooth
+        -   method: (optional) 'spline' for a smoothing spline, 'savgol'
+            for a Savitzky-Golay filter or 'window' for a moving average.
+            The last two are much quicker, and are applied on a one
+            second grid that is then sampled at the point times.
+        -   window: (optional) The filter window (s) for 'savgol'/'window'
+        -   order: (optional) The polynomial order for 'savgol'
+    Returns:
+        -   An array of smoothed values at each of times
+    """
+    if (method == 'spline'):
+        from scipy.interpolate import UnivariateSpline as UniSpl
+        return UniSpl(times, vals)(times)
+
+    grid = np.arange(times[0], times[-1] + 1.)
+    g_vals = np.interp(grid, times, vals)
+    win = min(window, len(grid))
+    if (win % 2 == 0):
+        win = win - 1
+    if (win < 3):
+        return np.asarray(vals, dtype=np.float64)
+    if (method == 'savgol'):
+        from scipy.signal import savgol_filter
+        g_vals = savgol_filter(g_vals, win, min(order, win - 1),
+                               mode='interp')
+    elif (method == 'window'):
+        # Moving average, with the window shrinking towards each end
+        csum = np.concatenate(([0.], np.cumsum(g_vals)))
+        half = win // 2
+        idx = np.arange(len(g_vals))
+        lo = np.maximum(idx - half, 0)
+        hi = np.minimum(idx + half + 1, len(g_vals))
+        g_vals = (csum[hi] - csum[lo]) / (hi - lo)
+    else:
+        raise ValueError('Unknown smoothing method: ' + str(method))
+    return np.interp(times, grid, g_vals)
+
+
+class spline_dict(dict):
+    """A dict of smoothed channels that are only computed when used.
+
+    The keys are those of spline_cols, so plotting code can use it just as
+    the dict that create_spline() used to fill in.
+    """
+
+    def __init__(self, fd, bpos, method):
+        """Setup the class, see create_spline()."""
+        dict.__init__(self)
+        self.fd = fd
+        self.bpos = bpos
+        self.method = method
+        self.times = np.asarray(fd['time'][0: bpos], dtype=np.float64)
+
+    def __missing__(self, name):
+        """Smooth a channel the first time it is used."""
+        if (name not in spline_cols):
+            raise KeyError(name)
+        vals = self.fd[spline_cols[name]][0: self.bpos]
+        self[name] = smooth_channel(self.times, vals, self.method)
+        return self[name]
+
+
+def create_spline(fd, bpos=None, method='spline'):
     """Create the splines needed for plotting smoothed lines on the output graphs.
 
+    Each channel is only smoothed when it is first used, so only those
+    that are plotted cost anything.
     Input:
         -   A dict of flight data, such as that returned by preproc_data()
         -   An int speicfying the max array value to use
+        -   (optional) The smoothing method, see smooth_channel()
     Returns:
         A dict containing:
         -   altspl
@@ -642,27 +1165,13 @@ def create_spline(fd, bpos=None):
         -   rocspl
         -   galspl
         -   hdgspl
+        -   latspl
+        -   lonspl
 
     """
-    spldict = {}
     if (bpos is None):
         bpos = len(fd['time'])
-    spldict['altspl'] = UniSpl(fd['time'][0: bpos],
-                               fd['alts'][0: bpos])(fd['time'][0: bpos])
-    spldict['spdspl'] = UniSpl(fd['time'][0: bpos],
-                               fd['spds'][0: bpos])(fd['time'][0: bpos])
-    spldict['rocspl'] = UniSpl(fd['time'][0: bpos],
-                               fd['rocs'][0: bpos])(fd['time'][0: bpos])
-    spldict['galspl'] = UniSpl(fd['time'][0: bpos],
-                               fd['gals'][0: bpos])(fd['time'][0: bpos])
-    spldict['hdgspl'] = UniSpl(fd['time'][0: bpos],
-                               fd['hdgs'][0: bpos])(fd['time'][0: bpos])
-    spldict['latspl'] = UniSpl(fd['time'][0: bpos],
-                               fd['lats'][0: bpos])(fd['time'][0: bpos])
-    spldict['lonspl'] = UniSpl(fd['time'][0: bpos],
-                               fd['lons'][0: bpos])(fd['time'][0: bpos])
-
-    return spldict
+    return spline_dict(fd, bpos, method)
 
 
 def do_labels(fd):
@@ -674,15 +1183,14 @@ def do_labels(fd):
         -   A dict of flight data, such as that returned by preproc_data()
     Returns:
         -   A numpy array containing categorised flight phases.
+    Raises:
+        -   ValueError if the flight can't be labelled
 
     """
-    try:
-        labels = flph.fuzzylabels(fd['time'], fd['alts'],
-                                  fd['spds'], fd['rocs'], twindow=15)
-    except Exception as e:
-        print("Error creating spline", e, fd['call'])
-        quit()
-    pts = (fd['ongd']).nonzero()
-    labels[pts] = 'GND'
+    labels, bad = OSPH.fuzzy_labels(fd['time'], fd['alts'], fd['spds'],
+                                    fd['rocs'], [0, len(fd['time'])],
+                                    ongd=fd['ongd'])
+    if (bad[0]):
+        raise ValueError('Non-finite flight data for ' + str(fd['call']))
 
     return labels
@@ -0,0 +1,193 @@
+"""A persistent record of the input files and flights already processed.
+
+The manifest is a SQLite database. Each processed flight is recorded once
+its results are written, and each input file is recorded (with its size,
+modification time and sha1) once every flight with data in it has been
+written. Both are tagged with a version computed from code_version and
+the settings in OS_Consts, so changing either causes a full reprocess.
+A rerun skips the completed files and flights, and appends to the
+existing outputs.
+
+A rerun starts reading a little before the first incomplete file, so
+that flights already under way at its start are rebuilt from their first
+point rather than from a tail fragment. Those flights have data in a
+completed file, so they were already written and are skipped.
+"""
+from datetime import datetime
+import OS_Consts as CNS
+import hashlib
+import sqlite3
+import os
+
+
+# Increase this when a code change alters the detection results
+code_version = '2'
+
+
+def get_version():
+    """Compute the version tag of the code and settings.
+
+    Returns:
+        -   A short hex string
+    """
+    sha = hashlib.sha1(code_version.encode())
+    for name in sorted(dir(CNS)):
+        if (name.startswith('_')):
+            continue
+        val = getattr(CNS, name)
+        if (isinstance(val, (int, float, str, list, tuple, bool))):
+            sha.update((name + '=' + repr(val) + ';').encode())
+    return sha.hexdigest()[0:16]
+
+
+def file_hash(inf):
+    """Compute the sha1 hash of a file's contents."""
+    sha = hashlib.sha1()
+    with open(inf, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_start(inf):
+    """Get the start time of an input file from its name.
+
+    Inputs:
+        -   inf: A downloaded file, such as 'OS_201908100000_VABB.pkl', or
+            a Parquet file, '<ICAO>/<YYYYMMDD>/<HH>.parquet'
+    Returns:
+        -   The start time as a datetime, or None if the name doesn't
+            match either layout
+    """
+    import OS_Parquet as OSPQ
+
+    _, hour = OSPQ.hour_from_name(inf)
+    if (hour is not None):
+        return hour
+    day = os.path.basename(os.path.dirname(inf))
+    try:
+        return datetime.strptime(day + os.path.basename(inf)[0:2],
+                                 "%Y%m%d%H")
+    except ValueError:
+        return None
+
+
+def flight_key(flight, airport=None):
+    """Create a string that identifies a 'traffic' flight.
+
+    Inputs:
+        -   A flight produced by the 'traffic' library
+        -   (optional) The ICAO code of the airport the flight is checked
+            against, when a flight can be checked against several
+    Returns:
+        -   A string of the icao24, callsign, start and stop times and
+            number of points, after the airport if given
+    """
+    parts = [str(flight.icao24), str(flight.callsign),
+             flight.start.strftime("%Y%m%d%H%M%S"),
+             flight.stop.strftime("%Y%m%d%H%M%S"),
+             str(len(flight.data))]
+    if (airport is not None):
+        parts = [airport] + parts
+    return '_'.join(parts)
+
+
+class manifest:
+    """A SQLite record of the processed input files and flights."""
+
+    def __init__(self, dbfile, version=None):
+        """Open (or create) the manifest.
+
+        Inputs:
+            -   dbfile: The SQLite database file
+            -   version: (optional) The version tag, see get_version()
+        """
+        if (version is None):
+            version = get_version()
+        self.version = version
+        self.conn = sqlite3.connect(dbfile)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                          'path TEXT PRIMARY KEY, size INTEGER, '
+                          'mtime INTEGER, sha1 TEXT, version TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS flights ('
+                          'fkey TEXT PRIMARY KEY, version TEXT)')
+        self.conn.commit()
+
+    def file_done(self, inf):
+        """Check whether an input file has been completely processed.
+
+        The file must be unchanged: the same size and either the same
+        modification time or the same sha1 hash.
+        """
+        row = self.conn.execute('SELECT size, mtime, sha1, version FROM '
+                                'files WHERE path=?', (inf,)).fetchone()
+        if (row is None or row[3] != self.version):
+            return False
+        stat = os.stat(inf)
+        if (row[0] != stat.st_size):
+            return False
+        if (row[1] == stat.st_mtime_ns):
+            return True
+        return row[2] == file_hash(inf)
+
+    def pending_files(self, files, gap=None):
+        """Return the files still to be processed, in their original order.
+
+        Everything from the first file that is not complete onwards is
+        returned, so that flights crossing into later files are rebuilt.
+        It is preceded by enough completed files to cover 'gap' seconds
+        (or by one file if the times can't be found from the names), so
+        that flights under way at the start of the first incomplete file
+        are joined up with their earlier points. Any flight with data in
+        these leading files was already written, and should be skipped,
+        see OS_Stream.stream_flights().
+        Inputs:
+            -   files: A time-ordered list of input filenames
+            -   gap: (optional) The time (s) to cover, defaults to
+                CNS.stream_gap
+        Returns:
+            -   The list of files to read
+            -   The number of completed files at its start
+        """
+        if (gap is None):
+            gap = CNS.stream_gap
+        for i, inf in enumerate(files):
+            if (not self.file_done(inf)):
+                break
+        else:
+            return [], 0
+        n_lead = 0
+        t_first = file_start(files[i])
+        while (n_lead < i):
+            n_lead += 1
+            t_lead = file_start(files[i - n_lead])
+            if (t_first is None or t_lead is None or
+                    (t_first - t_lead).total_seconds() >= gap):
+                break
+        return files[i - n_lead:], n_lead
+
+    def mark_files(self, files):
+        """Record a list of input files as completely processed."""
+        for inf in files:
+            stat = os.stat(inf)
+            self.conn.execute('INSERT OR REPLACE INTO files VALUES '
+                              '(?, ?, ?, ?, ?)',
+                              (inf, stat.st_size, stat.st_mtime_ns,
+                               file_hash(inf), self.version))
+        self.conn.commit()
+
+    def flight_done(self, fkey):
+        """Check whether a flight, given by flight_key(), was processed."""
+        row = self.conn.execute('SELECT version FROM flights WHERE fkey=?',
+                                (fkey,)).fetchone()
+        return row is not None and row[0] == self.version
+
+    def mark_flights(self, fkeys):
+        """Record a list of flights, given by flight_key(), as processed."""
+        self.conn.executemany('INSERT OR REPLACE INTO flights VALUES (?, ?)',
+                              [(fkey, self.version) for fkey in fkeys])
+        self.conn.commit()
+
+    def close(self):
+        """Close the manifest."""
+        self.conn.close()
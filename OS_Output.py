@@ -1,13 +1,17 @@
-"""A set of functions to plot and/or save flight trajectory information."""
+"""A set of functions to plot and/or save flight trajectory information.
+
+matplotlib is only imported when a plot is made, so that importing this
+module is cheap for processes that never plot.
+"""
+from datetime import datetime
+import OS_Airports.RWY as RWY
+import OS_Flight as OSFL
 import numpy as np
 import os
 
 # This line stops matplotlib messing up in terminal mode
 os.environ['QT_QPA_PLATFORM'] = 'offscreen'
 
-from matplotlib.lines import Line2D
-import matplotlib.pyplot as plt
-
 
 def do_plots(fd, spld, cmap, outdir, app_ylim=True,
              odpi=300, rwy=None, bpos=None):
@@ -28,6 +32,9 @@ def do_plots(fd, spld, cmap, outdir, app_ylim=True,
     Returns:
         -   Nothing
     """
+    from matplotlib.lines import Line2D
+    import matplotlib.pyplot as plt
+
     if bpos is None:
         bpos = len(fd['time'])
 
@@ -155,15 +162,7 @@ def make_yvals(dists, multis):
     Returns:
         -   A list of y values
     """
-    yvals = (np.power(dists, 6) * multis[0] +
-             np.power(dists, 5) * multis[1] +
-             np.power(dists, 4) * multis[2] +
-             np.power(dists, 3) * multis[3] +
-             np.power(dists, 2) * multis[4] +
-             np.power(dists, 1) * multis[5] +
-             multis[6])
-
-    return yvals
+    return RWY.eval_poly(np.asarray(dists), multis)
 
 
 def do_plots_dist(fd, spld, cmap, outdir,
@@ -187,11 +186,14 @@ def do_plots_dist(fd, spld, cmap, outdir,
     Returns:
         -   Nothing
     """
+    from matplotlib.lines import Line2D
+    import matplotlib.pyplot as plt
+
     if bpos is None:
         bpos = len(fd['time'])
 
     xlims = [-10., 0.1]
-    distlist = np.arange(xlims[0], xlims[1] + 0.01, 0.01)
+    distlist = RWY.env_grid
     if (rwy is not None):
         hdglim = [rwy.mainhdg - 5, rwy.mainhdg + 5]
     else:
@@ -218,9 +220,7 @@ def do_plots_dist(fd, spld, cmap, outdir,
                 c=colors,
                 lw=0)
     if (rwy is not None):
-        yvals1 = make_yvals(distlist, rwy.alts1)
-        yvalm = make_yvals(distlist, rwy.altm)
-        yvalp1 = make_yvals(distlist, rwy.altp1)
+        yvals1, yvalm, yvalp1 = rwy.get_envelope('alt')
         plt.plot(distlist, yvals1/1000., '-', color='k', lw=0.1)
         plt.plot(distlist, yvalm/1000., '-', color='k', lw=0.1)
         plt.plot(distlist, yvalp1/1000., '-', color='k', lw=0.1)
@@ -250,9 +250,7 @@ def do_plots_dist(fd, spld, cmap, outdir,
                 c=colors,
                 lw=0)
     if (rwy is not None):
-        yvals1 = make_yvals(distlist, rwy.rocs1)
-        yvalm = make_yvals(distlist, rwy.rocm)
-        yvalp1 = make_yvals(distlist, rwy.rocp1)
+        yvals1, yvalm, yvalp1 = rwy.get_envelope('roc')
         plt.plot(distlist, yvals1/1000., '-', color='k', lw=0.1)
         plt.plot(distlist, yvalm/1000., '-', color='k', lw=0.1)
         plt.plot(distlist, yvalp1/1000., '-', color='k', lw=0.1)
@@ -307,9 +305,7 @@ def do_plots_dist(fd, spld, cmap, outdir,
                 c=colors,
                 lw=0)
     if (rwy is not None):
-        yvals1 = make_yvals(distlist, rwy.hdgs1)
-        yvalm = make_yvals(distlist, rwy.hdgm)
-        yvalp1 = make_yvals(distlist, rwy.hdgp1)
+        yvals1, yvalm, yvalp1 = rwy.get_envelope('hdg')
         plt.plot(distlist, yvals1, '-', color='k', lw=0.1)
         plt.plot(distlist, yvalm, '-', color='k', lw=0.1)
         plt.plot(distlist, yvalp1, '-', color='k', lw=0.1)
@@ -339,9 +335,7 @@ def do_plots_dist(fd, spld, cmap, outdir,
                 c=colors,
                 lw=0)
     if (rwy is not None):
-        yvals1 = make_yvals(distlist, rwy.lons1)
-        yvalm = make_yvals(distlist, rwy.lonm)
-        yvalp1 = make_yvals(distlist, rwy.lonp1)
+        yvals1, yvalm, yvalp1 = rwy.get_envelope('lon')
         plt.plot(distlist, yvals1, '-', color='k', lw=0.1)
         plt.plot(distlist, yvalm, '-', color='k', lw=0.1)
         plt.plot(distlist, yvalp1, '-', color='k', lw=0.1)
@@ -370,9 +364,7 @@ def do_plots_dist(fd, spld, cmap, outdir,
                 c=colors,
                 lw=0)
     if (rwy is not None):
-        yvals1 = make_yvals(distlist, rwy.lats1)
-        yvalm = make_yvals(distlist, rwy.latm)
-        yvalp1 = make_yvals(distlist, rwy.latp1)
+        yvals1, yvalm, yvalp1 = rwy.get_envelope('lat')
         plt.plot(distlist, yvals1, '-', color='k', lw=0.1)
         plt.plot(distlist, yvalm, '-', color='k', lw=0.1)
         plt.plot(distlist, yvalp1, '-', color='k', lw=0.1)
@@ -415,4 +407,263 @@ def to_numpy(fd, outdir):
     outf = odir + 'FLT_' + fd['ic24'] + '_'
     outf = outf + fd['call'] + '_'
     outf = outf + fd['stop'].strftime("%Y%m%d%H%m") + '.pkl'
+    # Saved as a plain dict, so it can be loaded without this package
+    if (hasattr(fd, 'to_dict')):
+        fd = fd.to_dict()
     np.save(outf, fd)
+
+
+# The per-point record stored in the daily flight files
+pt_dtype = np.dtype([('time', np.int64),
+                     ('lats', np.float64),
+                     ('lons', np.float64),
+                     ('alts', np.float64),
+                     ('spds', np.float64),
+                     ('gals', np.float64),
+                     ('hdgs', np.float64),
+                     ('rocs', np.float64),
+                     ('rdis', np.float64),
+                     ('ongd', np.bool_),
+                     ('labl', 'S3')])
+
+# The columns of the daily index files. 'gapts' and 'ga_times' list the
+# position and time of every go-around in the flight, separated by ';'
+idx_cols = ['ic24', 'call', 'strt', 'stop', 'offset', 'length',
+            'rwy', 'posser', 'gapt', 'min_alt_pt', 'gapts', 'ga_times']
+
+# The columns of the index that hold a single integer
+idx_ints = ['offset', 'length', 'posser', 'gapt', 'min_alt_pt']
+
+
+def pack_flight(fd):
+    """Pack a flight into a compact form for the daily flight files.
+
+    Input:
+        -   fd: Dict containing flight info, as saved by to_numpy()
+    Returns:
+        -   A dict of the per-flight values, keyed by idx_cols
+        -   A structured array of the per-point values, with pt_dtype
+    """
+    pts = np.zeros(len(fd['time']), dtype=pt_dtype)
+    for col in pt_dtype.names:
+        if (col == 'labl'):
+            pts[col] = np.char.encode(np.asarray(fd[col], dtype=str))
+        elif (col in fd):
+            pts[col] = fd[col]
+    meta = {'ic24': fd['ic24'],
+            'call': fd['call'],
+            'strt': fd['strt'].strftime("%Y-%m-%dT%H:%M:%S"),
+            'stop': fd['stop'].strftime("%Y-%m-%dT%H:%M:%S"),
+            'rwy': fd.get('rwy', 'None'),
+            'posser': int(fd.get('posser', -1)),
+            'gapt': int(fd.get('gapt', 0)),
+            'min_alt_pt': int(fd.get('min_alt_pt', -1)),
+            'gapts': ';'.join([str(int(pt)) for pt in fd.get('gapts', [])]),
+            'ga_times': ';'.join([t_val.strftime("%Y-%m-%dT%H:%M:%S")
+                                  for t_val in fd.get('ga_times', [])])}
+    return meta, pts
+
+
+class flight_store:
+    """Writes processed flights into one binary table per day.
+
+    For each output directory and day there are two files:
+        FLIGHTS_YYYYMMDD.dat - the points of every flight, as pt_dtype
+                               records appended one flight after another
+        FLIGHTS_YYYYMMDD.idx - a CSV index with one line per flight giving
+                               the offset and length of its points and
+                               the position and time of every go-around
+    Only one process should write to a given directory. The points are
+    written before the index line, so a crash can at worst leave some
+    unindexed points at the end of the table, or a partial last line in
+    the index. Both are removed when the files are next opened, see
+    repair().
+    """
+
+    def __init__(self):
+        """Setup the class."""
+        self.files = {}
+        # The open files written to since the last sync()
+        self.dirty = set()
+
+    def get_files(self, outdir, day):
+        """Return the open data and index files for a directory and day."""
+        key = (outdir, day)
+        if (key in self.files):
+            return self.files[key]
+        if (not os.path.exists(outdir)):
+            os.makedirs(outdir, exist_ok=True)
+        datf = outdir + 'FLIGHTS_' + day + '.dat'
+        idxf = outdir + 'FLIGHTS_' + day + '.idx'
+        n_rec = self.repair(datf, idxf)
+        datfid = open(datf, 'ab')
+        idxfid = open(idxf, 'a')
+        if (idxfid.tell() == 0):
+            idxfid.write(','.join(idx_cols) + '\n')
+        self.files[key] = [datfid, idxfid, n_rec]
+        return self.files[key]
+
+    def repair(self, datf, idxf):
+        """Remove anything left by an interrupted write to a daily file.
+
+        The index is cut back to its last complete line, and any lines
+        whose points are not all in the table are dropped. The table is
+        then cut back to the end of the last indexed flight.
+        Inputs:
+            -   datf, idxf: The table and index files
+        Returns:
+            -   The number of points in the table
+        """
+        n_dat = 0
+        if (os.path.exists(datf)):
+            n_dat = os.path.getsize(datf) // pt_dtype.itemsize
+        if (not os.path.exists(idxf)):
+            lines = []
+        else:
+            with open(idxf, 'r') as fid:
+                text = fid.read()
+            lines = text[0:text.rfind('\n') + 1].splitlines(True)
+            if (len(lines) > 0 and
+                    lines[0].rstrip('\n').split(',') != idx_cols):
+                raise ValueError(idxf + " has different columns to this "
+                                 "version, move it aside to carry on")
+
+        # Keep the complete index lines whose points are in the table
+        keep = lines[0:1]
+        n_rec = 0
+        pos = {col: i for i, col in enumerate(idx_cols)}
+        for line in lines[1:]:
+            vals = line.rstrip('\n').split(',')
+            if (len(vals) != len(idx_cols)):
+                continue
+            end = int(vals[pos['offset']]) + int(vals[pos['length']])
+            if (end > n_dat):
+                continue
+            keep.append(line)
+            n_rec = max(n_rec, end)
+        if (os.path.exists(idxf) and ''.join(keep) != text):
+            tmpf = idxf + '.tmp'
+            with open(tmpf, 'w') as fid:
+                fid.write(''.join(keep))
+            os.replace(tmpf, idxf)
+        if (os.path.exists(datf) and
+                os.path.getsize(datf) != n_rec * pt_dtype.itemsize):
+            with open(datf, 'r+b') as fid:
+                fid.truncate(n_rec * pt_dtype.itemsize)
+        return n_rec
+
+    def add(self, outdir, meta, pts):
+        """Append a packed flight to the store.
+
+        Inputs:
+            -   outdir: The output directory
+            -   meta, pts: The packed flight, as from pack_flight()
+        """
+        day = meta['stop'][0:10].replace('-', '')
+        files = self.get_files(outdir, day)
+        datfid, idxfid, n_rec = files
+        datfid.write(pts.tobytes())
+        datfid.flush()
+        meta = dict(meta)
+        meta['offset'] = n_rec
+        meta['length'] = len(pts)
+        idxfid.write(','.join([str(meta[col]) for col in idx_cols]) + '\n')
+        idxfid.flush()
+        files[2] = n_rec + len(pts)
+        self.dirty.add((outdir, day))
+
+    def sync(self):
+        """Make sure every flight added so far is on disk.
+
+        This must be called before the flights are recorded as done in
+        the manifest, so that a power loss cannot leave a flight marked
+        as done without its points and index line.
+        """
+        for key in self.dirty:
+            datfid, idxfid, n_rec = self.files[key]
+            os.fsync(datfid.fileno())
+            os.fsync(idxfid.fileno())
+        self.dirty = set()
+
+    def close(self):
+        """Close all open files."""
+        self.sync()
+        for key in self.files:
+            self.files[key][0].close()
+            self.files[key][1].close()
+        self.files = {}
+
+
+def read_index(outdir, day):
+    """Read the index of a daily flight file.
+
+    Inputs:
+        -   outdir: The output directory
+        -   day: The day, as a YYYYMMDD string
+    Returns:
+        -   A list of dicts, one per flight, keyed by idx_cols
+    """
+    idxf = outdir + 'FLIGHTS_' + day + '.idx'
+    flights = []
+    with open(idxf, 'r') as fid:
+        cols = fid.readline().rstrip('\n').split(',')
+        for line in fid:
+            vals = line.rstrip('\n').split(',')
+            if (len(vals) != len(cols)):
+                continue
+            meta = dict(zip(cols, vals))
+            for col in idx_ints:
+                meta[col] = int(meta[col])
+            meta['gapts'] = np.array([int(pt) for pt in
+                                      meta.get('gapts', '').split(';')
+                                      if pt != ''], dtype=np.int64)
+            ga_times = meta.get('ga_times', '').split(';')
+            meta['ga_times'] = [datetime.strptime(t_val, "%Y-%m-%dT%H:%M:%S")
+                                for t_val in ga_times if t_val != '']
+            flights.append(meta)
+    return flights
+
+
+def load_flight(outdir, day, ic24, call=None, stop=None):
+    """Load a single flight from a daily flight file.
+
+    Only the selected flight's points are read, via a memory map.
+    Inputs:
+        -   outdir: The output directory
+        -   day: The day, as a YYYYMMDD string
+        -   ic24: The icao24 code of the flight
+        -   call: (optional) The callsign of the flight
+        -   stop: (optional) The stop time of the flight, as a datetime
+    Returns:
+        -   A flight_data (see OS_Flight), similar to that saved by
+            to_numpy(), or None if no matching flight is found. If several
+            flights match, the last one is returned.
+    """
+    if (stop is not None):
+        stop = stop.strftime("%Y-%m-%dT%H:%M:%S")
+    best = None
+    for meta in read_index(outdir, day):
+        if (meta['ic24'] != ic24):
+            continue
+        if (call is not None and meta['call'] != call):
+            continue
+        if (stop is not None and meta['stop'] != stop):
+            continue
+        best = meta
+    if (best is None):
+        return None
+
+    datf = outdir + 'FLIGHTS_' + day + '.dat'
+    recs = np.memmap(datf, dtype=pt_dtype, mode='r')
+    pts = recs[best['offset']:best['offset'] + best['length']]
+    fd = OSFL.flight_data()
+    for col in pt_dtype.names:
+        if (col == 'labl'):
+            fd[col] = np.char.decode(pts[col])
+        else:
+            fd[col] = np.array(pts[col])
+    for col in idx_cols:
+        fd[col] = best.get(col)
+    fd['strt'] = datetime.strptime(best['strt'], "%Y-%m-%dT%H:%M:%S")
+    fd['stop'] = datetime.strptime(best['stop'], "%Y-%m-%dT%H:%M:%S")
+    return fd
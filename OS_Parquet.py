@@ -0,0 +1,235 @@
+"""Conversion and reading of OpenSky data in a partitioned Parquet layout.
+
+Each hour of data is stored as a single Parquet file at:
+    <top_dir>/<ICAO>/<YYYYMMDD>/<HH>.parquet
+where <ICAO> is the region name, the ICAO codes joined by '_', for data
+covering several airports.
+Only the columns needed for go-around detection are kept. Files are read
+with column projection and memory-mapping, and altitude and time filters
+can be pushed down to the Parquet row groups, so that a reader only
+touches the data it needs. Detection reads every point, as filtering a
+flight uses the points either side of those that are kept.
+
+This requires the pyarrow library.
+"""
+from datetime import datetime
+import pandas as pd
+import glob
+import os
+
+
+# The columns used during go-around detection
+read_cols = ['timestamp', 'icao24', 'callsign', 'latitude', 'longitude',
+             'altitude', 'geoaltitude', 'groundspeed', 'track',
+             'vertical_rate', 'onground', 'last_position']
+
+# Rows per row group, smaller groups allow more effective filtering
+row_group_size = 65536
+
+
+def get_outname(top_dir, icao, hour):
+    """Get the output filename for an hour of data.
+
+    Inputs:
+        -   top_dir: The top level output directory
+        -   icao: The ICAO code of the airport
+        -   hour: A datetime for the start of the hour
+    Returns:
+        -   The filename as a string
+    """
+    return os.path.join(top_dir, icao, hour.strftime("%Y%m%d"),
+                        hour.strftime("%H") + '.parquet')
+
+
+def hour_from_name(inf):
+    """Get the start time of a downloaded file from its name.
+
+    The names are those written by OpenSky_Get_Data, such as
+    'OS_201908100000_VABB.pkl', or 'OS_201908100000_VABB_KIAD.pkl' for a
+    region of several airports (see OS_Registry).
+    Input:
+        -   inf: The filename
+    Returns:
+        -   The ICAO code or region name and start time, or None, None if
+            the name does not match
+    """
+    parts = os.path.basename(inf).split('.')[0].split('_')
+    if (len(parts) < 3):
+        return None, None
+    try:
+        hour = datetime.strptime(parts[1], "%Y%m%d%H%M")
+    except ValueError:
+        return None, None
+    return '_'.join(parts[2:]), hour
+
+
+def write_frame(df, outf):
+    """Write a DataFrame of flight data to a Parquet file.
+
+    The data is sorted by time so that the row group statistics allow
+    time filters to skip most of the file. The file is written to a
+    temporary name and then moved, so readers never see a partial file.
+    Inputs:
+        -   df: A DataFrame of OpenSky data
+        -   outf: The output filename
+    """
+    import pyarrow.parquet as pq
+    import pyarrow as pa
+
+    cols = [col for col in read_cols if col in df.columns]
+    df = df[cols].sort_values(by=['timestamp'])
+    odir = os.path.dirname(outf)
+    if (not os.path.exists(odir)):
+        os.makedirs(odir, exist_ok=True)
+    tmpf = outf + '.' + str(os.getpid()) + '.tmp'
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table, tmpf, row_group_size=row_group_size)
+    os.replace(tmpf, outf)
+
+
+def same_flights(inf, outf):
+    """Check that two data files give the same flights for detection.
+
+    Both files are read with OS_Funcs.get_flight(), so this checks that
+    the columns and points that are kept give the same cleaned, filtered
+    and split flights.
+    Inputs:
+        -   inf: A downloaded pickle
+        -   outf: The Parquet file converted from it
+    Returns:
+        -   True if the flights and their data are the same
+    """
+    import OS_Funcs as OSF
+
+    fls = []
+    for fname in [inf, outf]:
+        flights = {}
+        for flight in OSF.get_flight(fname):
+            f_data = flight.data.sort_values(by=['timestamp'])
+            f_data = f_data[[col for col in read_cols
+                             if col in f_data.columns]]
+            key = (flight.icao24, flight.callsign, f_data['timestamp'].min())
+            flights[key] = f_data.reset_index(drop=True)
+        fls.append(flights)
+    if (sorted(fls[0].keys()) != sorted(fls[1].keys())):
+        return False
+    for key, f_data in fls[0].items():
+        if (not f_data.equals(fls[1][key])):
+            return False
+    return True
+
+
+def convert_pickle(inf, top_dir, icao=None, verify=False):
+    """Convert a downloaded 'traffic' pickle into the Parquet layout.
+
+    Inputs:
+        -   inf: The input pickle, as written by OpenSky_Get_Data
+        -   top_dir: The top level output directory
+        -   icao: (optional) The airport ICAO code, taken from the
+            filename if not given
+        -   verify: (optional) True to check that the converted file
+            gives the same flights as the pickle, see same_flights(). A
+            file that doesn't is removed.
+    Returns:
+        -   The output filename, or None if the input can't be converted
+    """
+    from traffic.core import Traffic
+
+    f_icao, hour = hour_from_name(inf)
+    if (icao is None):
+        icao = f_icao
+    traf = Traffic.from_file(inf)
+    if (traf is None or icao is None):
+        print("Unable to convert:", inf)
+        return None
+    df = traf.data
+    if (hour is None):
+        hour = df['timestamp'].min().floor('H').to_pydatetime()
+    outf = get_outname(top_dir, icao, hour)
+    write_frame(df, outf)
+    if (verify and not same_flights(inf, outf)):
+        print("Converted file gives different flights:", inf)
+        os.remove(outf)
+        return None
+    return outf
+
+
+def convert_dir(indir, top_dir, icao=None, verify=False):
+    """Convert every downloaded pickle in a directory.
+
+    Inputs:
+        -   indir: The directory containing the pickles
+        -   top_dir: The top level output directory
+        -   icao: (optional) The airport ICAO code
+        -   verify: (optional) True to check each converted file, see
+            convert_pickle()
+    Returns:
+        -   A list of the files written
+    """
+    files = glob.glob(os.path.join(indir, '*.pkl'))
+    files.sort()
+    outfs = []
+    for inf in files:
+        outf = convert_pickle(inf, top_dir, icao, verify)
+        if (outf is not None):
+            outfs.append(outf)
+    return outfs
+
+
+def list_files(top_dir, icao):
+    """List the Parquet files for an airport in time order.
+
+    Inputs:
+        -   top_dir: The top level directory
+        -   icao: The airport ICAO code
+    Returns:
+        -   A sorted list of filenames
+    """
+    files = glob.glob(os.path.join(top_dir, icao, '*', '*.parquet'))
+    files.sort()
+    return files
+
+
+def to_utc(t_val):
+    """Convert a time into a UTC pandas Timestamp, naive times are UTC."""
+    t_val = pd.Timestamp(t_val)
+    if (t_val.tzinfo is None):
+        return t_val.tz_localize('UTC')
+    return t_val.tz_convert('UTC')
+
+
+def read_frame(inf, columns=None, max_alt=None, start=None, stop=None):
+    """Read flight data from a Parquet file.
+
+    Inputs:
+        -   inf: The input filename
+        -   columns: (optional) The columns to read, defaults to read_cols
+        -   max_alt: (optional) Only read points below this barometric
+            altitude
+        -   start: (optional) Only read points at or after this time
+        -   stop: (optional) Only read points before this time
+    Returns:
+        -   A pandas DataFrame
+    """
+    import pyarrow.parquet as pq
+
+    if (columns is None):
+        columns = read_cols
+    # Older files may not have every column
+    names = pq.read_schema(inf, memory_map=True).names
+    columns = [col for col in columns if col in names]
+    filters = []
+    if (max_alt is not None):
+        filters.append(('altitude', '<', max_alt))
+    if (start is not None):
+        filters.append(('timestamp', '>=', to_utc(start)))
+    if (stop is not None):
+        filters.append(('timestamp', '<', to_utc(stop)))
+    if (len(filters) < 1):
+        filters = None
+
+    table = pq.read_table(inf,
+                          columns=columns,
+                          filters=filters,
+                          memory_map=True)
+    return table.to_pandas()
@@ -0,0 +1,211 @@
+"""Fuzzy flight phase labelling, for a batch of flights at once.
+
+This follows the method of Junzi Sun's 'flightphase' module (from the
+flight-data-processor library): each flight is cut into windows of
+'twindow' seconds, and the mean altitude, speed and vertical rate of each
+window are given fuzzy memberships. Five rules (ground, climb, descent,
+cruise and level) are combined and defuzzified by the largest of maximum
+to give the label. As in the original, the final window of each flight is
+labelled 'NA'.
+
+The membership functions are computed once, and every window of every
+flight is then labelled with array operations. The labels are the same as
+those of flightphase.fuzzylabels(), except that a window whose mean lies
+within floating point rounding of a membership breakpoint may differ, as
+the means here are taken with np.add.reduceat rather than np.mean(). A
+flight with non-finite values is reported rather than labelled.
+"""
+import numpy as np
+
+
+# The grids the membership functions are defined on
+# alt: ft, spd: kts, roc: fpm
+alt_range = np.arange(0, 40000, 1)
+spd_range = np.arange(0, 600, 1)
+roc_range = np.arange(-4000, 4000, 0.1)
+state_range = np.arange(0, 6, 0.01)
+
+# The output state of each rule, in order, and the label of each state
+rule_states = [1, 2, 3, 4, 5]
+state_labels = np.array(['NA', 'GND', 'CL', 'DE', 'CR', 'LVL', 'NA'])
+
+# The membership functions, see get_mfs()
+mfs = None
+
+
+def gaussmf(x, mean, sigma):
+    """A gaussian membership function."""
+    return np.exp(-((x - mean)**2.) / (2 * sigma**2.))
+
+
+def smf(x, a, b):
+    """An S-shaped membership function, rising from 0 at a to 1 at b."""
+    y = np.ones(len(x))
+    y[x <= a] = 0
+    idx = np.logical_and(a <= x, x <= (a + b) / 2.)
+    y[idx] = 2. * ((x[idx] - a) / (b - a)) ** 2.
+    idx = np.logical_and((a + b) / 2. <= x, x <= b)
+    y[idx] = 1 - 2. * ((x[idx] - b) / (b - a)) ** 2.
+    return y
+
+
+def zmf(x, a, b):
+    """A Z-shaped membership function, falling from 1 at a to 0 at b."""
+    y = np.ones(len(x))
+    idx = np.logical_and(a <= x, x < (a + b) / 2.)
+    y[idx] = 1 - 2. * ((x[idx] - a) / (b - a)) ** 2.
+    idx = np.logical_and((a + b) / 2. <= x, x <= b)
+    y[idx] = 2. * ((x[idx] - b) / (b - a)) ** 2.
+    y[x >= b] = 0
+    return y
+
+
+def get_mfs():
+    """Return the membership functions, computing them on first use.
+
+    Returns:
+        -   A dict of the input membership functions, each an array on
+            the matching range, and 'state', the right-hand side of each
+            rule's output membership function from its peak onwards
+    """
+    global mfs
+    if (mfs is not None):
+        return mfs
+
+    mfs = {}
+    mfs['alt_gnd'] = zmf(alt_range, 0, 200)
+    mfs['alt_lo'] = gaussmf(alt_range, 10000, 10000)
+    mfs['alt_hi'] = gaussmf(alt_range, 35000, 20000)
+
+    mfs['spd_hi'] = gaussmf(spd_range, 600, 100)
+    mfs['spd_md'] = gaussmf(spd_range, 300, 100)
+    mfs['spd_lo'] = gaussmf(spd_range, 0, 50)
+
+    mfs['roc_zero'] = gaussmf(roc_range, 0, 100)
+    mfs['roc_plus'] = smf(roc_range, 10, 1000)
+    mfs['roc_minus'] = zmf(roc_range, -1000, -10)
+
+    # The output functions decrease to the right of their peak, so the
+    # largest state value at which one reaches a given level can be found
+    # with searchsorted
+    mfs['state'] = []
+    for state in rule_states:
+        smem = gaussmf(state_range, state, 0.1)
+        peak = int(np.argmax(smem))
+        mfs['state'].append((peak, -smem[peak:]))
+    return mfs
+
+
+def window_means(times, vals, offs, twindow):
+    """Find the time windows of each flight and average values over them.
+
+    Inputs:
+        -   times: The point times, flights one after another. The times
+            within each flight must be in order.
+        -   vals: A list of arrays to average, the same shape as times
+        -   offs: The flight offsets
+        -   twindow: The window length (s)
+    Returns:
+        -   An int array of the first position of each window
+        -   An int array of the number of points in each window
+        -   A bool array, True for the last window of each flight
+        -   A list of arrays of the mean of each of vals in each window
+    """
+    offs = np.asarray(offs)
+    lens = np.diff(offs)
+    seg = np.repeat(np.arange(len(lens)), lens)
+    t0 = np.asarray(times)[offs[:-1][lens > 0]]
+    t0 = np.repeat(t0, lens[lens > 0])
+    twin = (np.asarray(times) - t0) // twindow
+
+    new_win = np.ones(len(twin), dtype=bool)
+    new_win[1:] = (twin[1:] != twin[:-1]) | (seg[1:] != seg[:-1])
+    starts = np.flatnonzero(new_win)
+    counts = np.diff(np.append(starts, len(twin)))
+    last = np.ones(len(starts), dtype=bool)
+    last[:-1] = seg[starts[1:]] != seg[starts[:-1]]
+
+    means = [np.add.reduceat(np.asarray(val, dtype=np.float64), starts)
+             / counts for val in vals]
+    return starts, counts, last, means
+
+
+def fuzzy_labels(times, alts, spds, rocs, offs, ongd=None, twindow=15):
+    """Label the flight phase of every point in a batch of flights.
+
+    Inputs:
+        -   times, alts, spds, rocs: The point times (s), barometric
+            altitudes (ft), ground speeds (kts) and vertical rates (fpm),
+            with the flights one after another
+        -   offs: The flight offsets, flight i is at offs[i]:offs[i+1]
+        -   ongd: (optional) A bool array, points that are on the ground
+            are labelled 'GND'
+        -   twindow: (optional) The window length (s)
+    Returns:
+        -   An array of labels, one per point
+        -   A bool array, True for flights that could not be labelled
+            because they contain non-finite values. All their points are
+            labelled 'NA'.
+    """
+    offs = np.asarray(offs)
+    n_pts = len(times)
+    labels = np.full(n_pts, 'NA', dtype='<U3')
+    if (n_pts < 1):
+        return labels, np.zeros(len(offs) - 1, dtype=bool)
+    for arr in [alts, spds, rocs]:
+        if (len(arr) != n_pts):
+            raise ValueError('All input arrays must have the same length')
+
+    mf = get_mfs()
+    starts, counts, last, means = window_means(times, [alts, spds, rocs],
+                                               offs, twindow)
+    alt = np.clip(means[0], alt_range[0], alt_range[-1])
+    spd = np.clip(means[1], spd_range[0], spd_range[-1])
+    roc = np.clip(means[2], roc_range[0], roc_range[-1])
+
+    alt_gnd = np.interp(alt, alt_range, mf['alt_gnd'])
+    alt_lo = np.interp(alt, alt_range, mf['alt_lo'])
+    alt_hi = np.interp(alt, alt_range, mf['alt_hi'])
+    spd_hi = np.interp(spd, spd_range, mf['spd_hi'])
+    spd_md = np.interp(spd, spd_range, mf['spd_md'])
+    spd_lo = np.interp(spd, spd_range, mf['spd_lo'])
+    roc_zero = np.interp(roc, roc_range, mf['roc_zero'])
+    roc_plus = np.interp(roc, roc_range, mf['roc_plus'])
+    roc_minus = np.interp(roc, roc_range, mf['roc_minus'])
+
+    # The strength of each rule, in the order of rule_states
+    rules = np.vstack([np.minimum(np.minimum(alt_gnd, roc_zero), spd_lo),
+                       np.minimum(np.minimum(alt_lo, roc_plus), spd_md),
+                       np.minimum(np.minimum(alt_lo, roc_minus), spd_md),
+                       np.minimum(np.minimum(alt_hi, roc_zero), spd_hi),
+                       np.minimum(np.minimum(alt_lo, roc_zero), spd_md)])
+
+    # Defuzzify by the largest of maximum. The aggregated output peaks at
+    # the strongest rule strength, and its largest maximum is the furthest
+    # point at which one of the strongest rules' outputs reaches it.
+    best = np.max(rules, axis=0)
+    lom = np.zeros(len(best))
+    for i, (peak, neg_mem) in enumerate(mf['state']):
+        n_above = np.searchsorted(neg_mem, -best, side='right')
+        s_val = state_range[peak + np.maximum(n_above, 1) - 1]
+        lom = np.where(rules[i] == best, np.maximum(lom, s_val), lom)
+    # If no rule fires the output is zero everywhere, and its largest
+    # maximum is the end of the range
+    lom = np.where(best > 0, lom, state_range[-1])
+    state = np.clip(np.round(lom).astype(np.int64), 1, 6)
+
+    win_lab = state_labels[state]
+    win_lab[last] = 'NA'
+    labels = np.repeat(win_lab, counts)
+
+    # Flights with non-finite values can't be labelled
+    lens = np.diff(offs)
+    seg = np.repeat(np.arange(len(lens)), lens)
+    finite = np.isfinite(alts) & np.isfinite(spds) & np.isfinite(rocs)
+    bad = np.bincount(seg[~finite], minlength=len(lens)) > 0
+    labels[bad[seg]] = 'NA'
+
+    if (ongd is not None):
+        labels[np.asarray(ongd, dtype=bool) & ~bad[seg]] = 'GND'
+
+    return labels, bad
@@ -0,0 +1,173 @@
+"""A registry of the airport definitions in OS_Airports.
+
+Every '<ICAO>.json' definition in the OS_Airports package is an airport,
+as is every module there that defines 'rwy_list' and 'icao_name'. A
+region of several airports can then be processed in a single pass over
+its data: airport_index finds which airports' approach corridors each
+flight enters, and the flight is checked against the runways of each of
+those airports.
+
+An airport may set 'metar_file' to give its own METAR source,
+otherwise the file '<ICAO>_METAR' in a METAR directory is used.
+"""
+import OS_Corridor as OSC
+import OS_Airports.RWY as RWY
+import OS_Download as OSD
+import OS_Airports
+import numpy as np
+import importlib
+import pkgutil
+import glob
+import os
+
+
+def airport_names():
+    """List the airport definitions and modules in OS_Airports."""
+    names = [mod.name for mod in pkgutil.iter_modules(OS_Airports.__path__)]
+    for path in OS_Airports.__path__:
+        for inf in glob.glob(os.path.join(path, '*.json')):
+            names.append(os.path.splitext(os.path.basename(inf))[0])
+    return sorted(set([name for name in names if name != 'RWY']))
+
+
+def load_airports(names=None, verbose=True):
+    """Load a set of airport definitions.
+
+    An airport's JSON definition is used if it has one, see
+    OS_Airports.RWY.load_airport(), otherwise its module is imported.
+    Airports that can't be loaded are skipped with a warning, so one bad
+    definition doesn't stop the others being processed.
+    Inputs:
+        -   names: (optional) A list of ICAO codes, defaults to every
+            module in OS_Airports
+        -   verbose: (optional) True to print the airports loaded
+    Returns:
+        -   A dict of ICAO code -> airport, in the order given. Each
+            airport has the 'rwy_list' and names of an airport module.
+    """
+    if (names is None):
+        names = airport_names()
+    airports = {}
+    for name in names:
+        try:
+            if (os.path.exists(RWY.config_path(name))):
+                mod = RWY.load_airport(RWY.config_path(name))
+            else:
+                mod = importlib.import_module('OS_Airports.' + name)
+        except Exception as e:
+            print("Unable to load the airport definition for", name + ":", e)
+            continue
+        if (not hasattr(mod, 'rwy_list') or not hasattr(mod, 'icao_name')):
+            continue
+        airports[mod.icao_name] = mod
+    if (verbose):
+        print("Airports:", ', '.join(airports.keys()))
+    return airports
+
+
+def get_metar_file(airport, met_dir):
+    """Get the METAR file for an airport.
+
+    Inputs:
+        -   airport: The airport, as from load_airports()
+        -   met_dir: The directory holding '<ICAO>_METAR' files
+    Returns:
+        -   The airport's own 'metar_file' if it has one, otherwise the
+            file for its ICAO code in met_dir
+    """
+    met_file = getattr(airport, 'metar_file', None)
+    if (met_file is not None):
+        return met_file
+    return os.path.join(met_dir, airport.icao_name + '_METAR')
+
+
+def get_region_bounds(airports, margin=0.45):
+    """Compute a retrieval box that covers a set of airports.
+
+    Inputs:
+        -   airports: A dict of airports, as from load_airports()
+        -   margin: (optional) The margin (deg) around each airport, as
+            for OS_Download.get_bounds()
+    Returns:
+        -   The box, as [lon0, lat0, lon1, lat1]
+    """
+    bounds = np.array([OSD.get_bounds(airport.rwy_list, margin)
+                       for airport in airports.values()])
+    return [np.min(bounds[:, 0]), np.min(bounds[:, 1]),
+            np.max(bounds[:, 2]), np.max(bounds[:, 3])]
+
+
+class airport_index:
+    """Finds which airports' approach corridors a flight enters.
+
+    A coarse grid maps each cell to the airports whose corridor grids
+    overlap it, so each flight is only tested against the corridors of
+    airports it passes near.
+    cell = the coarse cell size in degrees
+    step = the track sample spacing, the smallest corridor cell size
+    corrs = a dict of ICAO code -> corridor_index
+    cells = a dict of (lat cell, lon cell) -> list of ICAO codes
+    """
+
+    def __init__(self, airports, cell=0.5):
+        """Build the index.
+
+        Inputs:
+            -   airports: A dict of airports, as from load_airports()
+            -   cell: (optional) The coarse cell size (deg)
+        """
+        self.cell = cell
+        self.corrs = {}
+        self.cells = {}
+        for icao, airport in airports.items():
+            corr = OSC.corridor_index(airport.rwy_list)
+            self.corrs[icao] = corr
+            lat1 = corr.lat0 + corr.mask.shape[0] * corr.cell
+            lon1 = corr.lon0 + corr.mask.shape[1] * corr.cell
+            for i_lat in range(int(np.floor(corr.lat0 / cell)),
+                               int(np.floor(lat1 / cell)) + 1):
+                for i_lon in range(int(np.floor(corr.lon0 / cell)),
+                                   int(np.floor(lon1 / cell)) + 1):
+                    self.cells.setdefault((i_lat, i_lon), []).append(icao)
+        self.step = min([corr.cell for corr in self.corrs.values()],
+                        default=cell)
+
+    def match_points(self, lats, lons, alts):
+        """Find the airports whose corridors a track enters.
+
+        The segments between the points are tested, as in
+        corridor_index.track_hits(), so no airport whose corridors the
+        one second interpolation of the track enters below the gate
+        altitude is missed. An airport whose corridors the track only
+        passes close to may also be returned.
+        Inputs:
+            -   lats, lons: Arrays of point coordinates, in time order
+            -   alts: An array of geometric altitudes (ft)
+        Returns:
+            -   A list of ICAO codes, in the order of the index
+        """
+        s_lats, s_lons = OSC.track_points(lats, lons, alts, self.step)
+        if (len(s_lats) < 1):
+            return []
+        keys = np.unique(np.floor(np.vstack([s_lats, s_lons]).T
+                                  / self.cell).astype(np.int64), axis=0)
+        cands = set()
+        for i_lat, i_lon in keys:
+            cands.update(self.cells.get((int(i_lat), int(i_lon)), []))
+        return [icao for icao in self.corrs if icao in cands and
+                self.corrs[icao].sample_hits(s_lats, s_lons)]
+
+    def match(self, flight, prev=None):
+        """Find the airports whose corridors a 'traffic' flight enters.
+
+        See corridor_index.flight_hits() for 'prev'.
+        """
+        return self.match_points(*OSC.track_arrays(flight, prev))
+
+    def flight_hits(self, flight, prev=None):
+        """Check whether a 'traffic' flight enters any airport's corridor.
+
+        This matches corridor_index.flight_hits(), so the index can be
+        used to filter a stream of flights.
+        """
+        return len(self.match(flight, prev)) > 0
@@ -0,0 +1,138 @@
+"""A separate stage for rendering the per-flight plots.
+
+Detection workers do not draw any plots. Instead they return a compact
+plot payload for each flight, and the main process passes these to a
+render pool of its own size. The number of payloads waiting to be drawn
+is bounded, so a slow render pool holds back detection rather than using
+up memory.
+"""
+import multiprocessing as mp
+import OS_Timing as OST
+import numpy as np
+
+
+# The per-point arrays needed to draw a flight
+plot_cols = ['time', 'alts', 'spds', 'rocs', 'gals', 'hdgs', 'lats', 'lons']
+
+
+def make_payload(fd, odir, ga_flag):
+    """Create a compact plot payload for a flight.
+
+    Inputs:
+        -   fd: A dict of flight data, with labels added
+        -   odir: The output directory for the plot
+        -   ga_flag: True if a go-around was detected
+    Returns:
+        -   A dict containing the payload
+    """
+    pfd = {}
+    for col in plot_cols:
+        pfd[col] = np.asarray(fd[col], dtype=np.float32)
+    pfd['labl'] = np.asarray(fd['labl'])
+    pfd['stop'] = fd['stop']
+    pfd['ic24'] = fd['ic24']
+    pfd['call'] = fd['call']
+    return {'fd': pfd, 'odir': odir, 'ga': ga_flag}
+
+
+def render_plot(payload, cmap, odpi, smooth='spline'):
+    """Draw and save the plots for one payload.
+
+    Inputs:
+        -   payload: A payload, as returned by make_payload()
+        -   cmap: A colour map, defined as a dict of classifications -> colors
+        -   odpi: The output DPI
+        -   smooth: (optional) The smoothing method for the plotted lines,
+            see OS_Funcs.smooth_channel()
+    Returns:
+        -   The stage timings of this worker, see OS_Timing.take()
+    """
+    import OS_Output as OSO
+    import OS_Funcs as OSF
+
+    fd = payload['fd']
+    try:
+        with OST.stage('spline'):
+            spldict = OSF.create_spline(fd, bpos=None, method=smooth)
+        with OST.stage('plot'):
+            OSO.do_plots(fd, spldict, cmap, payload['odir'], odpi=odpi)
+    except Exception as e:
+        print("Unable to plot flight", fd['call'], fd['ic24'], e)
+    return OST.take()
+
+
+class render_queue:
+    """A bounded queue of plot payloads, drawn by a pool of workers.
+
+    mode = 'all' to draw every flight, 'ga' to draw only go-arounds or
+           'none' to draw nothing
+    odpi = output DPI, a low value gives quicker preview plots
+    smooth = the smoothing method for the plotted lines, 'spline',
+             'savgol' or 'window' (see OS_Funcs.smooth_channel)
+    The stage timings of the render processes are added to those of the
+    main process as each plot completes.
+    """
+
+    def __init__(self, n_proc, cmap, mode='all', odpi=300,
+                 max_pending=None, method='forkserver', smooth='spline',
+                 timing=False):
+        """Setup the class and start the render pool.
+
+        Inputs:
+            -   n_proc: The number of render processes
+            -   cmap: A colour map, as used by OS_Output.do_plots()
+            -   mode: (optional) Which flights to draw, see above
+            -   odpi: (optional) The output DPI
+            -   max_pending: (optional) The maximum number of payloads
+                waiting to be drawn, defaults to 4 per render process
+            -   method: (optional) The multiprocessing start method
+            -   smooth: (optional) The smoothing method, see above
+            -   timing: (optional) True to time the plotting stages
+        """
+        self.cmap = cmap
+        self.smooth = smooth
+        self.mode = mode
+        self.odpi = odpi
+        if (max_pending is None):
+            max_pending = 4 * n_proc
+        self.max_pending = max_pending
+        self.pending = []
+        self.pool = None
+        if (mode != 'none'):
+            if (method not in mp.get_all_start_methods()):
+                method = None
+            self.pool = mp.get_context(method).Pool(processes=n_proc,
+                                                    initializer=OST.enable,
+                                                    initargs=(timing,))
+
+    def wanted(self, payload):
+        """Check whether a payload should be drawn in the current mode."""
+        if (self.mode == 'none'):
+            return False
+        if (self.mode == 'ga'):
+            return payload['ga']
+        return True
+
+    def put(self, payload):
+        """Add a payload to the queue, waiting if the queue is full."""
+        if (not self.wanted(payload)):
+            return
+        while (len(self.pending) > 0 and self.pending[0].ready()):
+            OST.merge(self.pending.pop(0).get())
+        while (len(self.pending) >= self.max_pending):
+            OST.merge(self.pending.pop(0).get())
+        self.pending.append(self.pool.apply_async(render_plot,
+                                                  args=(payload,
+                                                        self.cmap,
+                                                        self.odpi,
+                                                        self.smooth)))
+
+    def close(self):
+        """Wait for all queued plots to be drawn and stop the pool."""
+        for p in self.pending:
+            OST.merge(p.get())
+        self.pending = []
+        if (self.pool is not None):
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
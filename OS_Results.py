@@ -0,0 +1,298 @@
+"""Typed result records and a background writer for the results files.
+
+Each processed flight gives one record of res_dtype. Records are passed
+around as numpy structured arrays, which are cheap to send between
+processes, and are written out by a separate thread in chunks so that
+formatting and file writes do not hold up the main process.
+"""
+import OS_Airports.RWY as RWY
+import numpy as np
+import threading
+import queue
+import time
+import os
+
+
+# The result record for a single flight
+res_dtype = np.dtype([('ga', np.bool_),
+                      ('ic24', 'U8'),
+                      ('call', 'U10'),
+                      ('ga_time', 'datetime64[s]'),
+                      ('l_time', 'datetime64[s]'),
+                      ('rwy', 'U' + str(RWY.max_name_len)),
+                      ('hdg', np.float64),
+                      ('alt', np.float64),
+                      ('lat', np.float64),
+                      ('lon', np.float64),
+                      ('gapt', np.int64),
+                      ('n_ga', np.int64),
+                      ('rocvar', np.float64),
+                      ('hdgvar', np.float64),
+                      ('latvar', np.float64),
+                      ('lonvar', np.float64),
+                      ('gspvar', np.float64),
+                      ('has_met', np.bool_),
+                      ('temp', np.float64),
+                      ('dewp', np.float64),
+                      ('w_s', np.float64),
+                      ('w_g', np.float64),
+                      ('w_d', np.float64),
+                      ('cld', np.float64),
+                      ('cb', np.bool_),
+                      ('vis', np.float64),
+                      ('pres', np.float64)])
+
+# The output column names for each record field
+out_names = {'ga': 'GA', 'ic24': 'ICAO24', 'call': 'Callsign',
+             'ga_time': 'GA_Time', 'l_time': 'L_Time', 'rwy': 'Runway',
+             'hdg': 'Heading', 'alt': 'Alt', 'lat': 'Lat', 'lon': 'Lon',
+             'gapt': 'gapt', 'n_ga': 'N_GA', 'rocvar': 'rocvar',
+             'hdgvar': 'hdgvar', 'latvar': 'latvar', 'lonvar': 'lonvar',
+             'gspvar': 'gspvar',
+             'has_met': 'Has_Met', 'temp': 'Temp', 'dewp': 'Dewp',
+             'w_s': 'Wind_Spd', 'w_g': 'Wind_Gust', 'w_d': 'Wind_Dir',
+             'cld': 'Cld_Base', 'cb': 'CB', 'vis': 'Vis', 'pres': 'Pressure'}
+
+# The met fields, these are left empty in the output if there's no METAR
+met_fields = ['temp', 'dewp', 'w_s', 'w_g', 'w_d', 'cld', 'cb', 'vis', 'pres']
+
+
+def to_dt64(t_val):
+    """Convert a datetime or Timestamp (naive or UTC) to datetime64[s]."""
+    if (getattr(t_val, 'tzinfo', None) is not None):
+        t_val = t_val.replace(tzinfo=None)
+    return np.datetime64(t_val, 's')
+
+
+def make_record(ga_flag, ic24, call, l_time, ga_time, rwy_name,
+                hdg, alt, lat, lon, gapt, varis, bmet, n_ga=None):
+    """Create the result record for a flight.
+
+    Inputs:
+        -   ga_flag: True if a go-around was detected
+        -   ic24, call: The icao24 code and callsign
+        -   l_time, ga_time: The landing and go-around times
+        -   rwy_name: The runway name, or 'None'
+        -   hdg, alt, lat, lon: The heading (0-360), altitude and
+            position at the go-around
+        -   gapt: The array position of the go-around
+        -   varis: The roc, heading, lat, lon and ground speed variability
+            before landing / go-around, as a 5-element list
+        -   bmet: The METAR observation (as metobs), or None
+        -   n_ga: (optional) The number of go-arounds in the track, by
+            default one if ga_flag is set
+    Returns:
+        -   A numpy record of res_dtype
+    """
+    rec = np.zeros(1, dtype=res_dtype)[0]
+    rec['ga'] = ga_flag
+    rec['ic24'] = ic24
+    rec['call'] = call
+    rec['l_time'] = to_dt64(l_time)
+    rec['ga_time'] = to_dt64(ga_time)
+    rec['rwy'] = rwy_name
+    rec['hdg'] = hdg
+    rec['alt'] = alt
+    rec['lat'] = lat
+    rec['lon'] = lon
+    rec['gapt'] = gapt
+    if (n_ga is None):
+        n_ga = int(ga_flag)
+    rec['n_ga'] = n_ga
+    for fld, val in zip(['rocvar', 'hdgvar', 'latvar', 'lonvar', 'gspvar'],
+                        varis):
+        rec[fld] = val
+    rec['has_met'] = bmet is not None
+    if (bmet is not None):
+        for fld in met_fields:
+            rec[fld] = getattr(bmet, fld)
+    else:
+        for fld in met_fields:
+            if (fld != 'cb'):
+                rec[fld] = np.nan
+    return rec
+
+
+def csv_header():
+    """Return the header line of the CSV results files."""
+    return ','.join([out_names[fld] for fld in res_dtype.names]) + '\n'
+
+
+def check_csv(outf):
+    """Check that an existing CSV results file has the current columns.
+
+    Raises ValueError if it has a different header, as appending would
+    mix two layouts in one file. A missing or empty file is fine.
+    """
+    if (not os.path.exists(outf) or os.path.getsize(outf) == 0):
+        return
+    with open(outf, 'r') as fid:
+        header = fid.readline()
+    if (header != csv_header()):
+        raise ValueError(outf + " has different columns to this version, "
+                         "move it aside or choose a new results file")
+
+
+def to_array(recs):
+    """Convert a list of records into a structured array of res_dtype."""
+    return np.array(recs, dtype=res_dtype).reshape(-1)
+
+
+def format_csv(recs):
+    """Format an array of records as CSV lines.
+
+    Input:
+        -   A structured array of res_dtype
+    Returns:
+        -   A string of CSV lines, one per record
+    """
+    if (len(recs) < 1):
+        return ''
+    cols = []
+    for fld in res_dtype.names:
+        vals = recs[fld]
+        if (fld in ['ga_time', 'l_time']):
+            strs = np.datetime_as_string(vals, unit='s')
+            strs = np.char.replace(np.char.replace(strs, '-', '/'), 'T', ' ')
+        elif (fld in ['ga', 'has_met', 'cb']):
+            strs = np.where(vals, '1', '0')
+        else:
+            strs = vals.astype(str)
+        if (fld in met_fields):
+            strs = np.where(recs['has_met'], strs, '')
+        cols.append(strs)
+    lines = cols[0]
+    for col in cols[1:]:
+        lines = np.char.add(np.char.add(lines, ','), col)
+    return '\n'.join(lines.tolist()) + '\n'
+
+
+class result_writer:
+    """Writes result records from a background thread.
+
+    Records are buffered and written in chunks, when either flush_n records
+    are waiting or flush_s seconds have passed. Go-around and other results
+    go to separate files with the same columns. An existing CSV file is
+    only appended to if it has the same columns, see check_csv().
+    fmt = 'csv' to append to the two CSV files, or 'parquet' to write
+          each chunk as a new Parquet file (this requires pyarrow)
+    """
+
+    def __init__(self, out_ga, out_noga, fmt='csv',
+                 flush_n=1000, flush_s=10.):
+        """Setup the class and start the writer thread.
+
+        Inputs:
+            -   out_ga: The output for go-arounds, a CSV file or a
+                directory for Parquet files
+            -   out_noga: The same for non go-arounds
+            -   fmt: (optional) The output format, see above
+            -   flush_n: (optional) The number of records per chunk
+            -   flush_s: (optional) The maximum time between writes
+        """
+        self.outs = [out_noga, out_ga]
+        self.fmt = fmt
+        if (fmt == 'csv'):
+            for outf in self.outs:
+                check_csv(outf)
+        self.flush_n = flush_n
+        self.flush_s = flush_s
+        self.n_chunk = 0
+        # The number of put() calls that have been written to disk
+        self.n_written = 0
+        self.n_put = 0
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, recs):
+        """Queue an array of records for writing.
+
+        Returns:
+            -   A sequence number, the records are on disk once n_written
+                is at least this value
+        """
+        if (self.error is not None):
+            raise self.error
+        self.n_put += 1
+        self.queue.put((self.n_put, recs))
+        return self.n_put
+
+    def run(self):
+        """The writer thread, which collects and writes chunks of records."""
+        buf = []
+        last_seq = 0
+        n_buf = 0
+        last_write = time.time()
+        done = False
+        while (not done):
+            try:
+                item = self.queue.get(timeout=self.flush_s)
+            except queue.Empty:
+                item = None
+            if (item is not None and item[0] is None):
+                done = True
+            elif (item is not None):
+                last_seq = item[0]
+                buf.append(item[1])
+                n_buf += len(item[1])
+            if (len(buf) > 0 and (done or n_buf >= self.flush_n or
+                                  time.time() - last_write > self.flush_s)):
+                try:
+                    self.write_chunk(np.concatenate(buf))
+                except Exception as e:
+                    self.error = e
+                    print("ERROR: Unable to write results:", e)
+                    return
+                buf = []
+                n_buf = 0
+                last_write = time.time()
+            if (len(buf) == 0):
+                self.n_written = last_seq
+
+    def write_chunk(self, recs):
+        """Write a chunk of records to the output files."""
+        for ga_val in [False, True]:
+            sub = recs[recs['ga'] == ga_val]
+            if (len(sub) < 1):
+                continue
+            outf = self.outs[int(ga_val)]
+            if (self.fmt == 'parquet'):
+                self.write_parquet(sub, outf)
+            else:
+                self.write_csv(sub, outf)
+        self.n_chunk += 1
+
+    def write_csv(self, recs, outf):
+        """Append records to a CSV file, adding the header to a new file."""
+        new_file = (not os.path.exists(outf) or os.path.getsize(outf) == 0)
+        with open(outf, 'a') as fid:
+            if (new_file):
+                fid.write(csv_header())
+            fid.write(format_csv(recs))
+            fid.flush()
+            os.fsync(fid.fileno())
+
+    def write_parquet(self, recs, outdir):
+        """Write records to a new Parquet file in a directory."""
+        import pyarrow.parquet as pq
+        import pyarrow as pa
+
+        if (not os.path.exists(outdir)):
+            os.makedirs(outdir, exist_ok=True)
+        cols = {}
+        for fld in res_dtype.names:
+            cols[out_names[fld]] = recs[fld]
+        outf = os.path.join(outdir, 'RES_' + str(int(time.time() * 1e6))
+                            + '_' + str(self.n_chunk).zfill(6) + '.parquet')
+        tmpf = outf + '.tmp'
+        pq.write_table(pa.table(cols), tmpf)
+        os.replace(tmpf, outf)
+
+    def close(self):
+        """Write any remaining records and stop the writer thread."""
+        self.queue.put((None, None))
+        self.thread.join()
+        if (self.error is not None):
+            raise self.error
@@ -0,0 +1,110 @@
+"""Helpers for fast worker startup and for measuring module import times.
+
+Workers are started from a forkserver that has already imported the
+modules listed in preload_mods, so each new worker only pays for a fork.
+The METAR and runway tables are built once in the parent and handed to
+the workers by OS_Funcs.init_worker().
+"""
+import multiprocessing as mp
+import subprocess
+import sys
+
+
+# Modules imported once by the forkserver and inherited by every worker
+preload_mods = ['numpy', 'pandas', 'traffic.core', 'metar_parse',
+                'OS_Timing', 'OS_Phase', 'OS_Funcs', 'OS_Batch']
+
+# Modules whose import time is reported at startup
+report_mods = ['metar_parse', 'OS_Output', 'OS_Funcs', 'OS_Batch']
+
+# The import time budget, in seconds, for each of report_mods
+import_budget = 1.0
+
+
+def make_pool(n_proc, met_file, rwy_list, method='forkserver',
+              timing=False, airports=None):
+    """Create a pool of workers that share state built by the parent.
+
+    Inputs:
+        -   n_proc: The number of worker processes
+        -   met_file: The METAR file for the workers to use, the parent
+            should already have read it so that the cache is up to date
+        -   rwy_list: A list of runways to check, defined in OS_Airports
+        -   method: (optional) The multiprocessing start method
+        -   timing: (optional) True to time each stage in the workers,
+            see OS_Timing
+        -   airports: (optional) A dict of ICAO code -> (METAR file,
+            runway list), for processing several airports. The parent
+            should already have read each METAR file.
+    Returns:
+        -   A multiprocessing pool
+    """
+    import OS_Funcs as OSF
+
+    if (method not in mp.get_all_start_methods()):
+        method = None
+    ctx = mp.get_context(method)
+    if (method == 'forkserver'):
+        ctx.set_forkserver_preload(preload_mods)
+    return ctx.Pool(processes=n_proc,
+                    initializer=OSF.init_worker,
+                    initargs=(met_file, rwy_list, timing, airports))
+
+
+def measure_import_time(mod):
+    """Measure the time taken to import a module in a fresh interpreter.
+
+    Input:
+        -   mod: The module name
+    Returns:
+        -   The cumulative import time in seconds, or None on failure
+    """
+    cmd = [sys.executable, '-X', 'importtime', '-c', 'import ' + mod]
+    try:
+        res = subprocess.run(cmd, capture_output=True, text=True)
+    except OSError:
+        return None
+    if (res.returncode != 0):
+        return None
+    # Lines look like: 'import time:  self [us] | cumulative | package'
+    for line in res.stderr.splitlines():
+        parts = line.split('|')
+        if (len(parts) != 3):
+            continue
+        if (parts[2].strip() == mod):
+            try:
+                return int(parts[1]) / 1e6
+            except ValueError:
+                return None
+    return None
+
+
+def report_import_times(mods=None, budget=None, fidder=None):
+    """Measure and report the import time of a list of modules.
+
+    Inputs:
+        -   mods: (optional) The module names, defaults to report_mods
+        -   budget: (optional) The per-module budget in seconds,
+            defaults to import_budget
+        -   fidder: (optional) An open file to also write the report to
+    Returns:
+        -   A dict of module name -> import time in seconds (or None)
+    """
+    if (mods is None):
+        mods = report_mods
+    if (budget is None):
+        budget = import_budget
+    times = {}
+    for mod in mods:
+        imp_t = measure_import_time(mod)
+        times[mod] = imp_t
+        if (imp_t is None):
+            outstr = "Import time: " + mod + " failed to import"
+        else:
+            outstr = "Import time: " + mod + " {:.3f}".format(imp_t) + "s"
+            if (imp_t > budget):
+                outstr = outstr + " (over budget of " + str(budget) + "s)"
+        print(outstr)
+        if (fidder is not None):
+            fidder.write(outstr + '\n')
+    return times
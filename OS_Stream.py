@@ -0,0 +1,182 @@
+"""Streaming ingestion of the hourly OpenSky files.
+
+Files are read in time order and each aircraft's track is kept in an open
+buffer until no new data has arrived for it for a set time (the 'gap').
+The complete flight is then emitted for processing. Only the buffers of
+aircraft that are still being seen are held in memory, rather than whole
+batches of files.
+"""
+from datetime import timedelta
+import OS_Consts as CNS
+import OS_Timing as OST
+import OS_Funcs as OSF
+import pandas as pd
+
+
+def load_files(files, pool=None, n_ahead=4):
+    """Load the flights from a series of files, in order.
+
+    Inputs:
+        -   files: A time-ordered list of input filenames
+        -   pool: (optional) A multiprocessing pool used to read files
+            in the background. The stage timings of the workers are
+            added to those of this process.
+        -   n_ahead: (optional) The number of files to read ahead when
+            using a pool
+    Yields:
+        -   The list of flights in each file, as returned by get_flight()
+    """
+    if (pool is None):
+        for inf in files:
+            yield OSF.get_flight(inf)
+        return
+
+    p_list = []
+    for inf in files:
+        p_list.append(pool.apply_async(OST.with_timings,
+                                       args=(OSF.get_flight, inf)))
+        if (len(p_list) > n_ahead):
+            flist, snap = p_list.pop(0).get()
+            OST.merge(snap)
+            yield flist
+    for p in p_list:
+        flist, snap = p.get()
+        OST.merge(snap)
+        yield flist
+
+
+def join_parts(parts):
+    """Join the buffered pieces of a flight into a single flight.
+
+    Input:
+        -   A list of 'traffic' flights for the same aircraft
+    Returns:
+        -   A single 'traffic' flight
+    """
+    from traffic.core import Flight
+
+    if (len(parts) == 1):
+        return parts[0]
+    f_data = pd.concat([part.data for part in parts], ignore_index=True)
+    f_data = f_data.sort_values(by=['timestamp'])
+    return Flight(f_data)
+
+
+def stream_flights(files, gap=None, pool=None, n_ahead=4, fidder=None,
+                   corr=None, counts=None, loader=None, n_done=0):
+    """Read flights from a series of files and emit each once it is complete.
+
+    Flights are buffered by icao24 and callsign, which is how 'traffic'
+    separates flights. A flight is complete once the latest data read is
+    more than 'gap' seconds after the flight's last point. All remaining
+    flights are emitted when the files run out.
+    Inputs:
+        -   files: A time-ordered list of input filenames
+        -   gap: (optional) The quiet time in seconds, defaults to
+            CNS.stream_gap
+        -   pool: (optional) A multiprocessing pool used to read files
+        -   n_ahead: (optional) The number of files to read ahead
+        -   fidder: (optional) An open file to write progress into
+        -   corr: (optional) A corridor_index, flights that never enter
+            one of its corridors are discarded
+        -   counts: (optional) A dict that is updated with the number of
+            flights emitted ('emitted'), discarded ('rejected') and
+            skipped as already done ('skipped'), the number of leading
+            files that have no data left in the open buffers ('closed')
+            and the number of the first file with data in the flight
+            last emitted ('first')
+        -   loader: (optional) An iterator giving the list of flights in
+            each entry of 'files', used in place of reading the files.
+            This is how data is passed straight from the downloader.
+        -   n_done: (optional) The number of leading files that were
+            completed by an earlier run, see OS_Manifest.pending_files().
+            Flights with data in these files are not emitted.
+    Yields:
+        -   Complete 'traffic' flights
+    """
+    if (gap is None):
+        gap = CNS.stream_gap
+    gap = timedelta(seconds=gap)
+
+    if (counts is None):
+        counts = {}
+    counts['emitted'] = 0
+    counts['rejected'] = 0
+    counts['skipped'] = 0
+    counts['closed'] = 0
+    counts['first'] = 0
+
+    # Open buffers: (icao24, callsign) -> list of flight pieces
+    buffers = {}
+    # Whether any piece of each buffered flight has entered a corridor
+    in_corr = {}
+    # The time of the last point in each buffer
+    last_seen = {}
+    # The number of the first file with data in each buffer
+    first_file = {}
+    n_files = len(files)
+
+    if (loader is None):
+        loader = load_files(files, pool, n_ahead)
+
+    for f_num, flist in enumerate(loader):
+        outstr = ("Read file " + str(f_num + 1).zfill(5) + " of "
+                  + str(n_files).zfill(5) + ", " + str(len(buffers))
+                  + " open tracks, " + str(counts['rejected'])
+                  + " flights outside approach corridors")
+        print(outstr)
+        if (fidder is not None):
+            fidder.write(outstr + '\n')
+
+        for flight in flist:
+            key = (flight.icao24, flight.callsign)
+            if (key not in buffers):
+                buffers[key] = []
+                last_seen[key] = flight.stop
+                first_file[key] = f_num
+                in_corr[key] = corr is None
+            # The gap from the previous piece is part of the track too
+            prev = buffers[key][-1] if len(buffers[key]) > 0 else None
+            buffers[key].append(flight)
+            if (not in_corr[key]):
+                in_corr[key] = corr.flight_hits(flight, prev)
+            if (flight.stop > last_seen[key]):
+                last_seen[key] = flight.stop
+        if (len(last_seen) < 1):
+            counts['closed'] = f_num + 1
+            continue
+
+        # Emit every flight that has been quiet for long enough
+        now = max(last_seen.values())
+        done = [key for key in last_seen if last_seen[key] + gap < now]
+        for key in done:
+            parts = buffers.pop(key)
+            del last_seen[key]
+            f_first = first_file.pop(key)
+            if (f_first < n_done):
+                in_corr.pop(key)
+                counts['skipped'] += 1
+            elif (in_corr.pop(key)):
+                counts['emitted'] += 1
+                counts['first'] = f_first
+                yield join_parts(parts)
+            else:
+                counts['rejected'] += 1
+        if (len(first_file) > 0):
+            counts['closed'] = min(first_file.values())
+        else:
+            counts['closed'] = f_num + 1
+
+    for key in list(buffers.keys()):
+        parts = buffers.pop(key)
+        f_first = first_file.pop(key)
+        if (f_first < n_done):
+            in_corr.pop(key)
+            counts['skipped'] += 1
+        elif (in_corr.pop(key)):
+            counts['emitted'] += 1
+            counts['first'] = f_first
+            yield join_parts(parts)
+        else:
+            counts['rejected'] += 1
+    counts['closed'] = n_files
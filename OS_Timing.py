@@ -0,0 +1,222 @@
+"""Lightweight timers and counters for the stages of go-around detection.
+
+Timing is off by default. When it is off, stage() hands back a shared
+do-nothing context manager and count() returns straight away, so the
+instrumented code costs little more than a function call per stage.
+
+Each stage's timings are kept as fixed-size statistics: the number of
+calls, the total, minimum and maximum time, and a histogram with
+log-spaced bins for the percentiles. Memory use therefore does not grow
+with the number of flights, however long the run.
+
+Each process keeps its own statistics. Pool workers hand theirs back
+along with their results using take(), which also clears them, and the
+parent adds them to its own with merge(). The parent can then write a
+JSON summary of the per-stage totals, percentiles and throughput.
+
+Usage:
+    with OST.stage('labels'):
+        labels = do_labels(fd)
+    OST.count('flights')
+"""
+import numpy as np
+import json
+import math
+import time
+import os
+
+
+# Whether timing is enabled in this process
+enabled = False
+
+# The statistics of each stage, see new_stats(), and the counters
+stats = {}
+counts = {}
+
+# The time that timing was enabled, used for the overall throughput
+t_begin = time.perf_counter()
+
+# The percentiles given in the summary
+pcts = [50, 90, 99]
+
+# The histogram has hist_per_dec bins per decade from 10^hist_lo to
+# 10^hist_hi seconds, plus a bin either side for times outside this
+# range. The percentiles are accurate to about 3%.
+hist_lo = -6
+hist_hi = 4
+hist_per_dec = 40
+n_bins = (hist_hi - hist_lo) * hist_per_dec + 2
+
+
+def new_stats():
+    """Return empty statistics: [calls, total, min, max, histogram]."""
+    return [0, 0., math.inf, 0., np.zeros(n_bins, dtype=np.int64)]
+
+
+def add_time(st, dur):
+    """Add the duration (s) of one call to a stage's statistics."""
+    st[0] += 1
+    st[1] += dur
+    if (dur < st[2]):
+        st[2] = dur
+    if (dur > st[3]):
+        st[3] = dur
+    if (dur > 0):
+        b_num = int((math.log10(dur) - hist_lo) * hist_per_dec) + 1
+        st[4][min(max(b_num, 0), n_bins - 1)] += 1
+    else:
+        st[4][0] += 1
+
+
+def get_percentile(st, pct):
+    """Estimate a percentile of a stage's times from its histogram.
+
+    The value is the geometric centre of the bin holding the percentile,
+    limited to the smallest and largest times seen.
+    """
+    target = max(1, int(math.ceil(pct / 100. * st[0])))
+    b_num = int(np.searchsorted(np.cumsum(st[4]), target))
+    val = 10 ** (hist_lo + (b_num - 0.5) / hist_per_dec)
+    return min(max(val, st[2]), st[3])
+
+
+class null_stage:
+    """A context manager that does nothing, used when timing is off."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, e_type, e_val, e_tb):
+        return False
+
+
+no_stage = null_stage()
+
+
+class stage_timer:
+    """A context manager that records the time spent in a stage."""
+
+    __slots__ = ('name', 't_start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t_start = time.perf_counter()
+        return self
+
+    def __exit__(self, e_type, e_val, e_tb):
+        dur = time.perf_counter() - self.t_start
+        try:
+            st = stats[self.name]
+        except KeyError:
+            st = stats[self.name] = new_stats()
+        add_time(st, dur)
+        return False
+
+
+def enable(on=True):
+    """Turn timing on or off in this process, clearing any timings."""
+    global enabled, t_begin
+    enabled = on
+    stats.clear()
+    counts.clear()
+    t_begin = time.perf_counter()
+
+
+def stage(name):
+    """Return a context manager that times a stage, if timing is on."""
+    if (not enabled):
+        return no_stage
+    return stage_timer(name)
+
+
+def count(name, n=1):
+    """Add to a counter, if timing is on."""
+    if (not enabled):
+        return
+    counts[name] = counts.get(name, 0) + n
+
+
+def take():
+    """Return and clear the statistics and counters of this process.
+
+    Returns:
+        -   A tuple of (stats, counts) to pass to merge(), or None if
+            timing is off
+    """
+    if (not enabled):
+        return None
+    snap = (dict(stats), dict(counts))
+    stats.clear()
+    counts.clear()
+    return snap
+
+
+def merge(snap):
+    """Add statistics and counters from take() to those of this process."""
+    if (snap is None):
+        return
+    for name, new in snap[0].items():
+        st = stats.get(name)
+        if (st is None):
+            stats[name] = [new[0], new[1], new[2], new[3], np.array(new[4])]
+            continue
+        st[0] += new[0]
+        st[1] += new[1]
+        st[2] = min(st[2], new[2])
+        st[3] = max(st[3], new[3])
+        st[4] += new[4]
+    for name, n in snap[1].items():
+        counts[name] = counts.get(name, 0) + n
+
+
+def with_timings(func, *args):
+    """Call a function and return its result with the timings, for a pool."""
+    return func(*args), take()
+
+
+def summary(n_flights=None):
+    """Summarise the statistics and counters of this process.
+
+    Input:
+        -   n_flights: (optional) The number of flights processed, used
+            for the overall rate. Defaults to the 'flights' counter.
+    Returns:
+        -   A dict with, for each stage, the number of calls, the total,
+            mean, percentile and maximum times (s) and the calls per
+            second spent in the stage. Also the counters, the time since
+            timing was enabled and the overall flights per second.
+    """
+    elapsed = time.perf_counter() - t_begin
+    if (n_flights is None):
+        n_flights = counts.get('flights', 0)
+    stages = {}
+    for name, st in stats.items():
+        if (st[0] < 1):
+            continue
+        total = float(st[1])
+        out = {'calls': int(st[0]),
+               'total': total,
+               'mean': total / st[0],
+               'min': float(st[2]),
+               'max': float(st[3]),
+               'per_sec': st[0] / total if total > 0 else None}
+        for pct in pcts:
+            out['p' + str(pct)] = float(get_percentile(st, pct))
+        stages[name] = out
+    return {'elapsed': elapsed,
+            'flights': n_flights,
+            'flights_per_sec': n_flights / elapsed if elapsed > 0 else None,
+            'counts': dict(counts),
+            'stages': stages}
+
+
+def write_summary(outf, n_flights=None):
+    """Write summary() to a JSON file, replacing any earlier summary."""
+    tmpf = outf + '.tmp'
+    with open(tmpf, 'w') as fid:
+        json.dump(summary(n_flights), fid, indent=1, sort_keys=True)
+    os.replace(tmpf, outf)
@@ -0,0 +1,235 @@
+"""Memory-budgeted batching and worker autotuning for GA_Detect.
+
+A fixed number of flights per batch either wastes memory in quiet hours
+or runs out of it in busy ones, as the number of points per flight and
+per file varies a lot. batch_tuner instead sizes each batch by its
+estimated memory, using the measured bytes per row of the flight data,
+so that every batch in flight fits within a memory budget together.
+
+The pool is started with more workers than are normally useful, and the
+tuner sets how many of them are given work at once. Every 'tune_every'
+seconds the flights per second over the last interval are compared with
+the interval before: the number of active workers keeps moving in the
+same direction while the throughput improves and turns back when it
+drops. It is not increased while the CPUs are already fully loaded.
+Every change is logged.
+"""
+import numpy as np
+import time
+import os
+
+
+def total_memory():
+    """Return the physical memory of this machine in bytes, or None."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def cpu_load():
+    """Return the 1 minute load average per CPU, or None if unavailable."""
+    try:
+        return os.getloadavg()[0] / os.cpu_count()
+    except (OSError, AttributeError):
+        return None
+
+
+class batch_tuner:
+    """Chooses the batch size and number of active workers during a run.
+
+    mem_budget = the memory (bytes) that the batches in flight may use
+    n_active = the number of workers currently given batches
+    max_proc = the number of workers in the pool, the most that can be
+               active
+    row_bytes = the measured memory per row of flight data
+    """
+
+    def __init__(self, max_proc=None, mem_budget=None, mem_frac=0.5,
+                 n_active=None, min_fl=10, max_fl=500, proc_factor=5.,
+                 tune_every=60., fidder=None):
+        """Setup the class.
+
+        Inputs:
+            -   max_proc: (optional) The number of workers in the pool,
+                defaults to twice the number of CPUs
+            -   mem_budget: (optional) The memory budget in bytes
+            -   mem_frac: (optional) If no budget is given, the fraction of
+                the physical memory to use
+            -   n_active: (optional) The starting number of active
+                workers, defaults to the number of CPUs
+            -   min_fl, max_fl: (optional) The smallest and largest number
+                of flights in a batch
+            -   proc_factor: (optional) The memory used while processing
+                a batch, as a multiple of the size of its input data
+            -   tune_every: (optional) The time (s) between adjustments
+            -   fidder: (optional) An open file to also log changes to
+        """
+        n_cpu = os.cpu_count() or 1
+        if (max_proc is None):
+            max_proc = 2 * n_cpu
+        if (mem_budget is None):
+            mem_budget = total_memory()
+            if (mem_budget is None):
+                mem_budget = 8 * 1024 ** 3
+            mem_budget = mem_budget * mem_frac
+        if (n_active is None):
+            n_active = n_cpu
+        self.max_proc = max_proc
+        self.mem_budget = mem_budget
+        self.n_active = max(1, min(n_active, max_proc))
+        self.min_fl = min_fl
+        self.max_fl = max_fl
+        self.proc_factor = proc_factor
+        self.tune_every = tune_every
+        self.fidder = fidder
+
+        # A first guess at the size of a row, refined as flights are seen
+        self.row_bytes = 400.
+        self.n_sampled = 0
+
+        # The rows and flights of the batches being built, by group, and
+        # the memory of the batches in flight
+        self.cur = {}
+        self.pending_bytes = 0.
+
+        # Throughput measurement
+        self.step = 1
+        self.n_done = 0
+        self.t_last = time.perf_counter()
+        self.last_rate = None
+        self.log("Starting with")
+
+    def log(self, prefix, rate=None):
+        """Print the current settings, and write them to the log file."""
+        outstr = (prefix + " " + str(self.n_active) + " of "
+                  + str(self.max_proc) + " workers, batches of up to "
+                  + "{:.1f}".format(self.batch_bytes() / 1024 ** 2)
+                  + " MB in a budget of "
+                  + "{:.1f}".format(self.mem_budget / 1024 ** 2) + " MB")
+        if (rate is not None):
+            outstr = outstr + ", {:.1f} flights/s".format(rate)
+        load = cpu_load()
+        if (load is not None):
+            outstr = outstr + ", CPU load {:.2f}".format(load)
+        print(outstr)
+        if (self.fidder is not None):
+            self.fidder.write(outstr + '\n')
+
+    def batch_bytes(self):
+        """The target size of the input data of a batch, in bytes.
+
+        Each active worker can have one batch running and one waiting, so
+        the budget is shared between twice the number of active workers.
+        """
+        return self.mem_budget / (self.proc_factor * 2 * self.n_active)
+
+    def files_ahead(self, files, min_ahead=1, max_ahead=16):
+        """Choose how many input files to read ahead.
+
+        A quarter of the budget is set aside for files that have been read
+        but not yet used, based on the size of the largest file on disk.
+        Input:
+            -   files: The input filenames
+        Returns:
+            -   The number of files to read ahead
+        """
+        sizes = [os.path.getsize(inf) for inf in files if os.path.exists(inf)]
+        if (len(sizes) < 1):
+            return min_ahead
+        n_ahead = int(self.mem_budget / 4 / (self.proc_factor * max(sizes)))
+        n_ahead = max(min_ahead, min(n_ahead, max_ahead))
+        outstr = ("Reading " + str(n_ahead) + " files ahead, the largest "
+                  "is {:.1f} MB".format(max(sizes) / 1024 ** 2))
+        print(outstr)
+        if (self.fidder is not None):
+            self.fidder.write(outstr + '\n')
+        return n_ahead
+
+    def add(self, flight, group=None):
+        """Add a flight to the batch being built.
+
+        The memory per row is measured for one flight in every hundred,
+        as a full measurement of the string columns is slow.
+        Inputs:
+            -   flight: A 'traffic' flight
+            -   group: (optional) A separate batch is built for each
+                group, such as each airport
+        Returns:
+            -   True if the batch is now full and should be sent
+        """
+        n_rows = len(flight.data)
+        if (self.n_sampled % 100 == 0 and n_rows > 0):
+            f_bytes = flight.data.memory_usage(index=True, deep=True).sum()
+            n_meas = self.n_sampled // 100 + 1
+            self.row_bytes = (self.row_bytes * (n_meas - 1)
+                              + f_bytes / n_rows) / n_meas
+        self.n_sampled += 1
+        cur = self.cur.setdefault(group, [0, 0])
+        cur[0] += n_rows
+        cur[1] += 1
+        if (cur[1] >= self.max_fl):
+            return True
+        return (cur[1] >= self.min_fl and
+                cur[0] * self.row_bytes >= self.batch_bytes())
+
+    def sent(self, group=None):
+        """Record that the batch being built for a group was sent.
+
+        Returns:
+            -   The estimated memory of the batch while it is processed,
+                to be passed to done() once it is finished
+        """
+        n_rows = self.cur.pop(group, [0, 0])[0]
+        n_bytes = n_rows * self.row_bytes * self.proc_factor
+        self.pending_bytes += n_bytes
+        return n_bytes
+
+    def done(self, n_bytes, n_flights):
+        """Record that a batch has finished, and retune if it is time.
+
+        Inputs:
+            -   n_bytes: The value returned by sent() for the batch
+            -   n_flights: The number of flights in the batch
+        """
+        self.pending_bytes = max(self.pending_bytes - n_bytes, 0.)
+        self.n_done += n_flights
+        now = time.perf_counter()
+        if (now - self.t_last >= self.tune_every):
+            self.retune(self.n_done / (now - self.t_last))
+            self.n_done = 0
+            self.t_last = now
+
+    def full(self, n_pending):
+        """Check whether to wait for a batch before sending another.
+
+        Input:
+            -   n_pending: The number of batches in flight
+        Returns:
+            -   True if the active workers have enough to do, or the
+                batches in flight use up the memory budget
+        """
+        if (n_pending < 1):
+            return False
+        return (n_pending >= 2 * self.n_active or
+                self.pending_bytes >= self.mem_budget)
+
+    def retune(self, rate):
+        """Adjust the number of active workers from the latest throughput.
+
+        Input:
+            -   rate: The flights per second over the last interval
+        """
+        if (self.last_rate is not None and rate < self.last_rate * 0.95):
+            self.step = -self.step
+        load = cpu_load()
+        if (self.step > 0 and load is not None and load > 0.95):
+            self.step = -self.step
+        self.last_rate = rate
+        new_n = self.n_active + self.step * max(1, self.n_active // 8)
+        new_n = int(np.clip(new_n, 1, self.max_proc))
+        if (new_n == self.n_active):
+            self.step = -self.step
+            return
+        self.n_active = new_n
+        self.log("Now using", rate)
@@ -1,16 +1,16 @@
 """
 This script downloads data from the opensky library for a particular airport,
-a small perimeter is set up around the airport to catch the approach path
+a small perimeter is set up around the airport to catch the approach path.
+Several airports can be retrieved together as a single region, which
+GA_Detect then processes in one pass.
 """
 
 from datetime import datetime, timedelta
-from traffic.data import opensky
-import multiprocessing as mp
-import numpy as np
-import os
+import OS_Registry as OSRG
+import OS_Download as OSD
 
-# Use this line to change the airport to retrieve.
-import OS_Airports.VABB as AIRPRT
+# Use this line to change the airports to retrieve, from OS_Airports.
+apt_names = ['VABB']
 
 # Use these lines if you need debug info
 # from traffic.core.logging import loglevel
@@ -19,6 +19,11 @@ import OS_Airports.VABB as AIRPRT
 # This line sets the output directory
 outdir = '/gf2/eodg/SRP002_PROUD_ADSBREP/GO_AROUNDS/VABB/INDATA/'
 
+# Output format, either 'pkl' for 'traffic' pickles in outdir or 'parquet'
+# for the partitioned layout in pqdir (see OS_Parquet)
+out_fmt = 'pkl'
+pqdir = '/gf2/eodg/SRP002_PROUD_ADSBREP/GO_AROUNDS/VABB/PQDATA/'
+
 # Setting up the start and end times for the retrieval
 start_dt = datetime(2019, 8, 10, 0, 0)
 end_dt = datetime(2019, 8, 20, 23, 59)
@@ -26,84 +31,56 @@ end_dt = datetime(2019, 8, 20, 23, 59)
 # Sets the number of simultaneous retrievals
 nummer = 6
 
+# Number of retries for a failed hour, and the wait (s) before the first
+# retry. The wait doubles after each failure.
+n_retry = 5
+backoff = 10.
 
-def get_bounds(rwys):
-    """
-    This function computes the boundaries of the retrieval
-    'box' based upon the runways selected for processing.
-    The box is approx. 0.25 degrees in each direction around
-    the airport midpoint.
-    """
-    latlist = []
-    lonlist = []
-    for rwy in rwys:
-        latlist.append(rwy.rwy[0])
-        lonlist.append(rwy.rwy[1])
-        latlist.append(rwy.rwy2[0])
-        lonlist.append(rwy.rwy2[1])
-
-    lat_ave = np.nanmean(latlist)
-    lon_ave = np.nanmean(lonlist)
-    bounds = [lon_ave - 0.45, lat_ave - 0.45,
-              lon_ave + 0.45, lat_ave + 0.45]
 
-    return bounds
+def main():
+    """Download every hour between start_dt and end_dt.
 
-
-def getter(init_time, bounds, timer, anam):
-    """
-    This function downloads the data, which is done in
-    one hour segments. Each hour is downloaded separately
-    using multiprocessing for efficiency.
+    Hours are shared out over a pool of 'nummer' workers, which each take
+    the next hour as soon as they finish, see OS_Download.
     """
-    try:
-        times = init_time + timedelta(hours=timer)
-        dtst = times.strftime("%Y%m%d%H%M")
-        outf = outdir+'OS_'+dtst+'_'+anam+'.pkl'
+    apts = OSRG.load_airports(apt_names, verbose=False)
+    bounds = OSRG.get_region_bounds(apts)
+    source = OSD.opensky_source(bounds)
+    if (out_fmt == 'parquet'):
+        odir = pqdir
+    else:
+        odir = outdir
+    # The files are named after the region, the airports' ICAO codes
+    region = '_'.join(apts.keys())
+    dler = OSD.downloader(source, region, odir, fmt=out_fmt,
+                          n_proc=nummer, n_retry=n_retry, backoff=backoff)
 
-        # Check if the file has already been retrieved
-        if (os.path.exists(outf)):
-            print("Already retrieved", outf)
-            return
-        # Otherwise use 'traffic' to download
-        flights = opensky.history(start=times,
-                                  stop=times+timedelta(hours=1),
-                                  bounds=bounds,
-                                  other_params=" and time-lastcontact<=15 ")
-        flights.to_pickle(outf)
-    except Exception as e:
-        print("There is a problem with this date/time combination:", e, times)
-
-    return
-
-
-bounds = get_bounds(AIRPRT.rwy_list)
-
-# Loop over timestamps to retrieve all the data.
-while True:
-
-    dtst = start_dt.strftime("%Y%m%d%H%M")
-    outf = outdir + 'OS_' + dtst+'_' + AIRPRT.icao_name + '.pkl'
     print("Now processing:",
-          start_dt.strftime("%Y/%m/%d %H:%M"),
-          'for', AIRPRT.airport_name + ' / ' +
-          AIRPRT.icao_name)
-
-    # Create processes for each hour, in total 'nummer' hours are
-    # processed simultaneously
-    processes = [mp.Process(target=getter,
-                            args=(start_dt, bounds, i, AIRPRT.icao_name))
-                 for i in range(0, nummer)]
-
-    # Start, and then join, all processes
-    for p in processes:
-        p.start()
-    for p in processes:
-        p.join()
-
-    # Move on to the next block of times
-    start_dt = start_dt + timedelta(hours=nummer)
-
-    # If we have reached the end of the block then exit
-    if (start_dt >= end_dt):
-        break
+          start_dt.strftime("%Y/%m/%d %H:%M"), 'to',
+          end_dt.strftime("%Y/%m/%d %H:%M"),
+          'for', ', '.join([apt.airport_name + ' / ' + apt.icao_name
+                            for apt in apts.values()]))
+
+    # Build the list of hours to retrieve
+    hours = []
+    cur_dt = start_dt
+    while (cur_dt < end_dt):
+        hours.append(cur_dt)
+        cur_dt = cur_dt + timedelta(hours=1)
+
+    for hour, outf, status, n_try, err in dler.run(hours):
+        if (status == 'exists'):
+            print("Already retrieved", outf)
+        elif (status == 'failed'):
+            print("There is a problem with this date/time combination:",
+                  err, hour)
+        else:
+            print("Retrieved", hour.strftime("%Y/%m/%d %H:%M"), status,
+                  "after", n_try, "attempt(s)")
+    dler.close()
+    print("Finished:", dler.counts)
+
+
+# The guard is needed as the forkserver workers import this file
+if __name__ == '__main__':
+    main()
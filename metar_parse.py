@@ -5,8 +5,10 @@ https://github.com/python-metar/python-metar
 """
 
 from datetime import datetime
-from metar import Metar
+import numpy as np
+import hashlib
 import pytz
+import os
 
 
 class metobs:
@@ -36,17 +38,179 @@ class metobs:
         self.cld = cld
 
 
-def get_metars(inf, verbose):
-    """A function to parse metars from a file and convert into a dict of metobs objects.
+def to_epoch(times):
+    """Convert times into integer seconds since 1970-01-01 UTC.
+
+    Input:
+        -   A single time or a sequence of times. These can be datetimes,
+            pandas Timestamps, numpy datetime64 values or epoch seconds.
+            Naive datetimes are assumed to be in UTC.
+    Output:
+        -   An int64 numpy array of epoch seconds (0-d for a single time)
+    """
+    if (isinstance(times, np.ndarray)):
+        if (np.issubdtype(times.dtype, np.datetime64)):
+            return times.astype('datetime64[s]').astype(np.int64)
+        if (times.dtype != object):
+            return times.astype(np.int64)
+    if (isinstance(times, (list, tuple, np.ndarray))):
+        return np.array([to_epoch(t) for t in times], dtype=np.int64)
+    if (isinstance(times, np.datetime64)):
+        return np.array(times, dtype='datetime64[s]').astype(np.int64)
+    if (isinstance(times, datetime)):
+        if (times.tzinfo is None):
+            times = times.replace(tzinfo=pytz.UTC)
+        return np.array(int(times.timestamp()), dtype=np.int64)
+    return np.array(times, dtype=np.int64)
+
+
+class metar_store:
+    """A sorted, array-backed store of METAR observations.
+
+    times = observation times in epoch seconds (int64), sorted
+    temp, dewp, w_s, w_d, w_g, vis, pres, cld = float64 arrays, as metobs
+    cb = bool array, as metobs
+
+    Lookups use a binary search on the times, so each is O(log n).
+    """
+
+    fields = ['temp', 'dewp', 'w_s', 'w_d', 'w_g', 'cb', 'vis', 'pres', 'cld']
+
+    def __init__(self, times, cols, is_sorted=False):
+        """Setup the class.
+
+        Inputs:
+            -   times: Observation times in epoch seconds
+            -   cols: A dict of arrays, one for each of the names in fields
+            -   is_sorted: (optional) if True the arrays are already sorted
+                with no repeated times, and are used without copying. This
+                keeps memory-mapped arrays mapped.
+        If two observations share a time the last one is kept.
+        """
+        if (is_sorted):
+            self.times = times
+            for fld in self.fields:
+                setattr(self, fld, cols[fld])
+            return
+        times = np.asarray(times, dtype=np.int64)
+        order = np.argsort(times, kind='stable')
+        times = times[order]
+        keep = np.ones(len(times), dtype=bool)
+        keep[:-1] = times[1:] != times[:-1]
+        self.times = times[keep]
+        for fld in self.fields:
+            if (fld == 'cb'):
+                arr = np.asarray(cols[fld], dtype=bool)
+            else:
+                arr = np.asarray(cols[fld], dtype=np.float64)
+            setattr(self, fld, arr[order][keep])
+
+    def __len__(self):
+        """Return the number of observations in the store."""
+        return len(self.times)
+
+    def get_obs(self, idx):
+        """Return the observation at a given array position as a metobs."""
+        return metobs(float(self.temp[idx]), float(self.dewp[idx]),
+                      float(self.w_s[idx]), float(self.w_d[idx]),
+                      float(self.w_g[idx]), bool(self.cb[idx]),
+                      float(self.vis[idx]), float(self.pres[idx]),
+                      float(self.cld[idx]))
+
+    def bracket(self, times):
+        """Find the observations either side of some times.
+
+        Input:
+            -   A time or sequence of times, see to_epoch()
+        Output:
+            -   The array position of the last observation at or before
+                each time, or -1 if there is none
+            -   The array position of the first observation after each
+                time, or len(self) if there is none
+        """
+        secs = to_epoch(times)
+        aft = np.searchsorted(self.times, secs, side='right')
+        return aft - 1, aft
+
+    def nearest(self, times):
+        """Find the observations closest in time to some times.
+
+        If two observations are equally close the earlier one is used.
+        Input:
+            -   A time or sequence of times, see to_epoch()
+        Output:
+            -   The array position of the closest observation to each time,
+                or -1 if the store is empty
+            -   The absolute time difference in seconds
+        """
+        secs = to_epoch(times)
+        n_obs = len(self.times)
+        if (n_obs < 1):
+            return (np.full(np.shape(secs), -1, dtype=np.int64),
+                    np.full(np.shape(secs), np.inf))
+        bef, aft = self.bracket(secs)
+        bef_c = np.clip(bef, 0, n_obs - 1)
+        aft_c = np.clip(aft, 0, n_obs - 1)
+        d_bef = np.where(bef >= 0, secs - self.times[bef_c], np.inf)
+        d_aft = np.where(aft < n_obs, self.times[aft_c] - secs, np.inf)
+        idx = np.where(d_aft < d_bef, aft_c, bef_c)
+        tdiff = np.minimum(d_bef, d_aft).astype(np.float64)
+
+        return idx, tdiff
+
+    def find_closest(self, l_time, max_diff=3600):
+        """Find the closest METAR to a time, as find_closest_metar().
+
+        Inputs:
+            -   The time to match
+            -   (optional) The maximum allowed time difference in seconds
+        Output:
+            -   The best metar (as metobs), or None if none within max_diff
+            -   The time difference in seconds
+        """
+        idx, tdiff = self.nearest(l_time)
+        tdiff = float(tdiff)
+        if (tdiff < max_diff):
+            return self.get_obs(int(idx)), tdiff
+        return None, tdiff
+
+    def find_closest_batch(self, l_times, max_diff=3600):
+        """Find the closest METAR to each of a sequence of times.
+
+        Inputs:
+            -   A sequence of times to match
+            -   (optional) The maximum allowed time difference in seconds
+        Output:
+            -   A list of the best metars (as metobs), with None for times
+                that have no METAR within max_diff
+            -   An array of the time differences in seconds
+        """
+        idx, tdiff = self.nearest(l_times)
+        bmets = []
+        for i in range(0, len(idx)):
+            if (tdiff[i] < max_diff):
+                bmets.append(self.get_obs(idx[i]))
+            else:
+                bmets.append(None)
+        return bmets, tdiff
+
+
+def parse_metars(inf, verbose=False):
+    """A function to parse metars from a file and convert into a metar_store.
     Input:
         -   inf: The input file (as a string filename)
+        -   verbose: (optional) print details of bad METAR data
     Output:
-        -   a dict of metobs read from the file
+        -   a metar_store of the observations read from the file
     """
+    from metar import Metar
 
     fid = open(inf, 'r')
 
-    met_dict = {}
+    met_times = []
+    met_cols = {}
+    for fld in metar_store.fields:
+        met_cols[fld] = []
 
     for line in fid:
         data = line.rstrip('\n').split(',')
@@ -112,7 +276,145 @@ def get_metars(inf, verbose):
             if obs.sky[0][1] is not None:
                 cld = obs.sky[0][1].value()
 
-        cur_obs = metobs(temp, dewp, w_s, w_d, w_g, cb, vis, press, cld)
-        met_dict[metdate] = cur_obs
+        met_times.append(int(metdate.timestamp()))
+        met_cols['temp'].append(temp)
+        met_cols['dewp'].append(dewp)
+        met_cols['w_s'].append(w_s)
+        met_cols['w_d'].append(w_d)
+        met_cols['w_g'].append(w_g)
+        met_cols['cb'].append(cb)
+        met_cols['vis'].append(vis)
+        met_cols['pres'].append(press)
+        met_cols['cld'].append(cld)
+    fid.close()
+
+    return metar_store(met_times, met_cols)
+
+
+def get_source_key(inf, hash_file=True):
+    """Compute the key used to check whether a METAR cache is up to date.
+
+    Input:
+        -   inf: The METAR text file
+        -   hash_file: (optional) if False, the hash is not computed
+    Output:
+        -   A dict of the file modification time (ns), size and sha1 hash
+    """
+    stat = os.stat(inf)
+    key = {'mtime': str(stat.st_mtime_ns),
+           'size': str(stat.st_size),
+           'sha1': ''}
+    if (hash_file):
+        sha = hashlib.sha1()
+        with open(inf, 'rb') as fid:
+            for chunk in iter(lambda: fid.read(1 << 20), b''):
+                sha.update(chunk)
+        key['sha1'] = sha.hexdigest()
+    return key
+
+
+def read_cache_key(cache_dir):
+    """Read the source key stored in a METAR cache directory, or None."""
+    try:
+        with open(os.path.join(cache_dir, 'key.txt'), 'r') as fid:
+            key = {}
+            for line in fid:
+                name, val = line.rstrip('\n').split('=', 1)
+                key[name] = val
+        return key
+    except (IOError, ValueError):
+        return None
+
+
+def write_cache_key(cache_dir, key):
+    """Write the source key into a METAR cache directory, atomically."""
+    outf = os.path.join(cache_dir, 'key.txt')
+    tmpf = outf + '.' + str(os.getpid()) + '.tmp'
+    with open(tmpf, 'w') as fid:
+        for name in ['mtime', 'size', 'sha1']:
+            fid.write(name + '=' + key[name] + '\n')
+    os.replace(tmpf, outf)
+
+
+def save_metar_cache(store, cache_dir, key):
+    """Save a metar_store as a directory of binary column files.
+
+    One .npy file is written per column so that each can be memory-mapped
+    on load. The key file is written last, so an interrupted save is
+    never mistaken for a valid cache.
+    Inputs:
+        -   store: The metar_store to save
+        -   cache_dir: The output directory
+        -   key: The source key, as returned by get_source_key()
+    """
+    if (not os.path.exists(cache_dir)):
+        os.makedirs(cache_dir, exist_ok=True)
+    keyf = os.path.join(cache_dir, 'key.txt')
+    if (os.path.exists(keyf)):
+        os.remove(keyf)
+    for fld in ['times'] + metar_store.fields:
+        outf = os.path.join(cache_dir, fld + '.npy')
+        tmpf = outf + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpf, 'wb') as fid:
+            np.save(fid, np.ascontiguousarray(getattr(store, fld)))
+        os.replace(tmpf, outf)
+    write_cache_key(cache_dir, key)
+
+
+def load_metar_cache(cache_dir):
+    """Load a metar_store from a cache directory, memory-mapping the columns.
+
+    Input:
+        -   cache_dir: A directory written by save_metar_cache()
+    Output:
+        -   A metar_store backed by read-only memory maps
+    """
+    times = np.load(os.path.join(cache_dir, 'times.npy'), mmap_mode='r')
+    cols = {}
+    for fld in metar_store.fields:
+        cols[fld] = np.load(os.path.join(cache_dir, fld + '.npy'),
+                            mmap_mode='r')
+    return metar_store(times, cols, is_sorted=True)
+
+
+def get_metars(inf, verbose=False, cache_dir=None):
+    """Load the METARs from a file, using a compiled cache where possible.
+
+    The first call parses the text file and stores the result in a binary
+    cache. Later calls memory-map the cache instead, and the file is only
+    parsed again if its contents change. A changed modification time with
+    the same contents (sha1) just refreshes the stored key.
+    Input:
+        -   inf: The input file (as a string filename)
+        -   verbose: (optional) print details of bad METAR data
+        -   cache_dir: (optional) The cache directory, defaults to the
+            input filename with '.cache' appended. Use False to disable.
+    Output:
+        -   a metar_store of the observations read from the file
+    """
+    if (cache_dir is False):
+        return parse_metars(inf, verbose)
+    if (cache_dir is None):
+        cache_dir = inf + '.cache'
+
+    old_key = read_cache_key(cache_dir)
+    key = get_source_key(inf, hash_file=False)
+    if (old_key is not None):
+        if (old_key['mtime'] == key['mtime'] and
+                old_key['size'] == key['size']):
+            return load_metar_cache(cache_dir)
+        key = get_source_key(inf)
+        if (old_key['sha1'] == key['sha1']):
+            write_cache_key(cache_dir, key)
+            return load_metar_cache(cache_dir)
+    else:
+        key = get_source_key(inf)
 
-    return met_dict
+    if (verbose):
+        print("Compiling METAR cache for", inf)
+    store = parse_metars(inf, verbose)
+    try:
+        save_metar_cache(store, cache_dir, key)
+    except OSError as e:
+        print("WARNING: Unable to write METAR cache:", cache_dir, e)
+    return store